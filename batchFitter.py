@@ -0,0 +1,155 @@
+import numpy as np
+
+from splineModel import ScaledSplineModel
+from parameterPredictor import ParameterPredictor
+
+
+class BatchFitter(object):
+    def __init__(self,fitFunction,interval,maxIterations=50,tolerance=1e-8,sigma=None):
+        """
+        Fits a ScaledSpline fit function to the interval of many intensity
+        profiles at once. The interval windows of K profiles are stacked in a
+        K x M array and a Levenberg-Marquardt solve of the 3-parameter model
+        (shift, scale, offset) is done for all of them together in numpy, so the
+        per-frame python overhead of curve_fit is paid once per batch.
+        
+        sigma is an optional per-pixel standard deviation of the whole profile,
+        the residuals are weighted with 1/sigma like curve_fit does.
+        """
+        self.fitFunction = fitFunction
+        self.model = ScaledSplineModel(fitFunction)
+        self.xmin = int(min(interval))
+        self.xmax = int(max(interval))
+        self.maxIterations = maxIterations
+        self.tolerance = tolerance
+        self.weights = None
+        self.evaluations = None
+        if sigma is not None:
+            self.weights = 1.0 / np.asarray(sigma,dtype=np.float64)[self.xmin:self.xmax]
+
+    def fit(self,intensityProfiles,p0=(0.0,1.0,0.0)):
+        """
+        Fits every row of the 2-D array intensityProfiles. p0 is either one set of
+        initial parameters for all rows or one set per row.
+
+        Returns the K x 3 array of fitted parameters, the K displacements and a
+        boolean array telling which fits converged. Afterwards evaluations holds
+        the number of model evaluations of every row.
+        """
+        profiles = np.atleast_2d(intensityProfiles)
+        ydata = np.asarray(profiles[:,self.xmin:self.xmax],dtype=np.float64)
+        xdata = np.arange(profiles.shape[1],dtype=np.float64)[self.xmin:self.xmax]
+        nFrames = ydata.shape[0]
+
+        params = np.empty((nFrames,3))
+        params[:] = p0
+        damping = np.empty(nFrames)
+        damping.fill(1e-3)
+        converged = np.zeros(nFrames,dtype=bool)
+        finished = np.zeros(nFrames,dtype=bool)
+        self.evaluations = np.ones(nFrames,dtype=int)
+
+        residuals, jacobians = self._residualsAndJacobians(xdata,ydata,params)
+        cost = (residuals**2).sum(axis=1)
+
+        for iteration in range(self.maxIterations):
+            active = ~finished
+            if not active.any():
+                break
+
+            jac = jacobians[active]
+            jtj = np.einsum('kmi,kmj->kij',jac,jac)
+            gradient = np.einsum('kmi,km->ki',jac,residuals[active])
+
+            diagonal = np.einsum('kii->ki',jtj)
+            system = jtj.copy()
+            system[:,range(3),range(3)] += damping[active,None] * diagonal
+            try:
+                step = np.linalg.solve(system,gradient[...,None])[...,0]
+            except np.linalg.LinAlgError:
+                step = np.array([np.linalg.lstsq(a,b,rcond=-1)[0] for a,b in zip(system,gradient)])
+
+            trialParams = params[active] + step
+            trialResiduals, trialJacobians = self._residualsAndJacobians(xdata,ydata[active],trialParams)
+            self.evaluations[active] += 1
+            trialCost = (trialResiduals**2).sum(axis=1)
+
+            improved = trialCost < cost[active]
+            activeIndices = np.flatnonzero(active)
+            accepted = activeIndices[improved]
+
+            smallStep = np.all(np.abs(step) <= self.tolerance * (np.abs(params[active]) + self.tolerance),axis=1)
+            smallChange = np.abs(cost[active]-trialCost) <= self.tolerance * cost[active]
+
+            params[accepted] = trialParams[improved]
+            residuals[accepted] = trialResiduals[improved]
+            jacobians[accepted] = trialJacobians[improved]
+            cost[accepted] = trialCost[improved]
+
+            damping[accepted] /= 10.0
+            damping[activeIndices[~improved]] *= 10.0
+
+            # without improvement a negligible step means the minimum is reached
+            done = (improved & smallChange) | smallStep
+            converged[activeIndices[done]] = True
+            # a frame for which no step improves the fit any more is given up on
+            finished[activeIndices[done | (damping[activeIndices] > 1e10)]] = True
+
+        displacements = np.array([self.fitFunction.getDisplacement(*p) for p in params])
+        return params, displacements, converged
+
+    def _residualsAndJacobians(self,xdata,ydata,params):
+        shift, scale, offset = params[:,0:1], params[:,1:2], params[:,2:3]
+        spline, splineDerivative = self.model.evaluate(xdata[None,:] - shift)
+
+        residuals = ydata - (scale*spline + offset)
+        jacobians = np.empty(ydata.shape + (3,))
+        jacobians[...,0] = -scale * splineDerivative
+        jacobians[...,1] = spline
+        jacobians[...,2] = 1.0
+        if self.weights is not None:
+            residuals *= self.weights
+            jacobians *= self.weights[:,None]
+        return residuals, jacobians
+
+
+def fitProfileMatrix(profileMatrix,fitFunction,interval,batchSize=256,p0=(0.0,1.0,0.0),seed=None):
+    """
+    Generator that fits a recorded profile matrix (one profile per row, e.g. a
+    memory-mapped array) in batches of batchSize rows. Every batch is started
+    from the parameters of the last row that converged before it, or from p0.
+
+    Like for a PeakFitter, a fit counts as not converged when its shift is
+    larger than the interval is wide, or when its scale changed sign or by
+    more than a factor of 4 from the last fit that converged; fits of dark
+    frames end up like that. When the last rows of a batch did not converge,
+    the peak may have moved anywhere since, and these rows are fitted again
+    from seed(their profiles, newest first), if seed is given and returns
+    parameters that pass the same test or have a larger scale, as when the
+    light comes back after dark frames. The fits are then judged against the
+    seed.
+
+    Yields (params, displacements, converged) for each batch.
+    """
+    fitter = BatchFitter(fitFunction,interval)
+    divergence = ParameterPredictor(maxShift=max(interval)-min(interval))
+
+    def fit(profiles,p0):
+        params, displacements, converged = fitter.fit(profiles,p0)
+        converged &= ~divergence.isDiverged(params)
+        return params, displacements, converged
+
+    for start in range(0,len(profileMatrix),batchSize):
+        profiles = profileMatrix[start:start+batchSize]
+        params, displacements, converged = fit(profiles,p0)
+        if seed is not None and not converged[-1]:
+            lost = np.flatnonzero(converged)[-1] + 1 if converged.any() else 0
+            seeded = seed(profiles[lost:][::-1])
+            if seeded is not None and (not divergence.isDiverged(seeded) or seeded[1] > divergence.last[1]):
+                divergence.reset()
+                divergence.record(seeded)
+                params[lost:], displacements[lost:], converged[lost:] = fit(profiles[lost:],seeded)
+        if converged.any():
+            p0 = params[converged][-1]
+            divergence.record(p0)
+        yield params, displacements, converged
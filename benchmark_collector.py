@@ -0,0 +1,117 @@
+"""
+Measures how CurveFitServiceCollector hands the fit results to the gui thread:
+one resultReceived signal per result, or one resultsReceived signal per batch
+(batch=True).
+
+A sender thread pushes synthetic fit results to the collector at --rate
+results per second (0 sends them as fast as it can), and a slot on the thread
+of the Qt event loop counts them. Reported are the number of signals, the
+results per second delivered and the delay from collecting a result to the
+slot, which grows when the event loop cannot keep up with the signals.
+
+usage: python benchmark_collector.py [--results 20000] [--rate 0,5000]
+"""
+
+import zmq
+import numpy as np
+import threading
+import argparse
+import time
+from PyQt4 import QtCore
+
+from curveFitCollector import CurveFitServiceCollector
+from fitResultFormat import RESULT_MESSAGE, packFitResult
+
+
+def makeRecords(nResults):
+    records = []
+    for i in range(nResults):
+        fitResult = dict(sequence=i,frameNumber=i,sendTime=time.time(),peaks=['mp','ref'],
+                         displacement_mp=np.sin(i/100.0),popt_mp=[np.sin(i/100.0),1.0,0.0],
+                         displacement_ref=0.0,popt_ref=[0.0,1.0,0.0])
+        records.append(packFitResult(fitResult,dict(mp=0,ref=0)))
+    return records
+
+def sendRecords(address, records, rate):
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.PUSH)
+    socket.connect(address)
+    t0 = time.time()
+    for i, record in enumerate(records):
+        if rate > 0:
+            delay = t0 + i / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        socket.send_multipart([RESULT_MESSAGE,record])
+    socket.close(linger=-1)
+
+
+class Receiver(QtCore.QObject):
+    def __init__(self,app,nResults):
+        QtCore.QObject.__init__(self)
+        self.app = app
+        self.nResults = nResults
+        self.signals = 0
+        self.results = 0
+        self.delays = []
+        self.endTime = None
+
+    def handleResult(self,fitResult):
+        self._count(1,[time.time() - fitResult['collectTime']])
+
+    def handleResults(self,batch):
+        self._count(batch['count'],time.time() - batch['collectTime'])
+
+    def _count(self,n,delays):
+        self.signals += 1
+        self.results += n
+        self.delays.extend(delays)
+        if self.results >= self.nResults:
+            self.endTime = time.time()
+            self.app.quit()
+
+
+def benchmarkCollector(app, records, rate, batch, timeout=60.0):
+    collector = CurveFitServiceCollector(batch=batch)
+    receiver = Receiver(app,len(records))
+    if batch:
+        collector.resultsReceived.connect(receiver.handleResults)
+    else:
+        collector.resultReceived.connect(receiver.handleResult)
+    collector.start()
+    timer = QtCore.QTimer()
+    timer.setSingleShot(True)
+    timer.timeout.connect(app.quit)
+    timer.start(int(timeout*1000))
+
+    t0 = time.time()
+    sender = threading.Thread(target=sendRecords,args=(collector.address,records,rate))
+    sender.start()
+    app.exec_()
+    timer.stop()
+    sender.join()
+    collector.abort()
+    collector.wait()
+    wallTime = (receiver.endTime or time.time()) - t0
+    return receiver.signals, receiver.results / wallTime, np.median(receiver.delays), np.percentile(receiver.delays,99)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit result delivery benchmark")
+    parser.add_argument('--results', type=int, default=20000,
+                        help="Number of fit results to send.")
+    parser.add_argument('--rate', type=lambda text: [float(value) for value in text.split(",")],
+                        default=[0,5000],
+                        help="Comma separated send rates [results/s], 0 sends as fast as possible.")
+    args = parser.parse_args()
+
+    app = QtCore.QCoreApplication([])
+    records = makeRecords(args.results)
+
+    print "%10s %8s %10s %12s %14s %14s" % ("rate","mode","signals","results/s","delay p50 [ms]","delay p99 [ms]")
+    for rate in args.rate:
+        for batch in (False,True):
+            signals, throughput, p50, p99 = benchmarkCollector(app,records,rate,batch)
+            print "%10s %8s %10i %12.0f %14.2f %14.2f" % ("max" if rate == 0 else "%.0f" % rate,
+                                                          "batch" if batch else "single",
+                                                          signals, throughput, p50*1e3, p99*1e3)
@@ -0,0 +1,56 @@
+"""
+Compares the throughput and accuracy of the two peak estimators of
+RealTimeFitter: the ScaledSpline fit with curve_fit ("spline") and the FFT
+cross-correlation estimator ("xcorr").
+
+usage: python benchmark_estimators.py [--frames 1000]
+"""
+
+import numpy as np
+import argparse
+import time
+
+from fitWorker import RealTimeFitter
+from syntheticProfiles import makeProfiles as makeSineProfiles, makeFitFunction
+
+
+def makeProfiles(nFrames):
+    """
+    Returns synthetic profiles of a moving and a stationary peak, and the true
+    displacement of the moving peak in pixels.
+    """
+    profiles, shifts = makeSineProfiles(nFrames)
+    # 2 pixels per x unit
+    return profiles, shifts * 2
+
+def benchmarkEstimator(profiles,estimator):
+    fitter = RealTimeFitter()
+    fitter.setMovingPeakFitFunction(makeFitFunction())
+    fitter.setReferencePeakFitFunction(makeFitFunction())
+    fitter.setMovingPeakInterval((40,80))
+    fitter.setReferencePeakInterval((100,140))
+    fitter.setPeakEstimator("movingPeak",estimator)
+    fitter.setPeakEstimator("referencePeak",estimator)
+
+    displacements = []
+    t0 = time.time()
+    for profile in profiles:
+        result = fitter.fit(profile)
+        displacements.append(result['displacement_mp'] - result['displacement_ref'])
+    wallTime = time.time() - t0
+    return len(profiles) / wallTime, np.array(displacements)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RealTimeFitter estimator benchmark")
+    parser.add_argument('--frames', type=int, default=1000,
+                        help="Number of synthetic profiles to process.")
+    args = parser.parse_args()
+
+    profiles, trueDisplacements = makeProfiles(args.frames)
+
+    print "%-10s %14s %18s" % ("estimator","frames/s","rms error [px]")
+    for estimator in ["spline","xcorr"]:
+        framesPerSecond, displacements = benchmarkEstimator(profiles,estimator)
+        error = displacements - trueDisplacements
+        print "%-10s %14.1f %18.4f" % (estimator, framesPerSecond, np.sqrt(np.mean((error-error.mean())**2)))
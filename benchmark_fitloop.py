@@ -0,0 +1,157 @@
+"""
+Compares the event-driven FittingConsumer loop with the loop it replaced, which
+polled with timeout=0 and slept for 1 ms whenever nothing was ready.
+
+Two numbers are reported for each loop:
+  - the CPU time an idle worker uses per second of wall time
+  - the latency from publishing a profile to receiving its fit result, measured
+    one profile at a time so that no queueing is involved
+
+usage: python benchmark_fitloop.py [--idle 5] [--frames 200]
+"""
+
+import zmq
+import msgpack as msg
+import msgpack_numpy
+msgpack_numpy.patch()
+import numpy as np
+import multiprocessing as mp
+import argparse
+import time
+import os
+
+from fitWorker import FittingConsumer
+from fitResultFormat import RESULT_MESSAGE
+from profileMessage import unpackProfileMessage
+from syntheticProfiles import makeProfile, makeFitFunction
+
+
+class PollingFittingConsumer(FittingConsumer):
+    """
+    FittingConsumer with the poll(timeout=0) + sleep(1ms) loop it used to have.
+    """
+    def run(self):
+        while self.state != "aborted":
+            sockets = dict(self.poller.poll(timeout=0))
+
+            if self.control_socket in sockets:
+                rpc = self.control_socket.recv_pyobj()
+                self._handleRPC(rpc)
+
+            if self.producer_socket in sockets:
+                sequence, message = self._receiveProducerMessage()
+                lvdata = unpackProfileMessage(message)
+                self._handleProducerData(lvdata,sequence)
+            if not sockets:
+                time.sleep(1e-3)
+        self._shutdown()
+
+
+def consumeWorker(consumerClass, producerAddress, collectorAddress, controlAddress, cpuConnection):
+    consumer = consumerClass(producerAddress, collectorAddress, controlAddress)
+    t0 = os.times()
+    consumer.run()
+    t1 = os.times()
+    cpuConnection.send((t1[0]-t0[0]) + (t1[1]-t0[1]))
+    cpuConnection.close()
+
+
+class LoopBenchmark(object):
+    def __init__(self,consumerClass):
+        self.consumerClass = consumerClass
+        self.context = zmq.Context()
+
+        self.producerSocket = self.context.socket(zmq.PUB)
+        self.producerAddress = "tcp://127.0.0.1:%i" % self.producerSocket.bind_to_random_port("tcp://127.0.0.1")
+
+        self.collectorSocket = self.context.socket(zmq.PULL)
+        self.collectorAddress = "tcp://127.0.0.1:%i" % self.collectorSocket.bind_to_random_port("tcp://127.0.0.1")
+
+        self.controlSocket = self.context.socket(zmq.DEALER)
+        self.controlAddress = "tcp://127.0.0.1:%i" % self.controlSocket.bind_to_random_port("tcp://127.0.0.1")
+
+        self.cpuConnection, childConnection = mp.Pipe()
+        self.process = mp.Process(target=consumeWorker,
+                                  args=(consumerClass,self.producerAddress,self.collectorAddress,
+                                        self.controlAddress,childConnection))
+        self.process.start()
+
+    def rpc(self,method,**params):
+        self.controlSocket.send_pyobj(dict(method=method,params=params))
+
+    def configure(self):
+        fitFunction = makeFitFunction()
+        self.rpc("setMovingPeakFitFunction",fitFunction=fitFunction)
+        self.rpc("setReferencePeakFitFunction",fitFunction=fitFunction)
+        self.rpc("setMovingPeakInterval",interval=(40,80))
+        self.rpc("setReferencePeakInterval",interval=(100,140))
+        self.rpc("startFitting")
+
+        # wait for the subscription to be in place
+        while True:
+            self.publish(makeProfile())
+            if self.collectorSocket.poll(timeout=100):
+                self.receiveResult()
+                break
+
+    def publish(self,profile):
+        self.producerSocket.send(msg.packb({'Measurement Process State': "benchmark",
+                                            'Intensity Profile': profile,
+                                            'Actuator Voltage': 0.0}))
+
+    def receiveResult(self):
+        """
+        Receives messages from the worker up to and including the next fit result.
+        """
+        while self.collectorSocket.recv_multipart()[0] != RESULT_MESSAGE:
+            pass
+
+    def measureLatencies(self,nFrames):
+        latencies = []
+        for i in range(nFrames):
+            profile = makeProfile(shift=np.sin(i/10.0)*3)
+            t0 = time.time()
+            self.publish(profile)
+            if self.collectorSocket.poll(timeout=1000):
+                self.receiveResult()
+                latencies.append(time.time()-t0)
+        return np.array(latencies)
+
+    def finish(self):
+        """
+        Aborts the worker and returns the CPU time it used while running.
+        """
+        self.rpc("abort")
+        cpuTime = self.cpuConnection.recv()
+        self.process.join()
+        self.context.destroy(linger=0)
+        return cpuTime
+
+
+def benchmarkLoop(consumerClass, idleSeconds, nFrames):
+    bench = LoopBenchmark(consumerClass)
+    time.sleep(idleSeconds)
+    idleCpu = bench.finish() / idleSeconds
+
+    bench = LoopBenchmark(consumerClass)
+    bench.configure()
+    latencies = bench.measureLatencies(nFrames)
+    bench.finish()
+    return idleCpu, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FittingConsumer loop benchmark")
+    parser.add_argument('--idle', type=float, default=5.0,
+                        help="Seconds the idle CPU use is measured over.")
+    parser.add_argument('--frames', type=int, default=200,
+                        help="Number of profiles used for the latency measurement.")
+    args = parser.parse_args()
+
+    print "%-14s %14s %14s %14s %14s" % ("loop","idle cpu [%]","mean [ms]","p50 [ms]","p99 [ms]")
+    for name, consumerClass in [("poll+sleep",PollingFittingConsumer),("event-driven",FittingConsumer)]:
+        idleCpu, latencies = benchmarkLoop(consumerClass, args.idle, args.frames)
+        print "%-14s %14.2f %14.3f %14.3f %14.3f" % (name, idleCpu*100,
+                                                     latencies.mean()*1e3,
+                                                     np.percentile(latencies,50)*1e3,
+                                                     np.percentile(latencies,99)*1e3)
@@ -0,0 +1,101 @@
+"""
+Compares RealTimeFitter with the exact Jacobian of the ScaledSpline model to
+RealTimeFitter with the finite-difference Jacobian curve_fit estimates itself.
+
+For both, the number of fit-function evaluations and Jacobian evaluations per
+fit and the wall time per fit are reported, measured over a synthetic sweep of
+the moving peak. With finite differences the Jacobian is made of fit-function
+evaluations, so it is already part of their count; the total adds the analytic
+Jacobian calls, each of which evaluates the spline and its derivative once.
+
+usage: python benchmark_jacobian.py [--frames 1000]
+"""
+
+import numpy as np
+import argparse
+import time
+
+from fitWorker import RealTimeFitter
+from syntheticProfiles import makeProfiles, makeFitFunction
+
+
+class CountingFitFunction(object):
+    """
+    Wraps a fit function and counts how often it is evaluated.
+    """
+    def __init__(self,fitFunction):
+        self.fitFunction = fitFunction
+        self.evaluations = 0
+
+    def __call__(self,*args):
+        self.evaluations += 1
+        return self.fitFunction(*args)
+
+    def __getattr__(self,name):
+        return getattr(self.fitFunction,name)
+
+
+class CountingJacobian(object):
+    """
+    Wraps the jacobian method of a ScaledSplineModel and counts its calls.
+    """
+    def __init__(self,jacobian):
+        self.jacobian = jacobian
+        self.evaluations = 0
+
+    def __call__(self,*args):
+        self.evaluations += 1
+        return self.jacobian(*args)
+
+
+def benchmarkFitter(profiles,useAnalyticJacobian):
+    mpFitFunction = CountingFitFunction(makeFitFunction())
+    refFitFunction = CountingFitFunction(makeFitFunction())
+
+    fitter = RealTimeFitter()
+    fitter.setMovingPeakFitFunction(mpFitFunction)
+    fitter.setReferencePeakFitFunction(refFitFunction)
+    fitter.setMovingPeakInterval((40,80))
+    fitter.setReferencePeakInterval((100,140))
+    fitter.setUseAnalyticJacobian(useAnalyticJacobian)
+
+    jacobians = []
+    for name in ("mp","ref"):
+        model = fitter._getPeak(name).model
+        model.jacobian = CountingJacobian(model.jacobian)
+        jacobians.append(model.jacobian)
+
+    mpFitFunction.evaluations = 0
+    refFitFunction.evaluations = 0
+    displacements = []
+    t0 = time.time()
+    for profile in profiles:
+        result = fitter.fit(profile)
+        displacements.append(result['displacement_mp'] - result['displacement_ref'])
+    wallTime = time.time() - t0
+
+    evaluations = mpFitFunction.evaluations + refFitFunction.evaluations
+    jacobianEvaluations = sum(jacobian.evaluations for jacobian in jacobians)
+    # every profile is fitted twice, once for each peak
+    nFits = 2 * len(profiles)
+    return (float(evaluations) / nFits, float(jacobianEvaluations) / nFits,
+            wallTime / nFits, np.array(displacements))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RealTimeFitter Jacobian benchmark")
+    parser.add_argument('--frames', type=int, default=1000,
+                        help="Number of synthetic profiles to fit.")
+    args = parser.parse_args()
+
+    profiles, shifts = makeProfiles(args.frames)
+
+    results = dict()
+    print "%-18s %16s %16s %16s %16s" % ("jacobian","evaluations/fit","jacobians/fit","total/fit","time/fit [ms]")
+    for name, useAnalyticJacobian in [("finite difference",False),("analytic",True)]:
+        evaluations, jacobianEvaluations, wallTime, displacements = benchmarkFitter(profiles,useAnalyticJacobian)
+        results[name] = displacements
+        print "%-18s %16.1f %16.1f %16.1f %16.3f" % (name, evaluations, jacobianEvaluations,
+                                                      evaluations + jacobianEvaluations, wallTime*1e3)
+
+    print "max. displacement difference: %g px" % np.abs(results["analytic"] - results["finite difference"]).max()
@@ -0,0 +1,95 @@
+"""
+Compares the ScaledSpline fit function evaluated directly with the same fit
+function evaluated from its lookup table (TabulatedScaledSpline).
+
+Reported are the time to evaluate the fit function over a whole profile, as for
+plotting, at several profile lengths, the wall time per fit of RealTimeFitter,
+the largest difference between the table and the spline, and the largest
+difference of the fitted displacements.
+
+usage: python benchmark_lut.py [--frames 1000] [--lengths 200,1000,4000] [--tolerance 1e-6]
+"""
+
+import numpy as np
+import argparse
+import time
+
+from fitWorker import RealTimeFitter
+from tabulatedFitFunction import TabulatedScaledSpline
+from splineModel import ScaledSplineModel
+from syntheticProfiles import makeProfiles, makeFitFunction
+
+
+def timeCall(function, minTime=0.2):
+    """
+    Returns the mean wall time of calling function, repeated for at least
+    minTime seconds.
+    """
+    n = 0
+    t0 = time.time()
+    while True:
+        function()
+        n += 1
+        elapsed = time.time() - t0
+        if elapsed >= minTime:
+            return elapsed / n
+
+def benchmarkEvaluation(length, tolerance):
+    fitFunction = makeFitFunction(length)
+    tabulated = TabulatedScaledSpline(fitFunction,domain=(0,length-1),tolerance=tolerance)
+    x = np.arange(length,dtype=float)
+    # a fine grid with subpixel shifts, not only the pixel positions
+    u = np.linspace(0,length-1,10*length)
+    reference = ScaledSplineModel(fitFunction).spline(u)
+    error = np.abs(tabulated.spline(u) - reference).max() / np.abs(reference).max()
+
+    directTime = timeCall(lambda: fitFunction(x,0.3,1.0,0.0))
+    tabulatedTime = timeCall(lambda: tabulated(x,0.3,1.0,0.0))
+    return directTime, tabulatedTime, error, tabulated.samplesPerPixel
+
+def benchmarkFitter(profiles, fitFunction):
+    fitter = RealTimeFitter()
+    fitter.setMovingPeakFitFunction(fitFunction)
+    fitter.setReferencePeakFitFunction(fitFunction)
+    fitter.setMovingPeakInterval((40,80))
+    fitter.setReferencePeakInterval((100,140))
+
+    displacements = []
+    t0 = time.time()
+    for profile in profiles:
+        result = fitter.fit(profile)
+        displacements.append(result['displacement_mp'] - result['displacement_ref'])
+    wallTime = time.time() - t0
+    # every profile is fitted twice, once for each peak
+    return wallTime / (2 * len(profiles)), np.array(displacements)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lookup-table fit function benchmark")
+    parser.add_argument('--frames', type=int, default=1000,
+                        help="Number of synthetic profiles to fit.")
+    parser.add_argument('--lengths', type=lambda text: [int(value) for value in text.split(",")],
+                        default=[200,1000,4000],
+                        help="Comma separated profile lengths for the evaluation timing.")
+    parser.add_argument('--tolerance', type=float, default=1e-6,
+                        help="Relative accuracy of the lookup tables.")
+    args = parser.parse_args()
+
+    print "%8s %18s %18s %10s %14s" % ("length","direct [us]","tabulated [us]","speedup","rel. error")
+    for length in args.lengths:
+        directTime, tabulatedTime, error, samplesPerPixel = benchmarkEvaluation(length,args.tolerance)
+        print "%8i %18.1f %18.1f %10.1f %14.2g" % (length, directTime*1e6, tabulatedTime*1e6,
+                                                   directTime/tabulatedTime, error)
+
+    profiles, shifts = makeProfiles(args.frames)
+    fitFunction = makeFitFunction()
+    results = dict()
+    print
+    print "%-18s %16s" % ("fit function","time/fit [ms]")
+    for name, function in [("spline",fitFunction),
+                           ("lookup table",TabulatedScaledSpline(fitFunction,domain=(0,199),tolerance=args.tolerance))]:
+        wallTime, displacements = benchmarkFitter(profiles,function)
+        results[name] = displacements
+        print "%-18s %16.3f" % (name, wallTime*1e3)
+
+    print "max. displacement difference: %g px" % np.abs(results["lookup table"] - results["spline"]).max()
@@ -0,0 +1,74 @@
+"""
+Measures the wall time per frame of RealTimeFitter with several peaks, fitted
+one after the other (threads=1) and concurrently on a thread pool.
+
+The synthetic profiles have nPeaks gaussian peaks that move independently. The
+fits release the GIL only inside the numpy and FITPACK calls, so the thread
+pool gains most for wide peak intervals; for narrow ones the overhead of
+handing out the fits can make it slower than fitting serially.
+
+usage: python benchmark_peaks.py [--frames 200] [--peaks 4] [--widths 100,400,1600] [--threads 1,2,4]
+"""
+
+import numpy as np
+import argparse
+import time
+
+from fitWorker import RealTimeFitter
+from syntheticProfiles import gauss, makeSplineFitFunction
+
+
+def makeCleanProfile(centers, width, shifts=None):
+    xValues = np.arange(len(centers)*width,dtype=float)
+    if shifts is None:
+        shifts = np.zeros(len(centers))
+    # the peaks are wider in wider intervals, so that every fit has work to do
+    return sum(gauss(xValues,center+shift,width/20.0) for center,shift in zip(centers,shifts))*10000 + 100
+
+def makeProfiles(nFrames, nPeaks, width):
+    centers = width * (np.arange(nPeaks) + 0.5)
+    phases = np.linspace(0,np.pi,nPeaks)
+    profiles = [np.random.poisson(makeCleanProfile(centers,width,3*np.sin(i/20.0 + phases))).astype(float)
+                for i in range(nFrames)]
+    return profiles, makeSplineFitFunction(makeCleanProfile(centers,width))
+
+def benchmarkFitter(profiles, fitFunction, nPeaks, width, threads):
+    fitter = RealTimeFitter(threads=threads)
+    for i in range(nPeaks):
+        name = "peak%i" % i
+        fitter.addPeak(name)
+        fitter.setPeakFitFunction(name,fitFunction)
+        fitter.setPeakInterval(name,(i*width + width/4,i*width + 3*width/4))
+    # only the added peaks are fitted
+    fitter.removePeak("mp")
+    fitter.removePeak("ref")
+
+    t0 = time.time()
+    for profile in profiles:
+        fitter.fit(profile)
+    return (time.time() - t0) / len(profiles)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-peak RealTimeFitter benchmark")
+    parser.add_argument('--frames', type=int, default=200,
+                        help="Number of synthetic profiles to fit.")
+    parser.add_argument('--peaks', type=int, default=4,
+                        help="Number of peaks per profile.")
+    parser.add_argument('--widths', type=lambda text: [int(value) for value in text.split(",")],
+                        default=[100,400,1600],
+                        help="Comma separated widths [pixels] of the profile section around each peak.")
+    parser.add_argument('--threads', type=lambda text: [int(value) for value in text.split(",")],
+                        default=[1,2,4],
+                        help="Comma separated thread pool sizes.")
+    args = parser.parse_args()
+
+    print "%8s %8s %16s %10s" % ("width","threads","time/frame [ms]","speedup")
+    for width in args.widths:
+        profiles, fitFunction = makeProfiles(args.frames,args.peaks,width)
+        serialTime = None
+        for threads in args.threads:
+            wallTime = benchmarkFitter(profiles,fitFunction,args.peaks,width,threads)
+            if serialTime is None:
+                serialTime = wallTime
+            print "%8i %8i %16.3f %10.2f" % (width, threads, wallTime*1e3, serialTime/wallTime)
@@ -0,0 +1,242 @@
+"""
+End-to-end benchmark of the fit pipeline: a synthetic lvdata producer, the
+curve-fit service (CurveFitServiceController with its worker processes) and a
+headless collector socket in this process.
+
+The producer runs in its own process and publishes at a fixed frame rate. Its
+PUB socket has no high-water mark, so the pipeline never drops frames silently
+and the n-th published frame gets sequence number base+n in the workers. The
+sweep covers frame rate, profile length, ROI width and worker count. For every
+configuration one JSON record is appended to the output file with:
+
+  - throughput:   fitted frames per second
+  - latency:      p50/p99/max from publishing a frame to receiving its fit result
+  - drop rate:    fraction of the published frames without a fit result
+  - cpu/frame:    CPU time of the worker processes per fitted frame
+
+usage: python benchmark_pipeline.py [--rates 100,400,1000] [--lengths 200,1000]
+                                    [--roi-widths 40,120] [--workers 1,2]
+                                    [--duration 3] [--output pipeline_benchmark.jsonl]
+"""
+
+import zmq
+import numpy as np
+import multiprocessing as mp
+import argparse
+import platform
+import json
+import time
+import os
+
+from curveFitService import CurveFitServiceController
+from fitResultFormat import RESULT_MESSAGE, FitFunctionCache, unpackFitResult
+from profileMessage import packProfileMessage
+from syntheticProfiles import makeProfile, makeFitFunction, peakIntervals
+
+
+def producerWorker(length, connection):
+    """
+    Publishes synthetic profiles on command from the benchmark: "frame" sends
+    one profile, ("run", rate, nFrames) sends nFrames profiles at rate and
+    returns the send times and the CPU time used, "stop" ends the process.
+    """
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.setsockopt(zmq.SNDHWM, 0)
+    port = socket.bind_to_random_port("tcp://127.0.0.1")
+    connection.send("tcp://127.0.0.1:%i" % port)
+
+    shifts = np.sin(np.linspace(0,2*np.pi,64,endpoint=False)) * 3
+    profiles = [makeProfile(length,shift) for shift in shifts]
+    messageDict = {'Measurement Process State': "benchmark", 'Actuator Voltage': 0.0}
+
+    def publish(i):
+        messageDict['Intensity Profile'] = profiles[i % len(profiles)]
+        messageDict['Send Time'] = time.time()
+        socket.send_multipart(packProfileMessage(messageDict),copy=False)
+
+    while True:
+        command = connection.recv()
+        if command == "frame":
+            publish(0)
+        elif command == "stop":
+            break
+        else:
+            name, rate, nFrames = command
+            sendTimes = np.zeros(nFrames)
+            t0 = os.times()
+            startTime = time.time()
+            for i in range(nFrames):
+                delay = startTime + i / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                sendTimes[i] = time.time()
+                publish(i)
+            t1 = os.times()
+            connection.send((sendTimes, (t1[0]-t0[0]) + (t1[1]-t0[1])))
+
+    socket.close(linger=1000)
+    context.term()
+
+
+class PipelineBenchmark(object):
+    def __init__(self, length, roiWidth, nWorkers):
+        """
+        Starts the producer and the fit service for one configuration.
+        """
+        self.context = zmq.Context()
+        self.collectorSocket = self.context.socket(zmq.PULL)
+        self.collectorAddress = "tcp://127.0.0.1:%i" % self.collectorSocket.bind_to_random_port("tcp://127.0.0.1")
+        self.fitFunctionCache = FitFunctionCache()
+
+        self.producerConnection, childConnection = mp.Pipe()
+        self.producer = mp.Process(target=producerWorker, args=(length,childConnection))
+        self.producer.start()
+        producerAddress = self.producerConnection.recv()
+
+        self.cpuAtStart = self._childrenCpuTime()
+        self.controller = CurveFitServiceController(producerAddress,self.collectorAddress,nWorkers=nWorkers)
+        fitFunction = makeFitFunction(length)
+        movingPeakInterval, referencePeakInterval = peakIntervals(length,roiWidth)
+        self.controller.setMovingPeakFitFunction(fitFunction)
+        self.controller.setReferencePeakFitFunction(fitFunction)
+        self.controller.setMovingPeakInterval(movingPeakInterval)
+        self.controller.setReferencePeakInterval(referencePeakInterval)
+        self.controller.startFitting()
+
+    def warmUp(self):
+        """
+        Sends single frames until the workers return results, and returns the
+        sequence number the next published frame will get.
+        """
+        while not self.collectorSocket.poll(timeout=100):
+            self.producerConnection.send("frame")
+        time.sleep(0.5)
+        sequences = [result['sequence'] for receiveTime, result in self._receiveResults()]
+        return max(sequences) + 1
+
+    def run(self, rate, duration, drainTimeout=2.0):
+        """
+        Publishes rate*duration frames and returns the send times and the
+        (receive time, fit result) pairs that came back.
+        """
+        nFrames = int(rate*duration)
+        self.producerConnection.send(("run",rate,nFrames))
+
+        results = []
+        producerDone = None
+        lastResultTime = time.time()
+        while True:
+            if self.collectorSocket.poll(timeout=50):
+                results += self._receiveResults()
+                lastResultTime = time.time()
+            if producerDone is None and self.producerConnection.poll():
+                producerDone = self.producerConnection.recv()
+            if producerDone is not None and (len(results) >= nFrames or time.time() - lastResultTime > drainTimeout):
+                break
+        sendTimes, producerCpu = producerDone
+        return sendTimes, producerCpu, results
+
+    def finish(self):
+        """
+        Stops all processes and returns the CPU time the fit service used.
+        """
+        self.producerConnection.send("stop")
+        self.controller.abort()
+        self.producer.join()
+        while mp.active_children():
+            time.sleep(0.05)
+        self.context.destroy(linger=0)
+        return self._childrenCpuTime() - self.cpuAtStart
+
+    def _receiveResults(self):
+        results = []
+        while True:
+            try:
+                frames = self.collectorSocket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return results
+            if frames[0] == RESULT_MESSAGE:
+                results.append((time.time(),unpackFitResult(frames[1],self.fitFunctionCache)))
+
+    def _childrenCpuTime(self):
+        t = os.times()
+        return t[2] + t[3]
+
+
+def benchmarkConfiguration(rate, length, roiWidth, nWorkers, duration):
+    bench = PipelineBenchmark(length,roiWidth,nWorkers)
+    try:
+        baseSequence = bench.warmUp()
+        sendTimes, producerCpu, results = bench.run(rate,duration)
+    finally:
+        serviceCpu = bench.finish()
+
+    latencies = []
+    for receiveTime, result in results:
+        index = result['sequence'] - baseSequence
+        if 0 <= index < len(sendTimes) and 'displacement_mp' in result:
+            latencies.append(receiveTime - sendTimes[index])
+    latencies = np.array(latencies)
+    nFitted = len(latencies)
+    nFrames = len(sendTimes)
+
+    record = dict(rate=rate, profileLength=length, roiWidth=roiWidth, nWorkers=nWorkers,
+                  frames=nFrames, fitted=nFitted,
+                  dropRate=1.0 - nFitted / float(nFrames))
+    if nFitted:
+        lastReceiveTime = max(receiveTime for receiveTime, result in results)
+        record.update(throughput=nFitted / (lastReceiveTime - sendTimes[0]),
+                      latencyP50=np.percentile(latencies,50),
+                      latencyP99=np.percentile(latencies,99),
+                      latencyMax=latencies.max(),
+                      cpuPerFrame=(serviceCpu - producerCpu) / nFitted)
+    return record
+
+
+def parseList(text, type=int):
+    return [type(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end fit pipeline benchmark")
+    parser.add_argument('--rates', type=parseList, default=[100,400,1000],
+                        help="Comma separated frame rates [frames/s].")
+    parser.add_argument('--lengths', type=parseList, default=[200,1000],
+                        help="Comma separated profile lengths [pixels].")
+    parser.add_argument('--roi-widths', type=parseList, default=[40,120],
+                        help="Comma separated widths of the peak intervals [pixels].")
+    parser.add_argument('--workers', type=parseList, default=[1,2],
+                        help="Comma separated numbers of worker processes.")
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help="Seconds of publishing per configuration.")
+    parser.add_argument('--output', default="pipeline_benchmark.jsonl",
+                        help="File the JSON records are appended to.")
+    args = parser.parse_args()
+
+    run = dict(time=time.strftime("%Y-%m-%dT%H:%M:%S"), host=platform.node())
+    columns = ("rate","length","roi","workers","frames/s","p50 [ms]","p99 [ms]","drops [%]","cpu/frame [ms]")
+    rows = []
+    with open(args.output,"a") as output:
+        for nWorkers in args.workers:
+            for length in args.lengths:
+                for roiWidth in args.roi_widths:
+                    if roiWidth > 0.3*length:
+                        # the intervals of the two peaks would overlap
+                        continue
+                    for rate in args.rates:
+                        record = benchmarkConfiguration(rate,length,roiWidth,nWorkers,args.duration)
+                        record.update(run)
+                        output.write(json.dumps(record) + "\n")
+                        output.flush()
+                        rows.append(record)
+
+    print "%6s %7s %5s %8s %10s %10s %10s %10s %15s" % columns
+    for record in rows:
+        print "%6i %7i %5i %8i %10.1f %10.2f %10.2f %10.2f %15.3f" % (record['rate'], record['profileLength'],
+                                                                      record['roiWidth'], record['nWorkers'],
+                                                                      record.get('throughput',0.0),
+                                                                      record.get('latencyP50',np.nan)*1e3,
+                                                                      record.get('latencyP99',np.nan)*1e3,
+                                                                      record['dropRate']*100,
+                                                                      record.get('cpuPerFrame',np.nan)*1e3)
@@ -0,0 +1,82 @@
+"""
+Measures how many fit-function evaluations RealTimeFitter needs per fit when it
+starts from the last fitted parameters, from parameters extrapolated at constant
+velocity, and from parameters predicted from the actuator voltage.
+
+The synthetic measurement is a fast actuation sweep: the moving peak follows
+the square of a sinusoidal actuator voltage, like an electrostatic actuator.
+Reported per starting point are the evaluations per moving-peak fit, the
+reseeds after diverged fits, the failed frames, the wall time per frame and
+the largest displacement error.
+
+usage: python benchmark_prediction.py [--frames 2000] [--periods 4] [--stroke 40] [--batch-size 1]
+"""
+
+import numpy as np
+import argparse
+import time
+
+from fitWorker import RealTimeFitter
+from syntheticProfiles import gauss, makeSplineFitFunction
+
+
+def makeCleanProfile(shift=0.0, length=400):
+    xValues = np.arange(length,dtype=float)
+    return (gauss(xValues,120+shift,8)+gauss(xValues,300,8))*10000 + 100
+
+def makeSweep(nFrames, periods, stroke):
+    voltages = 10 * np.abs(np.sin(np.linspace(0,periods*np.pi,nFrames)))
+    shifts = stroke * (voltages / 10)**2
+    profiles = [np.random.poisson(makeCleanProfile(shift)).astype(float) for shift in shifts]
+    return profiles, voltages, shifts
+
+def makeFitFunction():
+    return makeSplineFitFunction(makeCleanProfile())
+
+def benchmarkFitter(profiles, voltages, shifts, usePrediction, useVoltage, batchSize):
+    fitter = RealTimeFitter()
+    fitter.setMovingPeakFitFunction(makeFitFunction())
+    fitter.setReferencePeakFitFunction(makeFitFunction())
+    fitter.setMovingPeakInterval((60,230))
+    fitter.setReferencePeakInterval((270,330))
+    fitter.setUsePrediction(usePrediction)
+
+    results = []
+    t0 = time.time()
+    if batchSize > 1:
+        for start in range(0,len(profiles),batchSize):
+            batchVoltages = voltages[start:start+batchSize] if useVoltage else None
+            results += fitter.fitBatch(np.vstack(profiles[start:start+batchSize]),batchVoltages)
+    else:
+        for profile, voltage in zip(profiles,voltages):
+            results.append(fitter.fit(profile,voltage if useVoltage else None))
+    wallTime = time.time() - t0
+
+    displacements = np.array([result['displacement_mp'] if result else np.nan for result in results])
+    failed = ~np.isfinite(displacements)
+    maxError = np.abs(displacements[~failed] - shifts[~failed]).max() if (~failed).any() else np.nan
+    evaluations = fitter.evaluationCount['mp'] / float(max(fitter.fitCount,1))
+    return evaluations, fitter.reseeds, int(failed.sum()), wallTime / len(profiles), maxError
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RealTimeFitter warm-start benchmark")
+    parser.add_argument('--frames', type=int, default=2000,
+                        help="Number of synthetic profiles to fit.")
+    parser.add_argument('--periods', type=float, default=4,
+                        help="Number of actuation half periods in the sweep.")
+    parser.add_argument('--stroke', type=float, default=40,
+                        help="Peak displacement at full voltage [pixels].")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="Fit with fitBatch in batches of this size.")
+    args = parser.parse_args()
+
+    profiles, voltages, shifts = makeSweep(args.frames,args.periods,args.stroke)
+
+    print "%-14s %16s %8s %8s %14s %16s" % ("start","evaluations/fit","reseeds","failed","time/frame [ms]","max. error [px]")
+    for name, usePrediction, useVoltage in [("last fit",False,False),
+                                            ("extrapolated",True,False),
+                                            ("voltage",True,True)]:
+        evaluations, reseeds, failed, wallTime, maxError = benchmarkFitter(profiles,voltages,shifts,usePrediction,
+                                                                          useVoltage,args.batch_size)
+        print "%-14s %16.1f %8i %8i %14.3f %16.3g" % (name, evaluations, reseeds, failed, wallTime*1e3, maxError)
@@ -0,0 +1,157 @@
+"""
+Measures how long the curve-fit service takes to start.
+
+Reported are
+
+  - import:      the time a fresh interpreter takes to import the module a fit
+                 worker runs from, fitWorker, compared with curveFitService,
+                 which adds the controllers, and curveFitCollector, which also
+                 imports Qt. A worker process pays this when it is not forked
+                 from a process that has already imported it.
+  - spawn:       the imports of a fit worker started with the spawn start
+                 method, as on Windows: a fresh interpreter that imports the
+                 main script again, as __parents_main__ without running its
+                 main block, and then fitWorker. Measured for the gui entry
+                 script lvclient_gui, and for odmGui, which the gui ran from
+                 before, with Qt, pyqtgraph, scipy and odmanalysis at module
+                 level. Python 2 cannot start processes with spawn on other
+                 platforms, so these imports stand in for it.
+  - controller:  the time the CurveFitServiceController constructor takes,
+                 the time the GUI is blocked.
+  - first fit:   the time from creating the controller to receiving the first
+                 fit result, while a synthetic producer sends a frame every
+                 5 ms.
+
+The controller is started with new worker processes and with PrespawnedWorkers
+that were started --warmup seconds earlier.
+
+usage: python benchmark_startup.py [--workers 1,4] [--repeats 5] [--warmup 1]
+"""
+
+import zmq
+import numpy as np
+import multiprocessing as mp
+import subprocess
+import argparse
+import time
+import sys
+import os
+
+from curveFitService import CurveFitServiceController, PrespawnedWorkers
+from fitResultFormat import RESULT_MESSAGE
+from benchmark_pipeline import producerWorker
+from syntheticProfiles import makeFitFunction, peakIntervals
+
+PROFILE_LENGTH = 400
+ROI_WIDTH = 40
+
+
+def measureImportTime(module, repeats, script=None):
+    """
+    Returns the median time a fresh interpreter takes to import module, or
+    None if it cannot be imported. script replaces the import of module with
+    another script that prints the time it took.
+    """
+    if script is None:
+        script = "import time; t = time.time(); import %s; print time.time() - t" % module
+    times = []
+    for i in range(repeats):
+        process = subprocess.Popen([sys.executable,"-c",script],stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        output, errors = process.communicate()
+        if process.returncode != 0:
+            return None
+        times.append(float(output.split()[-1]))
+    return np.median(times)
+
+def measureSpawnImportTime(mainScript, repeats):
+    """
+    Returns the median time a fresh interpreter takes to import mainScript as
+    the main module of a spawned process and then fitWorker, or None if it
+    cannot.
+    """
+    script = ("import time, imp; t = time.time(); imp.load_source('__parents_main__',%r); "
+              "import fitWorker; print time.time() - t" % mainScript)
+    return measureImportTime(None,repeats,script)
+
+def measureStartup(producerConnection, producerAddress, nWorkers, workers, timeout=30.0):
+    """
+    Starts a controller and returns the time the constructor took and the time
+    until the first fit result arrived.
+    """
+    context = zmq.Context()
+    collectorSocket = context.socket(zmq.PULL)
+    collectorAddress = "tcp://127.0.0.1:%i" % collectorSocket.bind_to_random_port("tcp://127.0.0.1")
+    fitFunction = makeFitFunction(PROFILE_LENGTH)
+    movingPeakInterval, referencePeakInterval = peakIntervals(PROFILE_LENGTH,ROI_WIDTH)
+
+    t0 = time.time()
+    controller = CurveFitServiceController(producerAddress,collectorAddress,nWorkers=nWorkers,workers=workers)
+    controllerTime = time.time() - t0
+    controller.setMovingPeakFitFunction(fitFunction)
+    controller.setReferencePeakFitFunction(fitFunction)
+    controller.setMovingPeakInterval(movingPeakInterval)
+    controller.setReferencePeakInterval(referencePeakInterval)
+    controller.startFitting()
+
+    firstFitTime = None
+    while firstFitTime is None and time.time() - t0 < timeout:
+        producerConnection.send("frame")
+        while collectorSocket.poll(5):
+            if collectorSocket.recv_multipart()[0] == RESULT_MESSAGE:
+                firstFitTime = time.time() - t0
+                break
+
+    controller.abort()
+    time.sleep(0.5)
+    collectorSocket.close(linger=0)
+    context.term()
+    return controllerTime, firstFitTime
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Curve-fit service startup benchmark")
+    parser.add_argument('--workers', type=lambda text: [int(value) for value in text.split(",")],
+                        default=[1,4],
+                        help="Comma separated worker counts.")
+    parser.add_argument('--repeats', type=int, default=5,
+                        help="Number of measurements per configuration.")
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help="Time [s] between starting the pre-spawned workers and the controller.")
+    args = parser.parse_args()
+
+    print "%-18s %14s" % ("module","import [ms]")
+    for module in ("fitWorker","curveFitService","curveFitCollector"):
+        importTime = measureImportTime(module,args.repeats)
+        print "%-18s %14s" % (module, "%.1f" % (importTime*1e3) if importTime is not None else "not available")
+
+    print
+    print "%-18s %14s" % ("spawn main script","import [ms]")
+    for mainScript in ("lvclient_gui.py","odmGui.py"):
+        importTime = measureSpawnImportTime(mainScript,args.repeats)
+        print "%-18s %14s" % (mainScript, "%.1f" % (importTime*1e3) if importTime is not None else "not available")
+
+    producerConnection, childConnection = mp.Pipe()
+    producer = mp.Process(target=producerWorker,args=(PROFILE_LENGTH,childConnection))
+    producer.start()
+    producerAddress = producerConnection.recv()
+
+    print
+    print "%-14s %8s %16s %16s" % ("processes","workers","controller [ms]","first fit [ms]")
+    for nWorkers in args.workers:
+        for name in ("new","pre-spawned"):
+            controllerTimes = []
+            firstFitTimes = []
+            for i in range(args.repeats):
+                workers = None
+                if name == "pre-spawned":
+                    workers = PrespawnedWorkers(nWorkers + 1 if nWorkers > 1 else 1)
+                    time.sleep(args.warmup)
+                controllerTime, firstFitTime = measureStartup(producerConnection,producerAddress,nWorkers,workers)
+                controllerTimes.append(controllerTime)
+                firstFitTimes.append(firstFitTime if firstFitTime is not None else np.nan)
+            print "%-14s %8i %16.1f %16.1f" % (name, nWorkers, np.median(controllerTimes)*1e3,
+                                               np.median(firstFitTimes)*1e3)
+
+    producerConnection.send("stop")
+    producer.join()
@@ -0,0 +1,68 @@
+import numpy as np
+
+
+class CrossCorrelationEstimator(object):
+    def __init__(self,fitFunction,interval,maxShift=None):
+        """
+        Non-iterative alternative to fitting a ScaledSpline: estimates the shift
+        of the peak in the interval by cross-correlating the interval window
+        with the template profile the fit function was made from.
+
+        The template is the unshifted fit function sampled on the interval,
+        extended by maxShift pixels on both sides (default: half the interval
+        width), so that every shift compares the full window. Its spectrum and
+        the normalization of every shifted template window are computed once.
+        An estimate then costs one real FFT, one inverse FFT and a parabolic
+        interpolation of the correlation peak for the subpixel part of the shift.
+        """
+        self.fitFunction = fitFunction
+        self.xmin = int(min(interval))
+        self.xmax = int(max(interval))
+
+        width = self.xmax - self.xmin
+        self.maxShift = int(maxShift) if maxShift is not None else width // 2
+
+        xTemplate = np.arange(self.xmin-self.maxShift,self.xmax+self.maxShift,dtype=np.float64)
+        template = np.asarray(fitFunction(xTemplate,0.0,1.0,0.0),dtype=np.float64)
+        self._nfft = 1 << int(np.ceil(np.log2(len(template))))
+        self._templateSpectrum = np.fft.rfft(template,self._nfft)
+
+        # norm of the mean-subtracted template window for every shift
+        nShifts = 2*self.maxShift + 1
+        cumulativeSum = np.concatenate(([0.0],np.cumsum(template)))
+        cumulativeSquares = np.concatenate(([0.0],np.cumsum(template**2)))
+        windowSums = cumulativeSum[width:width+nShifts] - cumulativeSum[:nShifts]
+        windowSquares = cumulativeSquares[width:width+nShifts] - cumulativeSquares[:nShifts]
+        self._templateNorms = np.sqrt(np.maximum(windowSquares - windowSums**2/width,1e-300))
+
+    def estimate(self,intensityProfile):
+        """
+        Returns the estimated parameters [shift, scale, offset] for the interval
+        of intensityProfile, in the parameter order of the fit function.
+        """
+        xdata = np.arange(len(intensityProfile),dtype=np.float64)[self.xmin:self.xmax]
+        ydata = np.asarray(intensityProfile[self.xmin:self.xmax],dtype=np.float64)
+
+        spectrum = np.fft.rfft(ydata - ydata.mean(),self._nfft)
+        # element m correlates the window with the template shifted by maxShift - m
+        correlation = np.fft.irfft(np.conj(spectrum) * self._templateSpectrum,self._nfft)
+        correlation = correlation[:2*self.maxShift+1] / self._templateNorms
+
+        m = np.argmax(correlation)
+        shift = self.maxShift - (m + self._subpixelOffset(correlation,m))
+
+        # with the shift known, scale and offset follow from a linear least-squares fit
+        shiftedTemplate = np.asarray(self.fitFunction(xdata,shift,1.0,0.0),dtype=np.float64)
+        A = np.vstack((shiftedTemplate,np.ones_like(shiftedTemplate))).T
+        (scale, offset), residuals, rank, sv = np.linalg.lstsq(A,ydata,rcond=-1)
+        return np.array([shift,scale,offset])
+
+    def _subpixelOffset(self,correlation,m):
+        # the shifts at the ends of the searched range have only one neighbour
+        if m == 0 or m == len(correlation)-1:
+            return 0.0
+        left, center, right = correlation[m-1], correlation[m], correlation[m+1]
+        denominator = left - 2*center + right
+        if denominator == 0:
+            return 0.0
+        return 0.5 * (left - right) / denominator
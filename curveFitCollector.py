@@ -0,0 +1,259 @@
+"""
+The receiving end of the curve-fit service: CurveFitServiceCollector, a Qt
+thread that puts the fit results of the workers back in order and hands them
+to the gui with signals. It is the only part of the service that needs Qt;
+the controllers and PrespawnedWorkers in curveFitService import without it.
+"""
+
+import zmq
+import time
+from PyQt4 import QtCore
+
+from fitResultFormat import RESULT_MESSAGE, FIT_FUNCTION_MESSAGE, unpackFitResult, packResultBatch, FitFunctionCache
+from latencyStats import LatencyStats, SequenceGapDetector
+
+
+class ResultReorderBuffer(object):
+    def __init__(self, window=32, maxDelay=0.1):
+        """
+        Puts fit results that arrive out of order from a pool of workers back in
+        sequence order. A missing sequence number is given up on when more than
+        window later results are waiting, or when the oldest waiting result is
+        older than maxDelay seconds.
+        """
+        self.window = window
+        self.maxDelay = maxDelay
+        self.reset()
+    
+    def reset(self):
+        self._pending = dict()
+        self._expected = None
+        self._blockedSince = None
+    
+    def push(self,result):
+        """
+        Adds a result and returns the list of results that are ready to be emitted.
+        """
+        sequence = result.get('sequence') if result is not None else None
+        if sequence is None:
+            return [result]
+        
+        skippedSequences = result.get('skippedSequences',[])
+        if self._expected is None:
+            self._expected = min([sequence] + skippedSequences)
+        elif sequence < self._expected:
+            # arrived after it was given up on
+            return []
+        
+        # frames that a worker skipped will never produce a result, keep a
+        # placeholder so they do not hold up the results behind them
+        for skipped in skippedSequences:
+            if skipped >= self._expected:
+                self._pending[skipped] = None
+        self._pending[sequence] = result
+        ready = self._popReady()
+        if len(self._pending) > self.window:
+            ready += self._skipGap()
+        return ready
+    
+    def flush(self):
+        """
+        Returns all waiting results in sequence order, gaps or not, and starts
+        over with the next result pushed.
+        """
+        ready = [self._pending[sequence] for sequence in sorted(self._pending)
+                 if self._pending[sequence] is not None]
+        self.reset()
+        return ready
+    
+    def popExpired(self):
+        """
+        Returns the waiting results if the gap in front of them has been open for
+        longer than maxDelay.
+        """
+        if self._pending and time.time() - self._blockedSince > self.maxDelay:
+            return self._skipGap()
+        return []
+    
+    def _skipGap(self):
+        self._expected = min(self._pending)
+        return self._popReady()
+    
+    def _popReady(self):
+        ready = []
+        while self._expected in self._pending:
+            result = self._pending.pop(self._expected)
+            if result is not None:
+                ready.append(result)
+            self._expected += 1
+        if not self._pending:
+            self._blockedSince = None
+        elif ready or self._blockedSince is None:
+            self._blockedSince = time.time()
+        return ready
+
+
+class CurveFitServiceCollector(QtCore.QThread):
+    resultReceived = QtCore.Signal(dict)
+    resultsReceived = QtCore.Signal(dict)
+    def __init__(self,address = None, reorderWindow=32, maxReorderDelay=0.1, publish=False, batch=False, maxBatch=256):
+        """
+        Receives the fit results of the workers and emits them in sequence order.
+        With publish=True the messages are also re-published, unordered and as
+        received, on publishAddress for recorders and other listeners.
+        
+        The collector keeps the stage latencies and sequence gaps of the
+        results, see getStats. When fitting is started again, call restart, so
+        that the frames that came in while the workers were idle are not
+        waited for.
+        
+        The results of a CurveFitSupervisor come from several streams; they
+        are put in order and checked for gaps per stream.
+        
+        With batch=True the collector takes all the messages that are waiting
+        (at most maxBatch) each time it wakes up and emits the results that are
+        ready as one batch of arrays on resultsReceived (see packResultBatch)
+        instead of one resultReceived signal per result, so that a high fit rate
+        does not flood the gui thread with signals.
+        """
+        QtCore.QThread.__init__(self)        
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.PULL)
+                
+        if (address is None):
+            port = self._socket.bind_to_random_port("tcp://127.0.0.1")
+            address = "tcp://127.0.0.1:%i" % port
+        else:
+            self._socket.bind(address)
+        self._address = address
+        self._reorderWindow = reorderWindow
+        self._maxReorderDelay = maxReorderDelay
+        self._batch = batch
+        self._maxBatch = maxBatch
+        self._reorderBuffers = dict()
+        self._fitFunctionCache = FitFunctionCache()
+        self._aborted = False        
+        
+        self._latencyStats = LatencyStats()
+        self._gapDetectors = dict()
+        self._restartEpochs = dict()
+        
+        self._publishSocket = None
+        self._publishAddress = None
+        if publish:
+            self._publishSocket = self._context.socket(zmq.PUB)
+            port = self._publishSocket.bind_to_random_port("tcp://127.0.0.1")
+            self._publishAddress = "tcp://127.0.0.1:%i" % port
+        
+    def run(self):
+        while self._aborted == False:
+            if self._batch:
+                ready = self._receiveBatch()
+            elif self._socket.poll(timeout=10):
+                ready = self._receiveResults()
+            else:
+                ready = self._popExpired()
+            for result in ready:
+                self._gapDetectors[result['stream']].push(result)
+                if not self._batch:
+                    self.resultReceived.emit(result)
+            if self._batch and ready:
+                self.resultsReceived.emit(packResultBatch(ready))
+                
+        #abort logic
+        self._socket.close()
+        if self._publishSocket is not None:
+            self._publishSocket.close(linger=0)
+        self._context.destroy()
+                
+    def _popExpired(self):
+        return [result for reorderBuffer in self._reorderBuffers.values()
+                for result in reorderBuffer.popExpired()]
+    
+    def _receiveBatch(self):
+        """
+        Waits up to 10 ms for a message, then receives all the messages that
+        are waiting. Returns the results that are ready, expired ones included.
+        """
+        ready = []
+        if self._socket.poll(timeout=10):
+            for i in range(self._maxBatch):
+                try:
+                    ready.extend(self._receiveResults(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+        return ready + self._popExpired()
+    
+    def _receiveResults(self,flags=0):
+        frames = self._socket.recv_multipart(flags)
+        if self._publishSocket is not None:
+            self._publishSocket.send_multipart(frames)
+        if frames[0] == FIT_FUNCTION_MESSAGE:
+            self._fitFunctionCache.add(*frames[1:])
+            return []
+        elif frames[0] == RESULT_MESSAGE:
+            result = unpackFitResult(frames[1],self._fitFunctionCache)
+            result['collectTime'] = time.time()
+            self._latencyStats.record(result)
+            stream = result['stream']
+            if stream not in self._reorderBuffers:
+                self._reorderBuffers[stream] = ResultReorderBuffer(self._reorderWindow,self._maxReorderDelay)
+                self._gapDetectors[stream] = SequenceGapDetector()
+            ready = []
+            restartEpoch = self._restartEpochs.get(stream)
+            if restartEpoch is not None and result['epoch'] >= restartEpoch:
+                # the first result since the restart, the sequence order starts
+                # over after the results of before the stop
+                del self._restartEpochs[stream]
+                ready = self._reorderBuffers[stream].flush()
+                self._gapDetectors[stream].restartAt(result['sequence'])
+            self._gapDetectors[stream].addSkipped(result['skippedSequences'])
+            return ready + self._reorderBuffers[stream].push(result)
+        else:
+            return []
+    
+    def restart(self,epoch,stream=0):
+        """
+        Tells the collector that fitting of stream was started again with the
+        epoch CurveFitServiceController.startFitting returned. The frames that
+        came in while the workers were idle have sequence numbers without
+        results; instead of waiting for them and counting them as lost, the
+        sequence order starts over with the first result of the epoch. Can be
+        called from another thread.
+        """
+        self._restartEpochs[stream] = epoch
+    
+    def recordPaint(self,result):
+        """
+        Records that result has been drawn, for the gui and total latencies.
+        Call this from the slot connected to resultReceived, or with the
+        'last' result of a batch from the slot connected to resultsReceived.
+        """
+        result['paintTime'] = time.time()
+        self._latencyStats.record(result,("gui","total"))
+    
+    def getStats(self):
+        """
+        Returns the stage latencies (see latencyStats) and the sequence gaps.
+        'sequence' has the gaps of the first stream, the only one unless the
+        results come from a CurveFitSupervisor, 'streams' those of every
+        stream by id. The worker counters are returned by
+        CurveFitServiceController.getStats.
+        """
+        streams = dict((stream,gapDetector.getStats()) for stream,gapDetector in self._gapDetectors.items())
+        return dict(latency=self._latencyStats.getStats(),
+                    sequence=streams[min(streams)] if streams else SequenceGapDetector().getStats(),
+                    streams=streams)
+    
+    def abort(self):
+        self._aborted = True
+
+    
+        
+    @property
+    def address(self):
+        return self._address
+    
+    @property
+    def publishAddress(self):
+        return self._publishAddress
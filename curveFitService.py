@@ -1,274 +1,516 @@
 import zmq
-import msgpack as msg
-import numpy as np
-import msgpack_numpy
-msgpack_numpy.patch()
-import scipy as cp
-from scipy.optimize import curve_fit
 import time
 import multiprocessing as mp
-import sys
-import pickle
-from PyQt4 import QtCore, QtGui
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
-class RealTimeFitter(object):
-    def __init__(self):
-        
-        self._refFitFunction = None
-        self._mpFitFunction = None
-        self._xminRef = None
-        self._xmaxRef = None
-        self._xminMp = None
-        self._xmaxMp = None
-        self._refEstimates = [0.0,1.0,0.0]
-        self._mpEstimates = [0.0,1.0,0.0]
-        
-    @property        
-    def canFit(self):
-        return self._mpFitFunction is not None and self._xminRef is not None and self._xmaxRef is not None and self._xminMp is not None and self._xmaxMp is not None
-    
-    def fit(self,intensityProfile):
-        if self.canFit:
-            try:
-                displacement_mp, popt_mp = self._getMovingPeakDisplacement(intensityProfile)
-                displacement_ref, popt_ref = self._getReferencePeakDisplacement(intensityProfile)
-                return dict(displacement_mp=displacement_mp,
-                            displacement_ref=displacement_ref,
-                            popt_mp=popt_mp,
-                            popt_ref=popt_ref,
-                            fitFunction_mp=self._mpFitFunction,
-                            fitFunction_ref=self._refFitFunction)
-            except Exception as e:
-                print e
-        else:
-            return dict()
-    
-    def _getMovingPeakDisplacement(self,intensityProfile):
-        xdata = np.arange(len(intensityProfile))[self._xminMp:self._xmaxMp]
-        ydata = intensityProfile[self._xminMp:self._xmaxMp]
-        
-        popt,pcov = curve_fit(self._mpFitFunction,xdata,ydata,p0=self._mpEstimates)
-        self._mpEstimates = popt
-        return self._mpFitFunction.getDisplacement(*popt), popt
-        
-    def _getReferencePeakDisplacement(self,intensityProfile):
-        xdata = np.arange(len(intensityProfile))[self._xminRef:self._xmaxRef]
-        ydata = intensityProfile[self._xminRef:self._xmaxRef]
-        
-        popt,pcov = curve_fit(self._refFitFunction,xdata,ydata,p0=self._refEstimates)
-        self._refEstimates = popt
-        return self._refFitFunction.getDisplacement(*popt), popt
-    
-    
-    
-    def setReferencePeakFitFunction(self,fitFunction):
-        print "ref. fitfunction: %s" % fitFunction
-        self._refFitFunction = fitFunction
-        
-    def setReferencePeakInterval(self,interval):
-        print interval
-        self._xmaxRef = int(max(interval))
-        self._xminRef = int(min(interval))
+# the worker side lives in fitWorker, which the worker processes import without Qt
+from fitWorker import (RealTimeFitter, FrameDistributor, FittingConsumer, FittingConsumerGroup,
+                       FRAME_POLICIES, UNVERSIONED_METHODS, fitConsumeWorker, frameDistributeWorker,
+                       fitConsumeGroupWorker, prespawnedWorker)
+from peakFitter import PEAK_ESTIMATORS
 
-    def setMovingPeakInterval(self,interval):
-        print interval
-        self._xmaxMp = int(max(interval))
-        self._xminMp = int(min(interval))
 
-        
-    def setMovingPeakFitFunction(self,fitFunction):
-        "mp. fitfunction: %s" % fitFunction
-        self._mpFitFunction = fitFunction
-        
-        
-    def reset(self):
+class PrespawnedWorkers(object):
+    def __init__(self,n):
         """
-        Resets the stored curve-fit estimates to the default values.
+        Starts n worker processes ahead of time. They import the fitting code
+        and wait until a CurveFitServiceController or CurveFitSupervisor hands
+        them the worker to run, so that the controller does not wait for new
+        processes to start. The processes that are not used exit on close.
         """
-        self._refEstimates = [0.0,1.0,0.0]
-        self._mpEstimates = [0.0,1.0,0.0]
+        self._connections = deque()
+        for i in range(n):
+            parentConnection, childConnection = mp.Pipe()
+            mp.Process(target=prespawnedWorker,args=(childConnection,)).start()
+            self._connections.append(parentConnection)
     
-
-class FittingConsumer():
-    def __init__(self,producerAddress, collectorAddress, controlAddress)    :
+    def __len__(self):
+        return len(self._connections)
+    
+    def start(self,target,args,connect=False):
         """
-        Reads lvdata from producerAdress, uses it to do a curve fit, and sends the
-        results to collectorAddress. The consumer can be controlled from controlAddress
+        Runs target(*args) in a pre-spawned process, or in a new process when
+        none is left. With connect, target gets a connection as its last
+        argument and the other end is returned.
         """
-        self.context = zmq.Context()    
+        if self._connections:
+            connection = self._connections.popleft()
+            connection.send((target,tuple(args),connect))
+            if connect:
+                return connection
+            connection.close()
+        elif connect:
+            parentConnection, childConnection = mp.Pipe()
+            mp.Process(target=target,args=tuple(args) + (childConnection,)).start()
+            return parentConnection
+        else:
+            mp.Process(target=target,args=tuple(args)).start()
     
-        self.control_socket = self.context.socket(zmq.PULL)
-        self.control_socket.connect(controlAddress)
-        
-        self.producer_socket = self.context.socket(zmq.SUB)
-        self.producer_socket.connect(producerAddress)
-        self.producer_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+    def close(self):
+        while self._connections:
+            connection = self._connections.popleft()
+            connection.send(None)
+            connection.close()
+
+
+class CurveFitServiceController(object):
+    def __init__(self, producerAddress, collectorAddress, controlAddress=None, nWorkers=1, ringPath=None, workers=None):
+        """
+        Starts the fitting worker process(es) and sends control messages to them.
         
-        self.collector_socket = self.context.socket(zmq.PUSH)
-        self.collector_socket.connect(collectorAddress)
+        With nWorkers > 1 the service runs in pool mode: a FrameDistributor process
+        numbers the lvdata messages and fans them out to nWorkers FittingConsumers,
+        each with its own control socket so that every RPC reaches all workers.
         
-        self.poller = zmq.Poller()
-        self.poller.register(self.producer_socket,zmq.POLLIN)
-        self.poller.register(self.control_socket,zmq.POLLIN)
+        With ringPath, producerAddress is the notification address of a
+        ProfileIngestService and the workers read the profiles from its ring buffer.
         
+        workers is a PrespawnedWorkers to take the processes from.
         
-        self.fitter = RealTimeFitter()    
+        Every configuration change is numbered with a config epoch, which the
+        setters return. The workers apply the changes between two frames, reply
+        with the epoch (see pollReplies and waitForEpoch) and tag the fit
+        results with the epoch they were fitted under, so that results from
+        before a change can be told apart. Changes made in a configuration()
+        block are applied together under one epoch.
+        """
+        if nWorkers < 1:
+            raise ValueError("nWorkers must be at least 1")
+        if nWorkers > 1 and controlAddress is not None:
+            raise ValueError("a fixed controlAddress can only be used with a single worker")
         
-        self.state = "idle"
+        if workers is None:
+            # no processes to take, start new ones
+            workers = PrespawnedWorkers(0)
         
+        self._context = zmq.Context()
+        self._nWorkers = nWorkers
+        self._fitFunctionVersion = 0
         
-    def run(self):
-        print "running"
-        while self.state is not "aborted":
-                       
-            sockets = dict(self.poller.poll(timeout=0))
-            
-            if self.control_socket in sockets and sockets[self.control_socket] == zmq.POLLIN:
-                
-                rpc = self.control_socket.recv_pyobj()
-                self._handleRPC(rpc)
-                
-            if self.producer_socket in sockets and sockets[self.producer_socket] == zmq.POLLIN:
-                # handle message from producer          
-                message = self.producer_socket.recv()
-                lvdata = msg.unpackb(message)
-                self._handleProducerData(lvdata)
-            if not sockets:
-                time.sleep(1e-3)
-        
-        #abort logic
-        self.producer_socket.close()
-        self.collector_socket.close()
-        self.control_socket.close()
-        self.context.destroy()
-        print "aborted"
-            
-    def _handleRPC(self,rpc):
-        if rpc['method'] == 'stopFitting':
-            self.state = "idle"
-            
-        elif rpc['method'] == 'startFitting':
-            if self.fitter.canFit:
-                self.state = "fitting"
-
-        elif rpc['method'] == 'setMovingPeakFitFunction':
-            self.fitter.setMovingPeakFitFunction(**rpc['params'])
-
-        elif rpc['method'] == 'setReferencePeakFitFunction':
-            self.fitter.setReferencePeakFitFunction(**rpc['params'])
-
-        elif rpc['method'] == 'setMovingPeakInterval':
-            self.fitter.setMovingPeakInterval(**rpc['params'])
-
-        elif rpc['method'] == 'setReferencePeakInterval':
-            self.fitter.setReferencePeakInterval(**rpc['params'])
-
-        elif rpc['method'] == 'abort':
-            self.state = "aborted"
-        elif rpc['method'] == 'printState':
-            print self.state
+        if nWorkers == 1:
+            self._socket, controlAddress = self._createControlSocket(controlAddress)
+            workers.start(fitConsumeWorker,(producerAddress,collectorAddress,controlAddress,False,ringPath))
+            self._workerSockets = [self._socket]
+            self._distributorSocket = None
+        else:
+            self._distributorSocket, distributorControlAddress = self._createControlSocket()
+            connection = workers.start(frameDistributeWorker,(producerAddress,distributorControlAddress),connect=True)
+            distributorAddress = connection.recv()
+            connection.close()
             
-
-    def _handleProducerData(self,lvdata):
-        if self.state == "fitting" and self.fitter.canFit:
-            try:        
-                fitResult = self.fitter.fit(lvdata['Intensity Profile'])
-                self.collector_socket.send_pyobj(fitResult)
-            except:
-                pass
-
-def fitConsumeWorker(producerAddress, collectorAddress, controlAddress):
-    fittingConsumer = FittingConsumer(producerAddress, collectorAddress, controlAddress)
-    fittingConsumer.run()
-
-
-class CurveFitServiceController(object):
-    def __init__(self, producerAddress, collectorAddress, controlAddress=None):
-        self._context = zmq.Context()
-        self._socket = self._context.socket(zmq.PUSH)
+            self._workerSockets = []
+            for i in range(nWorkers):
+                socket, workerControlAddress = self._createControlSocket()
+                workers.start(fitConsumeWorker,(distributorAddress,collectorAddress,workerControlAddress,True,ringPath))
+                self._workerSockets.append(socket)
+        self._initializeEpochs()
+    
+    def _initializeEpochs(self):
+        self._epoch = 0
+        self._appliedEpochs = [0] * len(self._workerSockets)
+        self._pendingRPCs = None
+        self._replies = []
+        self._statsRequest = 0
+        self._replyPoller = zmq.Poller()
+        for socket in self._workerSockets:
+            self._replyPoller.register(socket,zmq.POLLIN)
+    
+    def _createControlSocket(self,controlAddress=None):
+        socket = self._context.socket(zmq.DEALER)
         if controlAddress == None:
-            port = self._socket.bind_to_random_port("tcp://127.0.0.1")
+            port = socket.bind_to_random_port("tcp://127.0.0.1")
             controlAddress = "tcp://localhost:%i" % port
             print controlAddress
         else:
-            self._socket.bind(controlAddress)
+            socket.bind(controlAddress)
         
-        self._socket.setsockopt(zmq.LINGER, 100)
-        mp.Process(target=fitConsumeWorker,args=(producerAddress,collectorAddress,controlAddress)).start()
+        socket.setsockopt(zmq.LINGER, 100)
+        return socket, controlAddress
+    
+    def _broadcast(self,rpc):
+        """
+        Sends rpc to all workers. A configuration change gets the next epoch,
+        which is returned, or is kept for the end of a configuration() block.
+        """
+        if rpc['method'] not in UNVERSIONED_METHODS:
+            if self._pendingRPCs is not None:
+                self._pendingRPCs.append(rpc)
+                return None
+            self._epoch += 1
+            rpc['epoch'] = self._epoch
+        for socket in self._workerSockets:
+            socket.send_pyobj(rpc)
+        return rpc.get('epoch')
+    
+    @contextmanager
+    def configuration(self):
+        """
+        Collects the configuration changes made in the with block and sends
+        them as one RPC, so that the workers apply them together under one
+        epoch and no frame is fitted with half of them, e.g.
+        
+            with controller.configuration():
+                controller.setMovingPeakFitFunction(fitFunction)
+                controller.setMovingPeakInterval(interval)
+            controller.waitForEpoch(controller.epoch)
+        
+        Nothing is sent when the block raises.
+        """
+        self._pendingRPCs = []
+        try:
+            yield
+        except:
+            self._pendingRPCs = None
+            raise
+        rpcs, self._pendingRPCs = self._pendingRPCs, None
+        if rpcs:
+            self._broadcast(dict(method="configure",params=dict(rpcs=rpcs)))
     
+    @property
+    def epoch(self):
+        """
+        The epoch of the last configuration change sent.
+        """
+        return self._epoch
+    
+    @property
+    def appliedEpoch(self):
+        """
+        The last epoch all workers have applied, as far as their replies have
+        been read.
+        """
+        return min(self._appliedEpochs)
+    
+    def pollReplies(self,timeout=0):
+        """
+        Reads the replies of the workers to the configuration changes, waiting
+        at most timeout milliseconds for the first one. Returns the replies,
+        dicts with the epoch, the method, the worker's pid and stream, and the
+        error, None when the change was applied.
+        """
+        self._readReplies(0 if self._replies else timeout)
+        replies, self._replies = self._replies, []
+        return replies
+    
+    def _readReplies(self,timeout):
+        """
+        Reads the replies waiting on the control sockets, waiting at most
+        timeout milliseconds for the first one. The replies to configuration
+        changes are kept for pollReplies, the (worker index, reply) pairs of
+        the replies to getStats are returned.
+        """
+        statsReplies = []
+        while True:
+            sockets = dict(self._replyPoller.poll(timeout))
+            if not sockets:
+                return statsReplies
+            for i, socket in enumerate(self._workerSockets):
+                if socket in sockets:
+                    reply = socket.recv_pyobj()
+                    if reply['method'] == 'getStats':
+                        statsReplies.append((i,reply))
+                    else:
+                        if reply['error'] is None:
+                            # a worker stays in its epoch when a change fails
+                            self._appliedEpochs[i] = max(self._appliedEpochs[i],reply['epoch'])
+                        self._replies.append(reply)
+            timeout = 0
+    
+    def waitForEpoch(self,epoch=None,timeout=1000):
+        """
+        Waits at most timeout milliseconds until all workers have applied
+        epoch, by default the last one sent, and returns whether they have.
+        Raises RuntimeError when a worker replies that the change of this epoch
+        failed.
+        """
+        if epoch is None:
+            epoch = self._epoch
+        deadline = time.time() + timeout / 1000.0
+        while self.appliedEpoch < epoch:
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0:
+                return False
+            errors = [reply for reply in self.pollReplies(remaining)
+                      if reply['epoch'] == epoch and reply['error'] is not None]
+            if errors:
+                raise RuntimeError("; ".join("%(method)s (epoch %(epoch)i): %(error)s" % reply for reply in errors))
+        return True
+    
+    @property
+    def nWorkers(self):
+        return self._nWorkers
+    
+    def _nextFitFunctionVersion(self):
+        self._fitFunctionVersion += 1
+        return self._fitFunctionVersion
     
     def setReferencePeakFitFunction(self,fitFunction):
         rpc = dict(method="setReferencePeakFitFunction",
-                   params=dict(fitFunction=fitFunction))
-        self._socket.send_pyobj(rpc)
+                   params=dict(fitFunction=fitFunction,
+                               version=self._nextFitFunctionVersion()))
+        return self._broadcast(rpc)
         
     def setMovingPeakFitFunction(self,fitFunction):
         rpc = dict(method="setMovingPeakFitFunction",
-                   params=dict(fitFunction=fitFunction))
-        self._socket.send_pyobj(rpc)
+                   params=dict(fitFunction=fitFunction,
+                               version=self._nextFitFunctionVersion()))
+        return self._broadcast(rpc)
         
     def setReferencePeakInterval(self,interval):
         rpc = dict(method="setReferencePeakInterval",
                    params=dict(interval=interval))
-        self._socket.send_pyobj(rpc)
+        return self._broadcast(rpc)
 
     def setMovingPeakInterval(self,interval):
         rpc = dict(method="setMovingPeakInterval",
                    params=dict(interval=interval))
-        self._socket.send_pyobj(rpc)
+        return self._broadcast(rpc)
+        
+    def addPeak(self,name):
+        """
+        Adds a named peak to the peaks the workers fit, besides "mp" and "ref".
+        It is fitted once it has a fit function and an interval.
+        """
+        rpc = dict(method="addPeak",
+                   params=dict(name=name))
+        return self._broadcast(rpc)
+        
+    def removePeak(self,name):
+        rpc = dict(method="removePeak",
+                   params=dict(name=name))
+        return self._broadcast(rpc)
+        
+    def setPeakFitFunction(self,name,fitFunction):
+        rpc = dict(method="setPeakFitFunction",
+                   params=dict(name=name,fitFunction=fitFunction,
+                               version=self._nextFitFunctionVersion()))
+        return self._broadcast(rpc)
+        
+    def setPeakInterval(self,name,interval):
+        rpc = dict(method="setPeakInterval",
+                   params=dict(name=name,interval=interval))
+        return self._broadcast(rpc)
+        
+    def setPeakTracking(self,name,width):
+        """
+        Fits the named peak over a window of width pixels that follows the
+        peak, instead of over its whole interval. None turns tracking off.
+        """
+        rpc = dict(method="setPeakTracking",
+                   params=dict(name=name,width=width))
+        return self._broadcast(rpc)
+        
+    def setThreads(self,threads):
+        """
+        Makes every worker fit the peaks of a frame concurrently on this many
+        threads.
+        """
+        rpc = dict(method="setThreads",
+                   params=dict(threads=threads))
+        return self._broadcast(rpc)
+        
+    def setFramePolicy(self,policy,n=1):
+        """
+        policy is one of "every", "latest" or "nth". With "nth", every n-th
+        message is fitted by each worker.
+        """
+        if policy not in FRAME_POLICIES:
+            raise ValueError("frame policy must be one of %s" % (FRAME_POLICIES,))
+        rpc = dict(method="setFramePolicy",
+                   params=dict(policy=policy,n=n))
+        return self._broadcast(rpc)
+        
+    def setBatchSize(self,batchSize):
+        rpc = dict(method="setBatchSize",
+                   params=dict(batchSize=batchSize))
+        return self._broadcast(rpc)
+        
+    def setUseAnalyticJacobian(self,enabled):
+        rpc = dict(method="setUseAnalyticJacobian",
+                   params=dict(enabled=enabled))
+        return self._broadcast(rpc)
+        
+    def setUsePrediction(self,enabled):
+        rpc = dict(method="setUsePrediction",
+                   params=dict(enabled=enabled))
+        return self._broadcast(rpc)
+        
+    def reset(self):
+        """
+        Makes the workers start their next fits from the default parameters.
+        """
+        rpc = dict(method="reset")
+        return self._broadcast(rpc)
+        
+    def setSigma(self,sigma):
+        """
+        Sets the per-pixel standard deviation that weights the spline fits, or
+        None for unweighted fits.
+        """
+        rpc = dict(method="setSigma",
+                   params=dict(sigma=sigma))
+        return self._broadcast(rpc)
+        
+    def setPeakEstimator(self,peak,estimator):
+        """
+        peak is the name of a peak, or "movingPeak" or "referencePeak",
+        estimator is "spline" or "xcorr".
+        """
+        if estimator not in PEAK_ESTIMATORS:
+            raise ValueError("estimator must be one of %s" % (PEAK_ESTIMATORS,))
+        rpc = dict(method="setPeakEstimator",
+                   params=dict(peak=peak,estimator=estimator))
+        return self._broadcast(rpc)
+        
+    def setMovingPeakTracking(self,width):
+        """
+        Fits the moving peak over a window of width pixels that follows the
+        peak, instead of over the whole moving-peak interval. None turns
+        tracking off.
+        """
+        rpc = dict(method="setMovingPeakTracking",
+                   params=dict(width=width))
+        return self._broadcast(rpc)
         
     def abort(self):
         rpc = dict(method="abort")
-        self._socket.send_pyobj(rpc)
+        self._broadcast(rpc)
+        if self._distributorSocket is not None:
+            self._distributorSocket.send_pyobj(rpc)
         
     def stopFitting(self):
         rpc = dict(method="stopFitting")
-        self._socket.send_pyobj(rpc)
+        return self._broadcast(rpc)
     
     def startFitting(self):
+        """
+        Starts fitting and returns the epoch of the start, to pass to
+        CurveFitServiceCollector.restart.
+        """
         rpc = dict(method="startFitting")
-        self._socket.send_pyobj(rpc)
+        return self._broadcast(rpc)
         
     def printState(self):
         rpc = dict(method="printState")
-        self._socket.send_pyobj(rpc)
-        
+        self._broadcast(rpc)
+    
+    def getStats(self,timeout=1000):
+        """
+        Asks the workers for their frame counters and waits at most timeout
+        milliseconds for the replies. Returns the counters of the workers that
+        replied (see FittingConsumer.getStats), sorted by pid. The stage
+        latencies and sequence gaps are kept by the collector, see
+        CurveFitServiceCollector.getStats.
+        """
+        # replies to an earlier request that timed out are not counted
+        self._statsRequest += 1
+        rpc = dict(method="getStats",request=self._statsRequest)
+        self._broadcast(rpc)
+        stats = dict()
+        deadline = time.time() + timeout / 1000.0
+        while len(stats) < len(self._workerSockets):
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0:
+                break
+            for i, reply in self._readReplies(remaining):
+                if reply['request'] == self._statsRequest:
+                    stats[i] = reply['stats']
+        return sorted(stats.values(),key=lambda workerStats: (workerStats['pid'],workerStats['stream']))
+
+
+class StreamController(CurveFitServiceController):
+    def __init__(self,context,stream):
+        """
+        Sends the control messages of one stream of a CurveFitSupervisor, with
+        the methods of CurveFitServiceController. The stream's FittingConsumer
+        runs in one of the supervisor's worker processes.
+        """
+        self._context = context
+        self._nWorkers = 1
+        self._fitFunctionVersion = 0
+        self.stream = stream
+        self._socket, self.controlAddress = self._createControlSocket()
+        self._workerSockets = [self._socket]
+        self._distributorSocket = None
+        self._initializeEpochs()
 
-class CurveFitServiceCollector(QtCore.QThread):
-    resultReceived = QtCore.Signal(dict)
-    def __init__(self,address = None):
-        QtCore.QThread.__init__(self)        
+
+class CurveFitSupervisor(object):
+    def __init__(self, producerAddresses, collectorAddress, nWorkers=None, workers=None):
+        """
+        Fits the lvdata of several producers, e.g. several ODM setups, in one
+        service. producerAddresses is a list of producer addresses, the stream
+        ids are their indices, or a dict of stream id to address. Stream ids
+        are ints from 0 to 65535, they are sent as a uint16 with the results.
+        
+        Every stream has its own fitter state and is controlled separately
+        through stream(id), a StreamController. The streams are spread evenly
+        over nWorkers processes, by default one per core, and all results go to
+        collectorAddress, tagged with their stream id (see
+        CurveFitServiceCollector). workers is a PrespawnedWorkers to take the
+        processes from.
+        """
+        if not isinstance(producerAddresses,dict):
+            producerAddresses = dict(enumerate(producerAddresses))
+        if not producerAddresses:
+            raise ValueError("at least one producer address is needed")
+        for stream in producerAddresses:
+            if not isinstance(stream,(int,long)) or isinstance(stream,bool) or not 0 <= stream <= 0xffff:
+                raise ValueError("stream ids must be ints from 0 to 65535, not %r" % (stream,))
+        if nWorkers is None:
+            nWorkers = mp.cpu_count()
+        if nWorkers < 1:
+            raise ValueError("nWorkers must be at least 1")
+        
         self._context = zmq.Context()
-        self._socket = self._context.socket(zmq.PULL)
-                
-        if (address is None):
-            port = self._socket.bind_to_random_port("tcp://127.0.0.1")
-            address = "tcp://127.0.0.1:%i" % port
-        else:
-            self._socket.bind(address)
-        self._address = address
-        self._aborted = False        
-        
-    def run(self):
-        while self._aborted == False:
-            if self._socket.poll(timeout=10):
-                result = self._socket.recv_pyobj()
-                self.resultReceived.emit(result)
-                
-        #abort logic
-        self._socket.close()
-        self._context.destroy()
-                
-    def abort(self):
-        self._aborted = True
-    
+        self._streams = OrderedDict()
+        self._nWorkers = min(nWorkers,len(producerAddresses))
         
+        assignments = [[] for i in range(self._nWorkers)]
+        for i, stream in enumerate(sorted(producerAddresses)):
+            controller = StreamController(self._context,stream)
+            self._streams[stream] = controller
+            assignments[i % self._nWorkers].append((stream,producerAddresses[stream],controller.controlAddress))
+        if workers is None:
+            workers = PrespawnedWorkers(0)
+        for streams in assignments:
+            workers.start(fitConsumeGroupWorker,(streams,collectorAddress))
+    
     @property
-    def address(self):
-        return self._address
-        
-
+    def nWorkers(self):
+        return self._nWorkers
+    
+    @property
+    def streamIds(self):
+        return list(self._streams)
+    
+    def stream(self,stream):
+        return self._streams[stream]
+    
+    def abort(self):
+        for controller in self._streams.values():
+            controller.abort()
+    
+    def stopFitting(self):
+        for controller in self._streams.values():
+            controller.stopFitting()
     
+    def startFitting(self):
+        """
+        Starts fitting all streams. Returns the epochs of the start by stream
+        id, to pass to CurveFitServiceCollector.restart.
+        """
+        return dict((stream,controller.startFitting()) for stream,controller in self._streams.items())
+    
+    def getStats(self,timeout=1000):
+        """
+        Returns the frame counters of the workers of all streams, see
+        CurveFitServiceController.getStats.
+        """
+        return sum([controller.getStats(timeout) for controller in self._streams.values()],[])
+
+
 if __name__=="__main__":
     cfc = CurveFitServiceController("tcp://localhost:4562","tcp://localhost:4563")
     time.sleep(2)    
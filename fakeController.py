@@ -4,7 +4,7 @@ import time
 
 def controller():
     context = zmq.Context()
-    socket = context.socket(zmq.PUSH)
+    socket = context.socket(zmq.DEALER)
     socket.bind("tcp://*:4568")
     print "controller online"
     while True:        
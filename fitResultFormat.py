@@ -0,0 +1,176 @@
+"""
+Compact wire format for the messages FittingConsumer sends to
+CurveFitServiceCollector.
+
+A fit result is sent as a binary record with a fixed-layout header followed by
+the skipped sequence numbers and one fixed-layout record per fitted peak:
+
+    header:  sequence, frameNumber, sendTime, receiveTime, fitTime,
+             framesSkipped, nSkipped, nPeaks, stream, epoch
+    skipped: nSkipped sequence numbers
+    peak:    name length, name, fit-function version, displacement,
+             popt (3 values), fitStart, fitEnd, evaluations
+
+frameNumber and sendTime come from the producer's message, -1 and NaN when it
+does not send them. The times are the stage timestamps of latencyStats.
+evaluations is the number of fit-function evaluations the fit took. The peaks
+are named, "mp" and "ref" for the moving and the reference peak, and the
+unpacked result lists the names in 'peaks'. stream is the id of the producer
+stream the profile came from, 0 unless the service is a CurveFitSupervisor;
+the sequence numbers count per stream. epoch is the config epoch of the
+worker when the profile was fitted, see CurveFitServiceController.epoch.
+
+The fit functions themselves are only referred to by version. A worker sends a
+fit function once, before the first result that uses it, and the collector
+keeps them in a FitFunctionCache. The versions count per stream, so the
+fit-function message carries the stream id as well.
+"""
+
+import struct
+import pickle
+import numpy as np
+
+RESULT_MESSAGE = b"R"
+FIT_FUNCTION_MESSAGE = b"F"
+
+PEAK_KEYS = ("mp","ref")
+
+_header = struct.Struct("<QqdddQIBHI")
+_name = struct.Struct("<B")
+_peak = struct.Struct("<IddddddH")
+_version = struct.Struct("<I")
+_stream = struct.Struct("<H")
+
+
+def packFitResult(fitResult,fitFunctionVersions):
+    """
+    Packs a fit result dict into a binary record. fitFunctionVersions maps the
+    peak names (those in fitResult['peaks'], or "mp" and "ref") to the version
+    of the fit function the peak was fitted with.
+    """
+    skippedSequences = fitResult.get('skippedSequences',[])
+    peaks = fitResult.get('peaks',[key for key in PEAK_KEYS if ('displacement_%s' % key) in fitResult])
+
+    parts = [_header.pack(fitResult['sequence'],
+                          fitResult.get('frameNumber',-1),
+                          fitResult.get('sendTime',np.nan),
+                          fitResult.get('receiveTime',0.0),
+                          fitResult.get('fitTime',0.0),
+                          fitResult.get('framesSkipped',0),
+                          len(skippedSequences),
+                          len(peaks),
+                          fitResult.get('stream',0),
+                          fitResult.get('epoch',0)),
+             np.asarray(skippedSequences,dtype='<u8').tostring()]
+    for key in peaks:
+        popt = fitResult['popt_%s' % key]
+        name = str(key)
+        parts.append(_name.pack(len(name)) + name)
+        parts.append(_peak.pack(fitFunctionVersions[key],
+                                fitResult['displacement_%s' % key],
+                                popt[0],popt[1],popt[2],
+                                fitResult.get('fitStart_%s' % key,np.nan),
+                                fitResult.get('fitEnd_%s' % key,np.nan),
+                                min(fitResult.get('evaluations_%s' % key,0),0xffff)))
+    return b"".join(parts)
+
+def unpackFitResult(record,fitFunctionCache):
+    """
+    Unpacks a binary record into a fit result dict, with the fit functions
+    looked up by stream and version in fitFunctionCache.
+    """
+    (sequence, frameNumber, sendTime, receiveTime, fitTime,
+     framesSkipped, nSkipped, nPeaks, stream, epoch) = _header.unpack_from(record,0)
+    offset = _header.size
+    skippedSequences = np.frombuffer(record,dtype='<u8',count=nSkipped,offset=offset).tolist()
+    offset += 8*nSkipped
+
+    fitResult = dict(sequence=sequence,
+                     frameNumber=frameNumber,
+                     sendTime=sendTime,
+                     receiveTime=receiveTime,
+                     fitTime=fitTime,
+                     framesSkipped=framesSkipped,
+                     skippedSequences=skippedSequences,
+                     stream=stream,
+                     epoch=epoch,
+                     peaks=[])
+    for n in range(nPeaks):
+        nameLength = _name.unpack_from(record,offset)[0]
+        offset += _name.size
+        key = record[offset:offset+nameLength]
+        offset += nameLength
+        values = _peak.unpack_from(record,offset)
+        offset += _peak.size
+        fitResult['peaks'].append(key)
+        fitResult['displacement_%s' % key] = values[1]
+        fitResult['popt_%s' % key] = np.array(values[2:5])
+        fitResult['fitFunction_%s' % key] = fitFunctionCache.get(values[0],stream)
+        fitResult['fitStart_%s' % key] = values[5]
+        fitResult['fitEnd_%s' % key] = values[6]
+        fitResult['evaluations_%s' % key] = values[7]
+    return fitResult
+
+def packResultBatch(fitResults):
+    """
+    Packs a list of unpacked fit results into one dict of contiguous arrays,
+    one row per result: 'sequence', 'stream', 'epoch', 'frameNumber', the stage
+    timestamps ('sendTime', 'receiveTime', 'fitTime' and 'collectTime' if the
+    results have it) and per peak 'displacement_X' and 'popt_X' (n x 3). 'peaks'
+    lists the peaks of all results, in the order they first appear; the rows of
+    a result without a peak are NaN. 'fitFunction_X' is the fit function of the
+    newest result with peak X, the last one of the highest config epoch, and
+    'fitRow_X' its row, to draw; the results of a pool of workers can arrive
+    with older epochs after newer ones. 'last' is the last result itself.
+    """
+    n = len(fitResults)
+    batch = dict(count=n,
+                 sequence=np.fromiter((r['sequence'] for r in fitResults),dtype=np.uint64,count=n),
+                 stream=np.fromiter((r['stream'] for r in fitResults),dtype=np.uint16,count=n),
+                 epoch=np.fromiter((r['epoch'] for r in fitResults),dtype=np.uint32,count=n),
+                 frameNumber=np.fromiter((r['frameNumber'] for r in fitResults),dtype=np.int64,count=n),
+                 peaks=[],
+                 last=fitResults[-1] if fitResults else None)
+    for key in ('sendTime','receiveTime','fitTime','collectTime'):
+        batch[key] = np.fromiter((r.get(key,np.nan) for r in fitResults),dtype=np.float64,count=n)
+    for i, fitResult in enumerate(fitResults):
+        for key in fitResult['peaks']:
+            if key not in batch['peaks']:
+                batch['peaks'].append(key)
+                batch['displacement_%s' % key] = np.empty(n)
+                batch['displacement_%s' % key].fill(np.nan)
+                batch['popt_%s' % key] = np.empty((n,3))
+                batch['popt_%s' % key].fill(np.nan)
+            batch['displacement_%s' % key][i] = fitResult['displacement_%s' % key]
+            batch['popt_%s' % key][i] = fitResult['popt_%s' % key]
+            if 'fitRow_%s' % key not in batch or fitResult['epoch'] >= batch['epoch'][batch['fitRow_%s' % key]]:
+                batch['fitFunction_%s' % key] = fitResult['fitFunction_%s' % key]
+                batch['fitRow_%s' % key] = i
+    return batch
+
+def packFitFunction(version,fitFunction,stream=0):
+    return [FIT_FUNCTION_MESSAGE,_version.pack(version),pickle.dumps(fitFunction,pickle.HIGHEST_PROTOCOL),
+            _stream.pack(stream)]
+
+
+class FitFunctionCache(object):
+    def __init__(self,maxSize=16):
+        """
+        Keeps the maxSize most recently received fit functions of every stream
+        by version. add takes the frames of a fit-function message after the
+        message type.
+        """
+        self.maxSize = maxSize
+        self._fitFunctions = dict()
+
+    def add(self,versionBytes,fitFunctionBytes,streamBytes=None):
+        version = _version.unpack(versionBytes)[0]
+        stream = _stream.unpack(streamBytes)[0] if streamBytes is not None else 0
+        fitFunctions = self._fitFunctions.setdefault(stream,dict())
+        if version not in fitFunctions:
+            fitFunctions[version] = pickle.loads(fitFunctionBytes)
+            for oldVersion in sorted(fitFunctions)[:-self.maxSize]:
+                del fitFunctions[oldVersion]
+
+    def get(self,version,stream=0):
+        return self._fitFunctions.get(stream,dict()).get(version)
@@ -0,0 +1,852 @@
+"""
+The fit worker processes of the curve-fit service: RealTimeFitter, the
+FittingConsumer that fits the lvdata of a producer with it, the
+FrameDistributor of a worker pool, and their process entry points.
+
+The module only imports what fitting needs, no Qt, so that a worker process
+that imports it starts quickly. The controllers are in curveFitService, the
+collector in curveFitCollector.
+"""
+
+import zmq
+import numpy as np
+import time
+import struct
+import os
+import copy
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from peakFitter import PeakFitter
+from fitResultFormat import PEAK_KEYS, RESULT_MESSAGE, packFitResult, packFitFunction
+from profileMessage import unpackProfileMessage
+from profileRing import ProfileRingBuffer, unpackSlotNotification
+
+# the names the moving and reference peak had before peaks were named
+PEAK_ALIASES = dict(movingPeak="mp",referencePeak="ref")
+
+# RPCs that do not change the configuration of the workers and get no epoch
+UNVERSIONED_METHODS = ("abort","printState","getStats")
+
+class RealTimeFitter(object):
+    def __init__(self,threads=1):
+        """
+        Fits a list of named peaks in every intensity profile, each with its own
+        interval, fit function and estimator (see PeakFitter). It starts with
+        the moving peak "mp" and the reference peak "ref"; addPeak and
+        removePeak change the list.
+        
+        The results are keyed per peak: displacement_<name>, popt_<name>,
+        fitFunction_<name>, fitStart_<name>, fitEnd_<name> and
+        evaluations_<name>, with the names in 'peaks'. With more than one
+        thread the peaks are fitted concurrently on a thread pool.
+        """
+        self._peaks = OrderedDict()
+        self.useAnalyticJacobian = True
+        self.usePrediction = True
+        self._sigma = None
+        self.fitCount = 0
+        self.threads = 1
+        self._pool = None
+        for name in PEAK_KEYS:
+            self.addPeak(name)
+        self.setThreads(threads)
+        
+    @property        
+    def canFit(self):
+        return len(self._peaks) > 0 and all(peak.canFit for peak in self._peaks.values())
+    
+    @property
+    def peakNames(self):
+        return list(self._peaks)
+    
+    @property
+    def trackingFallbacks(self):
+        return sum(peak.trackingFallbacks for peak in self._peaks.values())
+    
+    @property
+    def reseeds(self):
+        return sum(peak.reseeds for peak in self._peaks.values())
+    
+    @property
+    def evaluationCount(self):
+        return dict((peak.name,peak.evaluationCount) for peak in self._peaks.values())
+    
+    def _map(self,function):
+        peaks = list(self._peaks.values())
+        if self._pool is not None and len(peaks) > 1:
+            return peaks, self._pool.map(function,peaks)
+        return peaks, [function(peak) for peak in peaks]
+    
+    def fit(self,intensityProfile,actuatorVoltage=None):
+        if self.canFit:
+            try:
+                sigma = self._getSigma(len(intensityProfile))
+                peaks, fits = self._map(lambda peak: peak.fit(intensityProfile,actuatorVoltage,sigma))
+                self.fitCount += 1
+                fitResult = dict(peaks=[peak.name for peak in peaks])
+                for peak, (displacement, popt, evaluations, fitStart, fitEnd) in zip(peaks,fits):
+                    fitResult['displacement_%s' % peak.name] = displacement
+                    fitResult['popt_%s' % peak.name] = popt
+                    fitResult['fitFunction_%s' % peak.name] = peak.fitFunction
+                    fitResult['fitStart_%s' % peak.name] = fitStart
+                    fitResult['fitEnd_%s' % peak.name] = fitEnd
+                    fitResult['evaluations_%s' % peak.name] = evaluations
+                return fitResult
+            except Exception as e:
+                print e
+        else:
+            return dict()
+    
+    def fitBatch(self,intensityProfiles,actuatorVoltages=None):
+        """
+        Fits a stack of intensity profiles (one per row) at once with the
+        vectorized BatchFitter, starting from the predicted parameters. Returns a
+        list with one result dict per profile, like fit does for a single profile.
+        """
+        if self.canFit:
+            try:
+                profiles = np.atleast_2d(intensityProfiles)
+                sigma = self._getSigma(profiles.shape[1])
+                peaks, fits = self._map(lambda peak: peak.fitBatch(profiles,actuatorVoltages,sigma))
+                self.fitCount += len(profiles)
+                fitResults = [dict(peaks=[peak.name for peak in peaks]) for profile in profiles]
+                for peak, (displacements, popts, evaluations, fitStart, fitEnd) in zip(peaks,fits):
+                    for i, fitResult in enumerate(fitResults):
+                        fitResult['displacement_%s' % peak.name] = displacements[i]
+                        fitResult['popt_%s' % peak.name] = popts[i]
+                        fitResult['fitFunction_%s' % peak.name] = peak.fitFunction
+                        fitResult['fitStart_%s' % peak.name] = fitStart
+                        fitResult['fitEnd_%s' % peak.name] = fitEnd
+                        fitResult['evaluations_%s' % peak.name] = evaluations[i]
+                return fitResults
+            except Exception as e:
+                print e
+                return [dict() for profile in intensityProfiles]
+        else:
+            return [dict() for profile in intensityProfiles]
+    
+    def addPeak(self,name):
+        """
+        Adds a peak to fit; it is fitted once it has a fit function and an
+        interval.
+        """
+        if name not in self._peaks:
+            peak = PeakFitter(name)
+            peak.useAnalyticJacobian = self.useAnalyticJacobian
+            peak.predictor.extrapolate = self.usePrediction
+            self._peaks[name] = peak
+    
+    def removePeak(self,name):
+        self._peaks.pop(PEAK_ALIASES.get(name,name),None)
+    
+    def _getPeak(self,name):
+        name = PEAK_ALIASES.get(name,name)
+        if name not in self._peaks:
+            raise ValueError("unknown peak: %s" % name)
+        return self._peaks[name]
+    
+    def setPeakFitFunction(self,name,fitFunction):
+        print "%s fitfunction: %s" % (name,fitFunction)
+        self._getPeak(name).setFitFunction(fitFunction)
+        self._warnApproximateJacobian([PEAK_ALIASES.get(name,name)])
+    
+    def setPeakInterval(self,name,interval):
+        print name, interval
+        self._getPeak(name).setInterval(interval)
+    
+    def setPeakTracking(self,name,width):
+        """
+        Fits the peak over a window of width pixels that follows it, see
+        PeakFitter.setTracking. None turns tracking off.
+        """
+        self._getPeak(name).setTracking(width)
+    
+    def setReferencePeakFitFunction(self,fitFunction):
+        self.setPeakFitFunction("ref",fitFunction)
+        
+    def setReferencePeakInterval(self,interval):
+        self.setPeakInterval("ref",interval)
+
+    def setMovingPeakInterval(self,interval):
+        self.setPeakInterval("mp",interval)
+        
+    def setMovingPeakFitFunction(self,fitFunction):
+        self.setPeakFitFunction("mp",fitFunction)
+        
+    def setMovingPeakTracking(self,width):
+        self.setPeakTracking("mp",width)
+        
+    def setThreads(self,threads):
+        """
+        Fits the peaks concurrently on a pool of this many threads, or one after
+        the other with a single thread. The threads only run in parallel while
+        numpy and scipy release the GIL, which the BatchFitter does most.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        self.threads = threads
+        if threads > 1:
+            self._pool = ThreadPool(threads)
+        
+    def setUseAnalyticJacobian(self,enabled):
+        """
+        Selects whether curve_fit gets the exact Jacobian of the ScaledSpline
+        model, or estimates it with finite differences.
+        """
+        self.useAnalyticJacobian = bool(enabled)
+        for peak in self._peaks.values():
+            peak.useAnalyticJacobian = self.useAnalyticJacobian
+        self._warnApproximateJacobian(self._peaks.keys())
+    
+    def _warnApproximateJacobian(self,names):
+        if not self.useAnalyticJacobian:
+            return
+        for name in names:
+            peak = self._peaks[name]
+            if peak.model is not None and not peak.hasExactJacobian:
+                print "%s: fit function has no spline derivative, the analytic Jacobian uses a central difference" % name
+        
+    def setUsePrediction(self,enabled):
+        """
+        Selects whether the spline fits start from parameters extrapolated from
+        the last frames and the actuator voltage (see ParameterPredictor), or
+        from the last fitted parameters.
+        """
+        self.usePrediction = bool(enabled)
+        for peak in self._peaks.values():
+            peak.predictor.extrapolate = self.usePrediction
+        
+    def setSigma(self,sigma):
+        """
+        Sets the per-pixel standard deviation of the profiles, e.g. from
+        ProfileStatistics.sigma, that weights the spline fits. None fits
+        without weights.
+        """
+        self._sigma = np.asarray(sigma,dtype=np.float64) if sigma is not None else None
+    
+    def _getSigma(self,length):
+        # sigma recorded for profiles of another length does not apply
+        if self._sigma is not None and len(self._sigma) == length:
+            return self._sigma
+        return None
+        
+    def setPeakEstimator(self,peak,estimator):
+        """
+        Selects how the displacement of a peak (its name, or "movingPeak" or
+        "referencePeak") is determined: "spline" fits the ScaledSpline with
+        curve_fit, "xcorr" cross-correlates the interval with the fit function's
+        template profile.
+        """
+        self._getPeak(peak).setEstimator(estimator)
+        
+    def reset(self):
+        """
+        Resets the stored curve-fit estimates to the default values.
+        """
+        for peak in self._peaks.values():
+            peak.reset()
+    
+    def saveState(self):
+        """
+        Returns a copy of the peaks and the settings, for restoreState to go
+        back to when a configuration change fails halfway.
+        """
+        peaks = OrderedDict()
+        for name, peak in self._peaks.items():
+            # the setters replace the attributes of a peak, only the predictor
+            # is changed in place
+            peaks[name] = copy.copy(peak)
+            peaks[name].predictor = copy.copy(peak.predictor)
+        return dict(peaks=peaks,useAnalyticJacobian=self.useAnalyticJacobian,
+                    usePrediction=self.usePrediction,sigma=self._sigma,threads=self.threads)
+    
+    def restoreState(self,state):
+        self._peaks = state['peaks']
+        self.useAnalyticJacobian = state['useAnalyticJacobian']
+        self.usePrediction = state['usePrediction']
+        self._sigma = state['sigma']
+        if self.threads != state['threads']:
+            self.setThreads(state['threads'])
+    
+
+FRAME_POLICIES = ("every","latest","nth")
+
+def packSequence(sequence):
+    return struct.pack("<Q",sequence)
+
+def unpackSequence(sequenceBytes):
+    return struct.unpack("<Q",sequenceBytes)[0]
+
+
+class FrameDistributor(object):
+    def __init__(self,producerAddress, controlAddress):
+        """
+        Subscribes to the lvdata stream at producerAddress, tags every message
+        with a sequence number and fans the messages out over a PUSH socket to
+        a pool of FittingConsumers. The raw message bytes are forwarded as-is,
+        decoding is left to the workers.
+        """
+        self.context = zmq.Context()
+        
+        self.control_socket = self.context.socket(zmq.DEALER)
+        self.control_socket.connect(controlAddress)
+        
+        self.producer_socket = self.context.socket(zmq.SUB)
+        self.producer_socket.connect(producerAddress)
+        self.producer_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+        
+        self.distribute_socket = self.context.socket(zmq.PUSH)
+        port = self.distribute_socket.bind_to_random_port("tcp://127.0.0.1")
+        self.distribute_socket.setsockopt(zmq.LINGER, 0)
+        self._address = "tcp://127.0.0.1:%i" % port
+        
+        self.poller = zmq.Poller()
+        self.poller.register(self.producer_socket,zmq.POLLIN)
+        self.poller.register(self.control_socket,zmq.POLLIN)
+        
+        self._sequence = 0
+        self.state = "running"
+    
+    @property
+    def address(self):
+        return self._address
+    
+    def run(self):
+        try:
+            while self.state != "aborted":
+                # blocks until a message arrives, abort wakes it up through the control socket
+                sockets = dict(self.poller.poll())
+                
+                if self.control_socket in sockets:
+                    rpc = self.control_socket.recv_pyobj()
+                    if rpc['method'] == 'abort':
+                        self.state = "aborted"
+                        break
+                
+                if self.producer_socket in sockets:
+                    # forwards all parts of the message, single-frame or multipart
+                    message = self.producer_socket.recv_multipart(copy=False)
+                    self.distribute_socket.send_multipart([packSequence(self._sequence)] + message,copy=False)
+                    self._sequence += 1
+        finally:
+            #abort logic
+            self.producer_socket.close(linger=0)
+            self.distribute_socket.close(linger=0)
+            self.control_socket.close(linger=0)
+            self.context.term()
+
+
+class FittingConsumer():
+    def __init__(self,producerAddress, collectorAddress, controlAddress, distributed=False, ringPath=None, stream=0, context=None)    :
+        """
+        Reads lvdata from producerAdress, uses it to do a curve fit, and sends the
+        results to collectorAddress. The consumer can be controlled from controlAddress
+        
+        If distributed is True, producerAddress is the address of a FrameDistributor
+        and the consumer is one worker in a pool. Messages then arrive with the
+        sequence number assigned by the distributor, otherwise the consumer numbers
+        the messages itself.
+        
+        If ringPath is given, the messages are slot notifications of a
+        ProfileIngest and the profiles are read from its shared ring buffer.
+        
+        stream is the id the fit results are tagged with. With a context, the
+        consumer shares it with the other consumers of a FittingConsumerGroup,
+        which then polls its sockets (see handleSockets).
+        """
+        self.stream = stream
+        self._ownsContext = context is None
+        self.context = zmq.Context() if context is None else context
+        
+        self._ring = ProfileRingBuffer(ringPath) if ringPath is not None else None
+    
+        # requests from the controller, replies to configuration changes
+        self.control_socket = self.context.socket(zmq.DEALER)
+        self.control_socket.connect(controlAddress)
+        
+        self.distributed = distributed
+        if distributed:
+            self.producer_socket = self.context.socket(zmq.PULL)
+            self.producer_socket.connect(producerAddress)
+        else:
+            self.producer_socket = self.context.socket(zmq.SUB)
+            self.producer_socket.connect(producerAddress)
+            self.producer_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+        self._sequence = 0
+        
+        self._receiveTime = 0.0
+        self._fitFunctionVersions = dict()
+        self._sentFitFunctionVersions = set()
+        self._localFitFunctionVersion = 1 << 31
+        
+        self.framePolicy = "every"
+        self.frameInterval = 1
+        self.batchSize = 1
+        self.framesSkipped = 0
+        self._frameCounter = 0
+        self._skippedSequences = []
+        
+        self.framesReceived = 0
+        self.framesFitted = 0
+        self.fitsFailed = 0
+        self.configEpoch = 0
+        
+        self.collector_socket = self.context.socket(zmq.PUSH)
+        self.collector_socket.connect(collectorAddress)
+        
+        self.poller = zmq.Poller()
+        self.poller.register(self.producer_socket,zmq.POLLIN)
+        self.poller.register(self.control_socket,zmq.POLLIN)
+        
+        
+        self.fitter = RealTimeFitter()    
+        
+        self.state = "idle"
+        
+        
+    def run(self):
+        print "running"
+        try:
+            while self.state != "aborted":
+                # block until there is something to do, the control socket is
+                # part of the poll so RPCs (including abort) wake the loop up
+                self.handleSockets(dict(self.poller.poll()))
+        finally:
+            self._shutdown()
+        print "aborted"
+    
+    def handleSockets(self,sockets):
+        """
+        Handles the sockets of this consumer that a poll returned as readable.
+        """
+        if self.control_socket in sockets:
+            self._handlePendingRPCs()
+            if self.state == "aborted":
+                return
+            
+        if self.producer_socket in sockets:
+            # handle message(s) from producer          
+            frames = self._decodeFrames(self._receiveFrames())
+            if len(frames) == 1:
+                sequence, lvdata = frames[0]
+                self._handleProducerData(lvdata,sequence)
+            elif len(frames) > 1:
+                sequences = [sequence for sequence, lvdata in frames]
+                lvdatas = [lvdata for sequence, lvdata in frames]
+                self._handleProducerBatch(lvdatas,sequences)
+    
+    def _handlePendingRPCs(self):
+        """
+        Handles all queued RPCs, so that a configuration change is complete
+        before the next profile is fitted.
+        """
+        while True:
+            try:
+                rpc = self.control_socket.recv_pyobj(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self._handleRPC(rpc)
+            if self.state == "aborted":
+                return
+    
+    def _shutdown(self):
+        #abort logic
+        self.producer_socket.close(linger=0)
+        self.control_socket.close(linger=0)
+        # give results that are still queued a moment to reach the collector
+        self.collector_socket.close(linger=100)
+        if self._ownsContext:
+            self.context.term()
+    
+    def _receiveProducerMessage(self,flags=0):
+        if self.distributed:
+            parts = self.producer_socket.recv_multipart(flags,copy=False)
+            self.framesReceived += 1
+            return unpackSequence(parts[0].bytes), parts[1:]
+        else:
+            message = self.producer_socket.recv_multipart(flags,copy=False)
+            self.framesReceived += 1
+            if self._ring is not None:
+                # the ring numbers the profiles for all its readers
+                slot, sequence = unpackSlotNotification(message[0].bytes)
+                return sequence, message
+            sequence = self._sequence
+            self._sequence += 1
+            return sequence, message
+    
+    def _decodeFrames(self,frames):
+        """
+        Turns the (sequence, message) pairs into (sequence, lvdata) pairs. Profiles
+        that were already overwritten in the ring buffer are counted as skipped.
+        """
+        decoded = []
+        for sequence, message in frames:
+            if self._ring is not None:
+                slot, ringSequence = unpackSlotNotification(message[0].bytes)
+                lvdata = self._ring.read(slot,ringSequence)
+                if lvdata is not None:
+                    # the ingest may reuse the slot while the profile is
+                    # fitted, fit a copy that was still current after copying
+                    lvdata['Intensity Profile'] = lvdata['Intensity Profile'].copy()
+                    if not self._ring.isCurrent(slot,ringSequence):
+                        lvdata = None
+                if lvdata is None:
+                    self._skipFrame(sequence)
+                    continue
+            else:
+                lvdata = unpackProfileMessage(message)
+            decoded.append((sequence,lvdata))
+        return decoded
+    
+    def _receiveFrames(self):
+        """
+        Returns the list of (sequence, message) pairs that should be fitted next.
+        That is normally a single frame, but with a batch size larger than one
+        the messages that have queued up are taken as well, up to batchSize
+        frames, so that they can be fitted in one go.
+        """
+        sequence, message = self._receiveProducerMessage()
+        self._receiveTime = time.time()
+        if self.framePolicy == "latest":
+            sequence, message = self._drainProducerSocket(sequence,message)
+        
+        frames = []
+        while True:
+            if self._isFrameSelected():
+                frames.append((sequence,message))
+            else:
+                self._skipFrame(sequence)
+            
+            if len(frames) >= self.batchSize or self.framePolicy == "latest":
+                return frames
+            try:
+                sequence, message = self._receiveProducerMessage(zmq.NOBLOCK)
+            except zmq.Again:
+                return frames
+    
+    def _drainProducerSocket(self,sequence,message):
+        """
+        Reads all queued producer messages and returns only the newest one, the
+        older ones are counted as skipped without being decoded.
+        """
+        while True:
+            try:
+                newSequence, newMessage = self._receiveProducerMessage(zmq.NOBLOCK)
+            except zmq.Again:
+                return sequence, message
+            self._skipFrame(sequence)
+            sequence, message = newSequence, newMessage
+    
+    def _isFrameSelected(self):
+        if self.framePolicy == "nth":
+            selected = self._frameCounter % self.frameInterval == 0
+            self._frameCounter += 1
+            return selected
+        else:
+            return True
+    
+    def _skipFrame(self,sequence):
+        if self.state == "fitting":
+            self.framesSkipped += 1
+            self._skippedSequences.append(sequence)
+    
+    def setFramePolicy(self,policy,n=1):
+        """
+        Selects which producer messages are fitted: "every" message, only the
+        "latest" message whenever the fitter is ready for the next one, or every
+        "nth" message.
+        """
+        if policy not in FRAME_POLICIES:
+            raise ValueError("frame policy must be one of %s" % (FRAME_POLICIES,))
+        self.framePolicy = policy
+        self.frameInterval = max(int(n),1)
+        self.framesSkipped = 0
+        self._frameCounter = 0
+    
+    def setBatchSize(self,batchSize):
+        """
+        Sets the maximum number of queued up frames that are fitted together
+        with the vectorized batch fitter. 1 fits every frame on its own.
+        """
+        self.batchSize = max(int(batchSize),1)
+            
+    def _handleRPC(self,rpc):
+        """
+        Applies rpc. A configuration change carries the config epoch it
+        starts: the worker replies on the control socket with the epoch and
+        the error, if the change failed, and tags the results it fits from
+        then on with the epoch. A change that fails is undone as a whole and
+        the worker stays in the epoch it was in.
+        """
+        error = None
+        # only a change of the configuration can need undoing
+        saved = self._saveConfiguration() if rpc['method'] not in UNVERSIONED_METHODS else None
+        try:
+            if rpc['method'] == 'configure':
+                # the changes of one epoch are applied together, no frame is
+                # fitted in between
+                for change in rpc['params']['rpcs']:
+                    self._applyRPC(change)
+            else:
+                self._applyRPC(rpc)
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__,e)
+            if saved is not None:
+                self._restoreConfiguration(saved)
+        
+        if 'epoch' in rpc:
+            if error is None:
+                self.configEpoch = rpc['epoch']
+            self._sendReply(dict(epoch=rpc['epoch'],method=rpc['method'],error=error,pid=os.getpid(),stream=self.stream))
+        elif error is not None:
+            print "%s failed: %s" % (rpc['method'],error)
+    
+    def _saveConfiguration(self):
+        return dict(fitter=self.fitter.saveState(),state=self.state,
+                    framePolicy=self.framePolicy,frameInterval=self.frameInterval,
+                    framesSkipped=self.framesSkipped,frameCounter=self._frameCounter,
+                    batchSize=self.batchSize,fitFunctionVersions=dict(self._fitFunctionVersions),
+                    localFitFunctionVersion=self._localFitFunctionVersion)
+    
+    def _restoreConfiguration(self,saved):
+        self.fitter.restoreState(saved['fitter'])
+        self.state = saved['state']
+        self.framePolicy = saved['framePolicy']
+        self.frameInterval = saved['frameInterval']
+        self.framesSkipped = saved['framesSkipped']
+        self._frameCounter = saved['frameCounter']
+        self.batchSize = saved['batchSize']
+        self._fitFunctionVersions = saved['fitFunctionVersions']
+        self._localFitFunctionVersion = saved['localFitFunctionVersion']
+    
+    def _sendReply(self,reply):
+        try:
+            # a controller that does not read the replies must not hold up the worker
+            self.control_socket.send_pyobj(reply,zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+    
+    def _applyRPC(self,rpc):
+        if rpc['method'] == 'stopFitting':
+            self.state = "idle"
+            
+        elif rpc['method'] == 'startFitting':
+            if not self.fitter.canFit:
+                raise RuntimeError("cannot start fitting, not every peak has a fit function and an interval")
+            self.state = "fitting"
+
+        elif rpc['method'] == 'setMovingPeakFitFunction':
+            self._setFitFunctionVersion('mp',rpc['params'].pop('version',None))
+            self.fitter.setMovingPeakFitFunction(**rpc['params'])
+
+        elif rpc['method'] == 'setReferencePeakFitFunction':
+            self._setFitFunctionVersion('ref',rpc['params'].pop('version',None))
+            self.fitter.setReferencePeakFitFunction(**rpc['params'])
+
+        elif rpc['method'] == 'setMovingPeakInterval':
+            self.fitter.setMovingPeakInterval(**rpc['params'])
+
+        elif rpc['method'] == 'setReferencePeakInterval':
+            self.fitter.setReferencePeakInterval(**rpc['params'])
+
+        elif rpc['method'] == 'addPeak':
+            self.fitter.addPeak(**rpc['params'])
+
+        elif rpc['method'] == 'removePeak':
+            self.fitter.removePeak(**rpc['params'])
+
+        elif rpc['method'] == 'setPeakFitFunction':
+            name = PEAK_ALIASES.get(rpc['params']['name'],rpc['params']['name'])
+            self._setFitFunctionVersion(name,rpc['params'].pop('version',None))
+            self.fitter.setPeakFitFunction(**rpc['params'])
+
+        elif rpc['method'] == 'setPeakInterval':
+            self.fitter.setPeakInterval(**rpc['params'])
+
+        elif rpc['method'] == 'setPeakTracking':
+            self.fitter.setPeakTracking(**rpc['params'])
+
+        elif rpc['method'] == 'setThreads':
+            self.fitter.setThreads(**rpc['params'])
+
+        elif rpc['method'] == 'setFramePolicy':
+            self.setFramePolicy(**rpc['params'])
+
+        elif rpc['method'] == 'setBatchSize':
+            self.setBatchSize(**rpc['params'])
+
+        elif rpc['method'] == 'setUseAnalyticJacobian':
+            self.fitter.setUseAnalyticJacobian(**rpc['params'])
+
+        elif rpc['method'] == 'setUsePrediction':
+            self.fitter.setUsePrediction(**rpc['params'])
+
+        elif rpc['method'] == 'reset':
+            self.fitter.reset()
+
+        elif rpc['method'] == 'setSigma':
+            self.fitter.setSigma(**rpc['params'])
+
+        elif rpc['method'] == 'setPeakEstimator':
+            self.fitter.setPeakEstimator(**rpc['params'])
+
+        elif rpc['method'] == 'setMovingPeakTracking':
+            self.fitter.setMovingPeakTracking(**rpc['params'])
+
+        elif rpc['method'] == 'abort':
+            self.state = "aborted"
+        elif rpc['method'] == 'printState':
+            print self.state, "policy: %s, skipped frames: %i" % (self.framePolicy, self.framesSkipped)
+        elif rpc['method'] == 'getStats':
+            self._sendReply(dict(method='getStats',request=rpc.get('request'),stats=self.getStats(),
+                                 pid=os.getpid(),stream=self.stream))
+            
+
+    def _handleProducerData(self,lvdata,sequence):
+        if self.state == "fitting" and self.fitter.canFit:
+            try:        
+                fitResult = self.fitter.fit(lvdata['Intensity Profile'],lvdata.get('Actuator Voltage'))
+                self._sendFitResult(fitResult,sequence,lvdata)
+            except Exception as e:
+                print "frame %i: %s: %s" % (sequence,type(e).__name__,e)
+    
+    def _handleProducerBatch(self,lvdatas,sequences):
+        if self.state == "fitting" and self.fitter.canFit:
+            try:
+                profiles = [lvdata['Intensity Profile'] for lvdata in lvdatas]
+                voltages = [lvdata.get('Actuator Voltage') for lvdata in lvdatas]
+                if len(set(len(profile) for profile in profiles)) == 1:
+                    fitResults = self.fitter.fitBatch(np.vstack(profiles),
+                                                      None if None in voltages else voltages)
+                else:
+                    fitResults = [self.fitter.fit(profile,voltage) for profile,voltage in zip(profiles,voltages)]
+                for fitResult, sequence, lvdata in zip(fitResults,sequences,lvdatas):
+                    self._sendFitResult(fitResult,sequence,lvdata)
+            except Exception as e:
+                print "frames %i-%i: %s: %s" % (sequences[0],sequences[-1],type(e).__name__,e)
+    
+    def _setFitFunctionVersion(self,key,version):
+        if version is None:
+            # not sent by a CurveFitServiceController, use a local version number
+            self._localFitFunctionVersion += 1
+            version = self._localFitFunctionVersion
+        self._fitFunctionVersions[key] = version
+    
+    def getStats(self):
+        """
+        Returns the frame counters of this worker. The stage latencies are
+        kept by the collector, from the timestamps in the fit results.
+        """
+        return dict(pid=os.getpid(),
+                    stream=self.stream,
+                    state=self.state,
+                    configEpoch=self.configEpoch,
+                    framePolicy=self.framePolicy,
+                    batchSize=self.batchSize,
+                    framesReceived=self.framesReceived,
+                    framesFitted=self.framesFitted,
+                    framesSkipped=self.framesSkipped,
+                    fitsFailed=self.fitsFailed,
+                    trackingFallbacks=self.fitter.trackingFallbacks,
+                    reseeds=self.fitter.reseeds,
+                    evaluations=dict((name,count / float(max(self.fitter.fitCount,1)))
+                                     for name,count in self.fitter.evaluationCount.items()))
+    
+    def _sendFitResult(self,fitResult,sequence,lvdata):
+        if fitResult is None:
+            # failed fit, still report the sequence number so that the
+            # collector does not wait for it
+            fitResult = dict()
+        if 'peaks' in fitResult:
+            self.framesFitted += 1
+        else:
+            self.fitsFailed += 1
+        fitResult['sequence'] = sequence
+        fitResult['stream'] = self.stream
+        fitResult['epoch'] = self.configEpoch
+        fitResult['frameNumber'] = lvdata.get('Frame Number',-1)
+        fitResult['sendTime'] = lvdata.get('Send Time',np.nan)
+        fitResult['receiveTime'] = self._receiveTime
+        fitResult['fitTime'] = time.time()
+        fitResult['skippedSequences'] = self._skippedSequences
+        fitResult['framesSkipped'] = self.framesSkipped
+        self._skippedSequences = []
+        
+        # the fit functions only go over the wire once per version
+        for key in fitResult.get('peaks',[]):
+            fitFunction = fitResult.get('fitFunction_%s' % key)
+            version = self._fitFunctionVersions.get(key)
+            if fitFunction is not None and version not in self._sentFitFunctionVersions:
+                self.collector_socket.send_multipart(packFitFunction(version,fitFunction,self.stream))
+                self._sentFitFunctionVersions.add(version)
+        self.collector_socket.send_multipart([RESULT_MESSAGE,packFitResult(fitResult,self._fitFunctionVersions)])
+
+def fitConsumeWorker(producerAddress, collectorAddress, controlAddress, distributed=False, ringPath=None):
+    fittingConsumer = FittingConsumer(producerAddress, collectorAddress, controlAddress, distributed, ringPath)
+    fittingConsumer.run()
+
+def frameDistributeWorker(producerAddress, controlAddress, addressConnection):
+    frameDistributor = FrameDistributor(producerAddress, controlAddress)
+    addressConnection.send(frameDistributor.address)
+    addressConnection.close()
+    frameDistributor.run()
+
+
+class FittingConsumerGroup(object):
+    def __init__(self,streams,collectorAddress):
+        """
+        Runs one FittingConsumer per producer stream in a single process.
+        streams is a list of (stream id, producerAddress, controlAddress).
+        Every stream has its own fitter, frame policy and control socket; one
+        poll over the sockets of all streams serves whichever streams have
+        messages, one frame or batch per stream at a time.
+        """
+        self.context = zmq.Context()
+        self.consumers = [FittingConsumer(producerAddress,collectorAddress,controlAddress,stream=stream,context=self.context)
+                          for stream, producerAddress, controlAddress in streams]
+        self.poller = zmq.Poller()
+        for consumer in self.consumers:
+            self.poller.register(consumer.producer_socket,zmq.POLLIN)
+            self.poller.register(consumer.control_socket,zmq.POLLIN)
+    
+    def run(self):
+        print "running streams %s" % [consumer.stream for consumer in self.consumers]
+        running = list(self.consumers)
+        try:
+            while running:
+                sockets = dict(self.poller.poll())
+                for consumer in list(running):
+                    consumer.handleSockets(sockets)
+                    if consumer.state == "aborted":
+                        self.poller.unregister(consumer.producer_socket)
+                        self.poller.unregister(consumer.control_socket)
+                        consumer._shutdown()
+                        running.remove(consumer)
+        finally:
+            for consumer in running:
+                consumer._shutdown()
+            self.context.term()
+        print "aborted"
+
+def fitConsumeGroupWorker(streams, collectorAddress):
+    fittingConsumerGroup = FittingConsumerGroup(streams, collectorAddress)
+    fittingConsumerGroup.run()
+
+def prespawnedWorker(connection):
+    """
+    Entry point of a process started by PrespawnedWorkers: waits for the
+    worker function and its arguments and runs it. With connect, the function
+    gets the connection as its last argument.
+    """
+    task = connection.recv()
+    if task is None:
+        connection.close()
+        return
+    target, args, connect = task
+    if connect:
+        target(*(args + (connection,)))
+    else:
+        connection.close()
+        target(*args)
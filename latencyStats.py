@@ -0,0 +1,201 @@
+"""
+Rolling latency statistics of the stages a frame passes through.
+
+Every fit result carries the timestamps its frame collected on the way:
+
+    sendTime         producer sends the lvdata message ('Send Time' field)
+    receiveTime      FittingConsumer receives the message
+    fitStart_<name>  fit of each peak in 'peaks' starts
+    fitEnd_<name>    fit of each peak in 'peaks' ends
+    fitTime          the result is sent to the collector
+    collectTime      CurveFitServiceCollector receives the result
+    paintTime        MainWindow has drawn the result
+
+From the fits of the peaks, which may run concurrently, follow fitStart, the
+first start, and fitEnd, the last end (see stageTimestamps).
+
+The timestamps are time.time() values, the clock that all processes on a host
+share. A stage is the time between two of them; besides STAGES every peak has
+a stage fit_<name> from its fitStart_<name> to its fitEnd_<name>. LatencyStats
+keeps the
+durations of the last window frames per stage and turns them into histograms
+and percentiles on request. SequenceGapDetector counts the frames that never
+made it through the pipeline.
+"""
+
+import numpy as np
+import threading
+from collections import OrderedDict
+
+STAGES = (("transport","sendTime","receiveTime"),
+          ("queue","receiveTime","fitStart"),
+          ("fit","fitStart","fitEnd"),
+          ("send","fitEnd","fitTime"),
+          ("delivery","fitTime","collectTime"),
+          ("gui","collectTime","paintTime"),
+          ("pipeline","sendTime","collectTime"),
+          ("total","sendTime","paintTime"))
+
+# 1 us to 10 s, 8 bins per decade
+BIN_EDGES = np.logspace(-6,1,57)
+
+
+def stageTimestamps(fitResult):
+    """
+    Returns the timestamps of a fit result with fitStart and fitEnd, the first
+    start and the last end of the fits of its peaks, and the stages of the
+    result, STAGES and the fit_<name> stages of its peaks.
+    """
+    timestamps = dict(fitResult)
+    peaks = fitResult.get('peaks',[])
+    starts = [fitResult.get('fitStart_%s' % name,np.nan) for name in peaks]
+    ends = [fitResult.get('fitEnd_%s' % name,np.nan) for name in peaks]
+    if starts and np.isfinite(starts).all() and np.isfinite(ends).all():
+        timestamps['fitStart'] = min(starts)
+        timestamps['fitEnd'] = max(ends)
+    stages = STAGES + tuple(("fit_%s" % name,"fitStart_%s" % name,"fitEnd_%s" % name) for name in peaks)
+    return timestamps, stages
+
+
+class LatencyStats(object):
+    def __init__(self,window=1000):
+        """
+        Keeps the durations of the last window frames for every stage.
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._durations = dict((name,np.zeros(self.window)) for name, start, end in STAGES)
+            self._counts = dict((name,0) for name, start, end in STAGES)
+            # STAGES, then the fit_<name> stages of the peaks as they show up
+            self._stageNames = [name for name, start, end in STAGES]
+
+    @property
+    def stageNames(self):
+        with self._lock:
+            return list(self._stageNames)
+
+    def record(self,fitResult,stageNames=None):
+        """
+        Records the duration of every stage of which both timestamps are in the
+        fit result (see stageTimestamps), or only of the stages in stageNames.
+        """
+        timestamps, stages = stageTimestamps(fitResult)
+        with self._lock:
+            for name, start, end in stages:
+                if stageNames is not None and name not in stageNames:
+                    continue
+                t0 = timestamps.get(start)
+                t1 = timestamps.get(end)
+                if t0 is None or t1 is None or not np.isfinite(t0) or not np.isfinite(t1):
+                    continue
+                if name not in self._durations:
+                    self._durations[name] = np.zeros(self.window)
+                    self._counts[name] = 0
+                    self._stageNames.append(name)
+                self._durations[name][self._counts[name] % self.window] = t1 - t0
+                self._counts[name] += 1
+
+    def getStats(self):
+        """
+        Returns a dict with the count, percentiles in seconds and histogram
+        (counts per bin of BIN_EDGES) of every stage that has been recorded,
+        in the order of stageNames.
+        """
+        stats = OrderedDict()
+        with self._lock:
+            for name in self._stageNames:
+                count = self._counts[name]
+                if count == 0:
+                    continue
+                durations = self._durations[name][:min(count,self.window)]
+                stats[name] = dict(count=count,
+                                   mean=durations.mean(),
+                                   p50=np.percentile(durations,50),
+                                   p90=np.percentile(durations,90),
+                                   p99=np.percentile(durations,99),
+                                   max=durations.max(),
+                                   histogram=np.histogram(durations,BIN_EDGES)[0].tolist())
+        return stats
+
+
+class SequenceGapDetector(object):
+    def __init__(self,maxGaps=100):
+        """
+        Follows the fit results in sequence order and counts:
+          - lost: sequence numbers without a result that the workers did not
+            report as skipped, i.e. results lost between worker and collector
+          - dropped: frames of the producer ('Frame Number' field) that never
+            got a sequence number, i.e. lost before the pipeline
+        The last maxGaps gaps are kept as (sequence, size, kind) tuples.
+        
+        Results from a pool of workers can report a skipped sequence number
+        after later results, so addSkipped is called when a result arrives and
+        push when it comes out of the ResultReorderBuffer.
+        """
+        self.maxGaps = maxGaps
+        self.reset()
+
+    def reset(self):
+        self._lastSequence = None
+        self._lastFrameNumber = None
+        self._restartSequence = None
+        self._skipped = set()
+        self.lost = 0
+        self.dropped = 0
+        self.gaps = []
+
+    def addSkipped(self,sequences):
+        self._skipped.update(sequences)
+
+    def restartAt(self,sequence):
+        """
+        Starts over at the result with this sequence number, the first one
+        since fitting was started again; the frames before it that came in
+        while the workers were idle are not counted as lost.
+        """
+        self._restartSequence = sequence
+
+    def push(self,result):
+        sequence = result['sequence']
+        frameNumber = result.get('frameNumber',-1)
+
+        if self._lastSequence is not None and sequence <= self._lastSequence:
+            # the pipeline was restarted
+            self._lastSequence = None
+            self._lastFrameNumber = None
+        if self._restartSequence is not None and sequence >= self._restartSequence:
+            self._lastSequence = None
+            self._lastFrameNumber = None
+            self._restartSequence = None
+            self._skipped = set(s for s in self._skipped if s > sequence)
+
+        if self._lastSequence is not None:
+            skipped = sum(1 for s in self._skipped if self._lastSequence < s < sequence)
+            missing = sequence - self._lastSequence - 1 - skipped
+            if missing > 0:
+                self.lost += missing
+                self._addGap(self._lastSequence+1,missing,"lost")
+            if frameNumber >= 0 and self._lastFrameNumber is not None:
+                dropped = (frameNumber - self._lastFrameNumber) - (sequence - self._lastSequence)
+                if dropped > 0:
+                    self.dropped += dropped
+                    self._addGap(sequence,dropped,"dropped")
+        self._skipped = set(s for s in self._skipped if s > sequence)
+
+        self._lastSequence = sequence
+        if frameNumber >= 0:
+            self._lastFrameNumber = frameNumber
+
+    def getStats(self):
+        return dict(lastSequence=self._lastSequence,
+                    lost=self.lost,
+                    dropped=self.dropped,
+                    gaps=list(self.gaps))
+
+    def _addGap(self,sequence,size,kind):
+        self.gaps.append((sequence,size,kind))
+        del self.gaps[:-self.maxGaps]
@@ -1,15 +1,11 @@
 import zmq
-import msgpack as msg
-import msgpack_numpy
-msgpack_numpy.patch()
 from pyqtgraph import QtCore, QtGui
 from threading import Thread
 import time
 import sys
 import numpy as np
 
-
-app = QtGui.QApplication(sys.argv)
+from profileClient import ProfileClient
 
 
 class EmittingLVODMClient(QtCore.QObject):
@@ -24,6 +20,8 @@ class EmittingLVODMClient(QtCore.QObject):
             
     def abort(self):
         self.consumer.abort()
+        # the consumer closes the socket when it stops
+        self.consumer.wait()
         self.context.destroy()
     
     def connect(self,host):
@@ -53,55 +51,66 @@ class ProcessingLVODMClient(EmittingLVODMClient):
         self.messageProcessed.emit(resultDict)
 
 
+class RingLVODMClient(EmittingLVODMClient):
+    def __init__(self,ringPath):
+        """
+        Client for the notifications of a ProfileIngestService, the profiles are
+        read from the ring buffer at ringPath.
+        """
+        EmittingLVODMClient.__init__(self)
+        self.consumer = RingSocketConsumer(self.socket,ringPath)
+
+
 
 class EmittingSocketConsumer(QtCore.QThread):
     messageReceived = QtCore.Signal(dict)
     
-    def __init__(self,socket):
+    def __init__(self,socket,maxQueue=16,dropPolicy="oldest",ringPath=None):
+        """
+        Emits the frames of a ProfileClient on socket as messageReceived
+        signals, from its own thread.
+        """
         QtCore.QThread.__init__(self)        
-        self.socket = socket
-        self.abortRequested = False
+        self.client = ProfileClient(maxQueue=maxQueue,dropPolicy=dropPolicy,ringPath=ringPath,socket=socket)
     
     def abort(self):
-        self.abortRequested = True
+        self.client.abort()
 
     def run(self):
-        while not self.abortRequested:
-            messageBytes = self.socket.recv()
-            messageDict = msg.unpackb(messageBytes)
+        for messageDict in self.client:
             self.messageReceived.emit(messageDict)
-        self.socket.close()
-        self.terminate()
-        
+        self.client.close()
+
+
+class RingSocketConsumer(EmittingSocketConsumer):
+    def __init__(self,socket,ringPath):
+        """
+        Receives slot notifications and reads the profiles from the ring buffer
+        at ringPath. Only the newest queued notification is used, a display has
+        no use for the others.
+        """
+        EmittingSocketConsumer.__init__(self,socket,maxQueue=1,dropPolicy="oldest",ringPath=ringPath)
             
 
-class ProcessingSocketConsumer(QtCore.QThread):
-    messageReceived = QtCore.Signal(dict)
+class ProcessingSocketConsumer(EmittingSocketConsumer):
     messageProcessed = QtCore.Signal(dict)
     
     def __init__(self,socket,processingAction):
-        QtCore.QThread.__init__(self)        
-        self.socket = socket
-        self.abortRequested = False
+        EmittingSocketConsumer.__init__(self,socket)
         self.processingAction = processingAction
     
-    def abort(self):
-        self.abortRequested = True    
-    
     def run(self):
-        while not self.abortRequested:
-            messageBytes = self.socket.recv()
-            messageDict = msg.unpackb(messageBytes)
+        for messageDict in self.client:
             self.messageReceived.emit(messageDict)
             result = self.processingAction(messageDict)
             self.messageProcessed.emit(result)
-        self.socket.close()
-        self.terminate()
+        self.client.close()
 
 
 
 
 if __name__=="__main__":
+    app = QtGui.QApplication(sys.argv)
     
     def printMessageKeys(messageDict):
         print messageDict.keys()
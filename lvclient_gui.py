@@ -1,576 +1,77 @@
 # -*- coding: utf-8 -*-
 """
-Demonstrates use of PlotWidget class. This is little more than a 
-GraphicsView with a PlotItem placed in its center.
-"""
-
-
-import PyQt4.QtCore as q
-import PyQt4.QtGui as qt
-
-import numpy as np
-import pyqtgraph as pg
-import pyqtgraph.dockarea as dock
-
-import zmq
-import msgpack as msg
-import msgpack_numpy
-msgpack_numpy.patch()
-from lvclient import EmittingLVODMClient,ProcessingLVODMClient
+Starts the interactive odm gui (see odmGui).
 
-import odmanalysis as odm
-from odmanalysis import fitfunctions
+This script imports nothing heavy at module level on purpose. Where
+multiprocessing spawns its processes, as on Windows, every fit worker starts a
+new interpreter that imports the main script again, as __parents_main__, so
+everything imported here would be imported by every worker as well. The gui,
+Qt, pyqtgraph, scipy and odmanalysis are only imported once the script runs as
+__main__.
 
-import time
-
-from scipy.optimize import curve_fit
-
-from CurveFitService import CurveFitServiceController, CurveFitServiceCollector
+usage: python lvclient_gui.py [--port 4562] [--workers 1] ...
+"""
 
 import argparse
 
-class MeanRecorder(q.QObject):
-    def __init__(self):
-        q.QObject.__init__(self)
-        self.profile = None
-        self.n = 0.0
-    
-    def reset(self):
-        self.profile = None
-        self.n = 0.0
-        
-    def record(self,profile):
-        if self.n > 0:
-            self.n+=1
-            self.profile = profile/self.n + self.profile * (self.n-1)/self.n
-        elif self.n == 0:
-            self.n += 1
-            self.profile = profile
-        else:
-            pass
-
-
-class SplineCreatorState(q.QObject):
-    pass
-
-class SplineCreatorWidget(qt.QWidget):
-    movingPeakIntervalChanged = q.Signal(tuple)
-    referencePeakIntervalChanged = q.Signal(tuple)
-    movingPeakFitFunctionChanged = q.Signal(fitfunctions.ScaledSpline)
-    referencePeakFitFunctionChanged = q.Signal(fitfunctions.ScaledSpline)
-    
-    def __init__(self,parent=None):        
-        qt.QWidget.__init__(self,parent)
-        
-        self.isRecording = False        
-        
-        layout = qt.QVBoxLayout()
-        self.setLayout(layout)
-        
-        buttonStrip = qt.QHBoxLayout()
-        
-        self.startRecordingButton = qt.QPushButton("start recording",self)
-        self.startRecordingButton.setIcon(qt.QIcon(qt.QStyle.SP_MediaPlay))
-        self.startRecordingButton.setIconSize(q.QSize(24,24))
-        buttonStrip.addWidget(self.startRecordingButton)
-        
-        self.stopRecordingButton = qt.QPushButton("stop recording",self)
-        self.stopRecordingButton.setIcon(qt.QIcon(qt.QStyle.SP_MediaStop))
-        self.stopRecordingButton.setIconSize(q.QSize(24,24))
-        buttonStrip.addWidget(self.stopRecordingButton)
-        
-        layout.addLayout(buttonStrip)
-        
-        self.plotWidget = pg.PlotWidget(name='Intensity Profile',parent=self)
-        layout.addWidget(self.plotWidget)
-        
-        self.meanRecorder = MeanRecorder()
-        
-        self.refPeakSplineControl = InteractiveSplineCreatorControlsWidget(self.meanRecorder,parent=self)
-        self.movingPeakSplineControl = InteractiveSplineCreatorControlsWidget(self.meanRecorder,parent=self)
-        
-        hLayout = qt.QHBoxLayout()
-        hLayout.addWidget(self.refPeakSplineControl)
-        hLayout.addWidget(self.movingPeakSplineControl)
-        hLayout.addStretch()
-        layout.addLayout(hLayout)
-        
-        pw = self.plotWidget
-        self.livePlot = pw.plot()
-        self.livePlot.setPen((200,200,100))
-        
-        self.meanPlot = pw.plot()
-        self.meanPlot.setPen((100,200,200))
-        
-        pw.setLabel('left', 'Intensity', units='a.u.')
-        pw.setLabel('bottom', 'Position', units='px')
-        pw.setXRange(0, 200)
-        pw.setYRange(0, 10000)
-        
-        self.movingPeakRegion = pg.LinearRegionItem(brush=pg.intColor(1,alpha=100))
-        self.movingPeakRegion.setZValue(10)
-        self.movingPeakRegionLabel = pg.TextItem("moving peak",color=pg.intColor(1),
-                                                 anchor=(0,1))
-        self.movingPeakRegionLabel.setX(self.movingPeakRegion.getRegion()[0])
-        pw.addItem(self.movingPeakRegionLabel)                
-        pw.addItem(self.movingPeakRegion, ignoreBounds=True)
-        
-        self.referencePeakRegion = pg.LinearRegionItem(brush=pg.intColor(2,alpha=100))
-        self.referencePeakRegion.setZValue(10)
-        self.referencePeakRegionLabel = pg.TextItem("reference peak",color=pg.intColor(2),
-                                                 anchor=(0,2))
-        self.referencePeakRegionLabel.setX(self.referencePeakRegion.getRegion()[0])
-        pw.addItem(self.referencePeakRegionLabel)
-        pw.addItem(self.referencePeakRegion, ignoreBounds=True)
-        
-        
-        
-        pw.setAutoVisible(y=True)
-        
-        
-        # connect signals and slots
-        self.startRecordingButton.clicked.connect(self._startRecording)
-        self.stopRecordingButton.clicked.connect(self._stopRecording)
-        
-        self.referencePeakRegion.sigRegionChangeFinished.connect(self._emitReferencePeakIntervalChanged)
-        self.movingPeakRegion.sigRegionChangeFinished.connect(self._emitMovingPeakIntervalChanged)
-        self.referencePeakRegion.sigRegionChanged.connect(lambda r: self.referencePeakRegionLabel.setX(r.getRegion()[0]))        
-        self.movingPeakRegion.sigRegionChanged.connect(lambda r: self.movingPeakRegionLabel.setX(r.getRegion()[0]))        
-        
-        
-        self.refPeakSplineControl.splineCreator.fitFunctionCreated.connect(self._emitReferencePeakFitFunctionChanged)
-        self.movingPeakSplineControl.splineCreator.fitFunctionCreated.connect(self._emitMovingPeakFitFunctionChanged)
-        
-        
-    def _startRecording(self):
-        self.isRecording = True
-        self.meanRecorder.reset()
-    
-    def _stopRecording(self):
-        self.isRecording = False
-        
-    def _emitReferencePeakIntervalChanged(self):
-        interval = self.referencePeakRegion.getRegion()
-        self.referencePeakIntervalChanged.emit(interval)
-            
-    def _emitMovingPeakIntervalChanged(self):
-        interval = self.movingPeakRegion.getRegion()        
-        self.movingPeakIntervalChanged.emit(interval)
-    
-    def _emitMovingPeakFitFunctionChanged(self,spline):
-        self.movingPeakFitFunctionChanged.emit(spline)
-        
-    def _emitReferencePeakFitFunctionChanged(self,spline):
-        self.referencePeakFitFunctionChanged.emit(spline)
-        
-    
-    def updateData(self, intensityProfile):
-        length = len(intensityProfile)
-        xValues = np.arange(0,length)
-        
-        if self.isRecording:
-            if (self.meanRecorder.profile is not None and len(self.meanRecorder.profile) != length):
-                self.meanRecorder.reset()
-            self.meanRecorder.record(intensityProfile)        
-        
-        self.livePlot.setData(y=intensityProfile, x=xValues)
-        self.meanPlot.setData(y=self.meanRecorder.profile, x=xValues)
-            
-        
-        
-
 
-class FitGraphWidget(qt.QWidget):
-    def __init__(self,parent=None):        
-        qt.QWidget.__init__(self,parent)
-        
-        layout = qt.QVBoxLayout()
-        self.setLayout(layout)
-        
-        
-        self.plotWidget = pg.PlotWidget(name='Fit')
-        layout.addWidget(self.plotWidget)
-                
-        self.__initializePlots()
-        
-        
-    def __initializePlots(self):
-        pw = self.plotWidget
-        self.livePlot = pw.plot()
-        self.livePlot.setPen((200,200,100))
-        
-        self.movingPeakFitPlot = pw.plot()
-        self.movingPeakFitPlot.setPen((200,0,0))
-        self.referencePeakFitPlot = pw.plot()
-        self.referencePeakFitPlot.setPen((0,200,0))
-        self.xValues = None
-        
-        pw.setLabel('left', 'Intensity', units='a.u.')
-        pw.setLabel('bottom', 'Position', units='px')
-        pw.setXRange(0, 200)
-        pw.setYRange(0, 10000)
-        
-        pw.setAutoVisible(y=True)
-    
-    def updateIntensityProfile(self, intensityProfile):
-        xValues = np.arange(0,len(intensityProfile))
-        self.xValues = xValues
-        self.livePlot.setData(y=intensityProfile, x=xValues)
-        
-    def updateGraphData(self, fitFunction_mp, popt_mp, fitFunction_ref,popt_ref):
-        self.movingPeakFitPlot.setData(x=self.xValues,y=fitFunction_mp(self.xValues,*popt_mp))
-        
-        self.referencePeakFitPlot.setData(x=self.xValues,y=fitFunction_ref(self.xValues,*popt_ref))
-    
-class RollingChartWidget(qt.QWidget):
-    def __init__(self,parent=None):
-        qt.QWidget.__init__(self,parent)
-        
-        self.initializeBuffer(5000)
-        
-        layout = qt.QVBoxLayout()
-        self.setLayout(layout)
-        
-        self.plotWidget = pg.PlotWidget()
-        self.livePlot = self.plotWidget.plot()
-        self.livePlot.setPen((200,200,100))
-        layout.addWidget(self.plotWidget)
-        
-    def initializeBuffer(self,size):
-        self._xBuffer = np.empty(size)   
-        self._yBuffer = np.empty(size)
-        self._xBuffer.fill(np.NAN)
-        self._yBuffer.fill(np.NAN)
-        self._bufferSize = size
-        self._bufferPointer = 0
-    
-    @property
-    def bufferSize(self):
-        return self._bufferSize
-        
-    @bufferSize.setter
-    def setBufferSize(self,size):
-        self._initializeBuffer(size)
-        
-    def addData(self,y):
-        i = self._bufferPointer % self._bufferSize
-        self._yBuffer[i] = y
-        self.livePlot.setData(y=self._yBuffer)
-        self._bufferPointer += 1
-            
-    
-
-class LVStatusDisplayWidget(qt.QWidget):
-    def __init__(self,parent=None):
-        qt.QWidget.__init__(self,parent)
-        
-        layout = qt.QGridLayout()
-        self.setLayout(layout)
-        
-        layout.addWidget(qt.QLabel("Labview Status:"),0,0)       
-
-        self.lvStatusLabel = qt.QLabel("")        
-        layout.addWidget(self.lvStatusLabel,0,1)
-        
-        
-    
-    def updateStatus(self,status):
-        if not status == self.lvStatusLabel.text:
-            self.lvStatusLabel.setText(status)
-
-
-
-        
-
-class InteractiveSplineCreator(q.QObject):
-    
-    fitFunctionCreated = q.Signal(fitfunctions.ScaledSpline)
-    
-    def __init__(self):
-        q.QObject.__init__(self)
-        
-        self._fitFunction = None
-        self._sigma = 0
-        self._intensityProfile = None
-    
-    @property
-    def intensityProfile(self):
-        return self._intensityProfile
-    
-    
-    def setIntensityProfile(self,intensityProfile):
-        self._intensityProfile = intensityProfile
-    
-    @property
-    def sigma(self):
-        return self._sigma
-        
-        
-    def setSigma(self,sigma):
-        self._sigma = sigma
-        
-    
-    def hasFitFunction(self):
-        return self._fitFunction is not None
-    
-    @property
-    def fitFunction(self):
-        return self._fitFunction
-    
-    def createSpline(self):
-        spline = fitfunctions.ScaledSpline()
-        spline.estimateInitialParameters(self.intensityProfile,
-                                         filter_sigma=self.sigma)
-        
-        self._fitFunction = spline
-        self.fitFunctionCreated.emit(spline)
-        
-
-class InteractiveSplineCreatorControlsWidget(qt.QWidget):
-    def __init__(self,meanRecorder, parent=None):
-        qt.QWidget.__init__(self,parent)
-        
-        layout=qt.QGridLayout()
-        self.setLayout(layout)        
-        
-        layout.addWidget(qt.QLabel("Gaussian filter sigma:"),0,0)
-
-        self.sigmaSpinBox = qt.QSpinBox()  
-        self.sigmaSpinBox.setMinimum(0)
-        self.sigmaSpinBox.setMaximum(10)
-        layout.addWidget(self.sigmaSpinBox,0,1)
-        
-        self.makeFitFunctionButton = qt.QPushButton("Create")
-        layout.addWidget(self.makeFitFunctionButton,1,0)
-        
-        self.splineCreator = InteractiveSplineCreator()        
-        self.meanRecorder = meanRecorder
-        
-        # connect signals and slots
-        self.sigmaSpinBox.valueChanged.connect(self.splineCreator.setSigma)
-        self.makeFitFunctionButton.clicked.connect(self.createSpline)
-    
-    def createSpline(self):
-        self.splineCreator.setIntensityProfile(self.meanRecorder.profile)
-        self.splineCreator.createSpline()
-        
-        
-class RealTimeFitter(q.QObject):
-    def __init__(self,parent=None):
-        q.QObject.__init__(self,parent)
-        
-        self._refFitFunction = None
-        self._mpFitFunction = None
-        self._xminRef = None
-        self._xmaxRef = None
-        self._xminMp = None
-        self._xmaxMp = None
-        self._refEstimates = [0.0,1.0,0.0]
-        self._mpEstimates = [0.0,1.0,0.0]
-        
-    @property        
-    def canFit(self):
-        return self._mpFitFunction is not None and self._xminRef is not None and self._xmaxRef is not None and self._xminMp is not None and self._xmaxMp is not None
-    
-    def fit(self,intensityProfile):
-        if self.canFit:
-            try:
-                displacement_mp, popt_mp = self._getMovingPeakDisplacement(intensityProfile)
-                displacement_ref, popt_ref = self._getReferencePeakDisplacement(intensityProfile)
-                return dict(displacement_mp=displacement_mp,
-                            displacement_ref=displacement_ref,
-                            popt_mp=popt_mp,
-                            popt_ref=popt_ref,
-                            fitFunction_mp=self._mpFitFunction,
-                            fitFunction_ref=self._refFitFunction)
-            except Exception as e:
-                print e
-        else:
-            return dict()
-    
-    def _getMovingPeakDisplacement(self,intensityProfile):
-        xdata = np.arange(len(intensityProfile))[self._xminMp:self._xmaxMp]
-        ydata = intensityProfile[self._xminMp:self._xmaxMp]
-        
-        popt,pcov = curve_fit(self._mpFitFunction,xdata,ydata,p0=self._mpEstimates)
-        self._mpEstimates = popt
-        return self._mpFitFunction.getDisplacement(*popt), popt
-        
-    def _getReferencePeakDisplacement(self,intensityProfile):
-        xdata = np.arange(len(intensityProfile))[self._xminRef:self._xmaxRef]
-        ydata = intensityProfile[self._xminRef:self._xmaxRef]
-        
-        popt,pcov = curve_fit(self._refFitFunction,xdata,ydata,p0=self._refEstimates)
-        self._refEstimates = popt
-        return self._refFitFunction.getDisplacement(*popt), popt
-    
-    
-    
-    def setReferencePeakFitFunction(self,fitFunction):
-        print "ref. fitfunction: %s" % fitFunction
-        self._refFitFunction = fitFunction
-        
-    def setReferencePeakInterval(self,interval):
-        print interval
-        self._xmaxRef = int(max(interval))
-        self._xminRef = int(min(interval))
-
-    def setMovingPeakInterval(self,interval):
-        print interval
-        self._xmaxMp = int(max(interval))
-        self._xminMp = int(min(interval))
-
-        
-    def setMovingPeakFitFunction(self,fitFunction):
-        print "mp. fitfunction: %s" % fitFunction
-        self._mpFitFunction = fitFunction
-        
-        
-    def reset(self):
-        """
-        Resets the stored curve-fit estimates to the default values.
-        """
-        pass
-        
-
-class FitControlWidget(qt.QWidget):
-    def __init__(self,parent=None):
-        qt.QWidget.__init__(self,parent)
-        
-        layout = qt.QHBoxLayout()
-        self.setLayout(layout)
-        
-        self.startButton = qt.QPushButton("start fit")
-        layout.addWidget(self.startButton)
-        
-        self.stopButton = qt.QPushButton("stop fit")
-        layout.addWidget(self.stopButton)
-        
-
-
-class MainWindow(qt.QMainWindow):
-    def __init__(self, parent=None, lvport=4562):
-        qt.QMainWindow.__init__(self,parent)
-        
-        self._lvAddress = r"tcp://localhost:%i" % lvport
-        
-        self.setWindowTitle("Live ODM Analysis")
-        self.resize(1000,800)
-        
-        area=dock.DockArea()
-        self.dockArea = area
-        self.setCentralWidget(area)
-        
-        d1 = dock.Dock("Spline Creator", size=(500, 500))     ## give this dock the minimum possible size
-        d2 = dock.Dock("LabView Status", size=(1,100))
-        d3 = dock.Dock("Fit result", size=(500,400))
-        d4 = dock.Dock("Displacement", size=(500,200))
-        d5 = dock.Dock("Fit Controls", size=(1,100))
-        
-        area.addDock(d1, 'left')      ## place d1 at left edge of dock area (it will fill the whole space since there are no other docks yet)
-        area.addDock(d2, 'bottom', d1)     ## place d2 at right edge of dock area
-        area.addDock(d3, 'bottom', d2)## place d3 at bottom edge of d1
-        area.addDock(d4, 'right')     ## place d4 at right edge of dock area
-        area.addDock(d5, 'bottom', d2)        
-        
-        self.splineCreatorWidget = SplineCreatorWidget(self)
-        d1.addWidget(self.splineCreatorWidget)        
-        
-        self.lvStatusDisplay = LVStatusDisplayWidget(self)
-        hLayout = qt.QHBoxLayout()
-        hLayout.addWidget(self.lvStatusDisplay)
-        hLayout.addStretch()
-        w2 = qt.QWidget()
-        w2.setLayout(hLayout)        
-        d2.addWidget(w2)
-        
-        
-        self.fitGraph = FitGraphWidget(self)
-        d3.addWidget(self.fitGraph)
-
-                
-        self.displacementChart = RollingChartWidget()
-        d4.addWidget(self.displacementChart)
-        
-        self.fitControls = FitControlWidget(self)
-        d5.addWidget(self.fitControls)
-        
-        self.lvClient = EmittingLVODMClient()
-        self.lvClient.connect(self._lvAddress)
-        
-        #self.fitClient = ProcessingLVODMClient(lambda d: self.fitter.fit(d['Intensity Profile']))
-        #self.fitClient.connect("tcp://localhost:4562")
-        self.fitCollectorThread = CurveFitServiceCollector()
-        self.fitServiceController = CurveFitServiceController(producerAddress=self._lvAddress,
-                                                              collectorAddress=self.fitCollectorThread.address)
-        
-        # connect signals and slots        
-        self.lvClient.messageReceived.connect(self.handleLVData)
-        self.fitCollectorThread.resultReceived.connect(self.handleFitResult)
-                
-        self.splineCreatorWidget.referencePeakIntervalChanged.connect(self.fitServiceController.setReferencePeakInterval)
-        self.splineCreatorWidget.movingPeakIntervalChanged.connect(self.fitServiceController.setMovingPeakInterval)
-        
-        self.splineCreatorWidget.movingPeakFitFunctionChanged.connect(self.fitServiceController.setMovingPeakFitFunction)
-        self.splineCreatorWidget.referencePeakFitFunctionChanged.connect(self.fitServiceController.setReferencePeakFitFunction)
-        
-        self.fitControls.startButton.clicked.connect(self.fitServiceController.startFitting)
-        self.fitControls.stopButton.clicked.connect(self.fitServiceController.stopFitting)
-        
-        
-    def handleLVData(self,lvData):
-        status = lvData['Measurement Process State']
-        intensityProfile = np.array(lvData['Intensity Profile'])
-        
-        self.splineCreatorWidget.updateData(intensityProfile)
-        self.fitGraph.updateIntensityProfile(intensityProfile)
-        self.lvStatusDisplay.updateStatus(status)
-    
-    def handleFitResult(self,fitResult):
-        if fitResult is not None and len(fitResult) != 0:
-            
-            self.fitGraph.updateGraphData(fitFunction_mp=fitResult['fitFunction_mp'],
-                                          fitFunction_ref=fitResult['fitFunction_ref'],
-                                          popt_mp=fitResult['popt_mp'],
-                                          popt_ref=fitResult['popt_ref'])
-            self.displacementChart.addData(y=fitResult['displacement_mp']-fitResult['displacement_ref'])                                  
-    
-    def show(self):
-        super(MainWindow,self).show()
-        self.lvClient.startAsync()
-        self.fitCollectorThread.start()
-
-    def closeEvent(self,event):
-        self._abortClients()
-        qt.QWidget.closeEvent(self,event)        
-        
-    
-    def _abortClients(self):
-        print "aborting"
-        self.lvClient.abort()
-        self.fitServiceController.abort()
-        self.fitCollectorThread.abort()
-    
-
-    
-
-## Start Qt event loop unless running in interactive mode or using pyside.
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Interactive odm gui")
     parser.add_argument('--port','-p',
                         type=int,
                         help="Localhost port of the labview odm measurement process.",
                         default=4562)
+    parser.add_argument('--workers','-w',
+                        type=int,
+                        help="Number of curve-fit worker processes.",
+                        default=1)
+    parser.add_argument('--frame-policy',
+                        choices=["every","latest","nth"],
+                        help="Which lvdata messages are fitted: every message, only the latest one or every n-th message.",
+                        default="every")
+    parser.add_argument('--frame-interval','-n',
+                        type=int,
+                        help="n for the 'nth' frame policy.",
+                        default=1)
+    parser.add_argument('--spline-tolerance',
+                        type=float,
+                        help="Evaluate the fit functions with lookup tables of this relative accuracy (e.g. 1e-6) instead of the splines.",
+                        default=None)
+    parser.add_argument('--track-width',
+                        type=int,
+                        help="Fit the moving peak over a window of this many pixels that follows the peak, instead of over the whole interval.",
+                        default=None)
+    parser.add_argument('--no-prediction',
+                        action='store_true',
+                        help="Start every fit from the last fitted parameters instead of extrapolated ones.")
+    parser.add_argument('--threads',
+                        type=int,
+                        help="Number of threads per fit worker that fit the peaks of a frame concurrently.",
+                        default=1)
+    parser.add_argument('--pair',
+                        help="Peaks whose displacement difference is charted, e.g. mp,ref; a single peak charts its displacement.",
+                        default="mp,ref")
+    parser.add_argument('--refresh-rate',
+                        type=float,
+                        help="Rate [Hz] at which the plots are redrawn.",
+                        default=25)
+    parser.add_argument('--record',
+                        metavar='DIRECTORY',
+                        help="Record the profiles and fit results to a capture in DIRECTORY.",
+                        default=None)
+    parser.add_argument('--shared-memory',
+                        action='store_true',
+                        help="Decode the lvdata once and share the profiles with the fit workers through a ring buffer.")
+    parser.add_argument('--batch-results',
+                        action='store_true',
+                        help="Hand the fit results to the gui in batches, one signal per batch instead of one per result.")
     args = parser.parse_args()
     
+    from curveFitService import PrespawnedWorkers
     
-    #QtGui.QApplication.setGraphicsSystem('raster')
-    app = qt.QApplication([])
-    print args
-    mw = MainWindow(lvport=args.port)
-    mw.show()
-
-    import sys
-    if (sys.flags.interactive != 1) or not hasattr(q, 'PYQT_VERSION'):
-        
-        qt.QApplication.instance().exec_()
\ No newline at end of file
+    # start the fit workers (and the frame distributor) before the gui is
+    # imported and before there is a QApplication for them to inherit
+    workers = PrespawnedWorkers(args.workers + 1 if args.workers > 1 else 1)
+    
+    import odmGui
+    app, mw = odmGui.run(args,workers)
@@ -1,9 +1,7 @@
 import zmq
-from time import sleep
-import msgpack as msg
-import msgpack_numpy
-msgpack_numpy.patch()
+from time import sleep, time
 import numpy as np
+from profileMessage import packProfileMessage
 
 context = zmq.Context()
 socket = context.socket(zmq.PUB)
@@ -32,8 +30,9 @@ while True:
 
     messageDict['Intensity Profile'] = ip
     messageDict['Actuator Voltage'] = actuatorVoltage
-    messageBytes = msg.packb(messageDict)
-    socket.send(messageBytes)
+    messageDict['Frame Number'] = i
+    messageDict['Send Time'] = time()
+    socket.send_multipart(packProfileMessage(messageDict),copy=False)
     sleep(0.008)
     i+=1
     
\ No newline at end of file
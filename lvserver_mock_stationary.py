@@ -1,10 +1,8 @@
 import zmq
 from random import randrange
-from time import sleep
-import msgpack as msg
-import msgpack_numpy
-msgpack_numpy.patch()
+from time import sleep, time
 import numpy as np
+from profileMessage import packProfileMessage
 
 context = zmq.Context()
 socket = context.socket(zmq.PUB)
@@ -29,8 +27,9 @@ while True:
 
     messageDict['Intensity Profile'] = ip
     messageDict['Actuator Voltage'] = 0.0
-    messageBytes = msg.packb(messageDict)
-    socket.send(messageBytes)
+    messageDict['Frame Number'] = i
+    messageDict['Send Time'] = time()
+    socket.send_multipart(packProfileMessage(messageDict),copy=False)
     sleep(0.02)
     i+=1
     
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""
+Re-publishes a capture recorded with profileCapture on the lvdata port, like
+lvserver_mock_measurement.py does with generated profiles.
+
+usage: python lvserver_replay.py capturedir [--port 4562] [--speed 1.0] [--fast] [--loop]
+"""
+
+import zmq
+import time
+import argparse
+from profileMessage import packProfileMessage
+from profileCapture import Capture
+
+
+def replay(socket,capture,speed=1.0,fast=False):
+    """
+    Sends all profiles of capture, at the original timing divided by speed, or
+    as fast as possible.
+    """
+    startTime = time.time()
+    firstTimestamp = None
+    for frameNumber, (timestamp, messageDict) in enumerate(capture.iterFrames()):
+        if firstTimestamp is None:
+            firstTimestamp = timestamp
+        if not fast:
+            delay = startTime + (timestamp - firstTimestamp) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        # keep the recorded frame numbers, so that new fit results can be
+        # matched to the recorded ones
+        messageDict.setdefault('Frame Number',frameNumber)
+        messageDict['Send Time'] = time.time()
+        socket.send_multipart(packProfileMessage(messageDict),copy=False)
+    return time.time() - startTime
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay an lvdata capture")
+    parser.add_argument('capture',
+                        help="Capture directory.")
+    parser.add_argument('--port','-p',
+                        type=int,
+                        help="Port the profiles are published on.",
+                        default=4562)
+    parser.add_argument('--speed',
+                        type=float,
+                        help="Replay speed relative to the original timing.",
+                        default=1.0)
+    parser.add_argument('--fast',
+                        action='store_true',
+                        help="Send the profiles as fast as possible.")
+    parser.add_argument('--loop',
+                        action='store_true',
+                        help="Start over at the end of the capture.")
+    args = parser.parse_args()
+
+    capture = Capture(args.capture)
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    print socket.bind("tcp://*:%i" % args.port)
+    print 'replaying %i profiles at port %i' % (len(capture),args.port)
+
+    while True:
+        duration = replay(socket,capture,args.speed,args.fast)
+        print 'sent %i profiles in %.2f s' % (len(capture),duration)
+        if not args.loop:
+            break
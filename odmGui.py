@@ -0,0 +1,929 @@
+# -*- coding: utf-8 -*-
+"""
+Demonstrates use of PlotWidget class. This is little more than a 
+GraphicsView with a PlotItem placed in its center.
+"""
+
+
+import PyQt4.QtCore as q
+import PyQt4.QtGui as qt
+
+import numpy as np
+import pyqtgraph as pg
+import pyqtgraph.dockarea as dock
+
+import zmq
+import msgpack as msg
+import msgpack_numpy
+msgpack_numpy.patch()
+from lvclient import EmittingLVODMClient,ProcessingLVODMClient,RingLVODMClient
+from profileRing import ProfileIngestService
+from profileCapture import CaptureRecorderService
+from timeSeries import DecimatedTimeSeries
+from profileStatistics import ProfileStatistics
+from tabulatedFitFunction import TabulatedScaledSpline
+
+import odmanalysis as odm
+from odmanalysis import fitfunctions
+
+import time
+
+from scipy.optimize import curve_fit
+
+from splineModel import ScaledSplineModel
+
+from curveFitService import CurveFitServiceController
+from curveFitCollector import CurveFitServiceCollector
+
+class SplineCreatorState(q.QObject):
+    pass
+
+
+class CoalescingDisplay(q.QObject):
+    """
+    Keeps only the latest lvdata message and fit result and hands them to the
+    widgets on a fixed refresh timer, so that the number of repaints does not
+    depend on how fast the data comes in.
+    """
+    lvDataReady = q.Signal(dict)
+    fitResultReady = q.Signal(dict)
+    
+    def __init__(self,refreshRate=25,parent=None):
+        q.QObject.__init__(self,parent)
+        self._lvData = None
+        self._fitResult = None
+        self.timer = q.QTimer(self)
+        self.timer.timeout.connect(self._refresh)
+        self.setRefreshRate(refreshRate)
+    
+    def setRefreshRate(self,refreshRate):
+        self.timer.setInterval(int(round(1000.0/refreshRate)))
+    
+    def start(self):
+        self.timer.start()
+    
+    def stop(self):
+        self.timer.stop()
+    
+    def pushLVData(self,lvData):
+        self._lvData = lvData
+    
+    def pushFitResult(self,fitResult):
+        self._fitResult = fitResult
+    
+    def _refresh(self):
+        if self._lvData is not None:
+            lvData, self._lvData = self._lvData, None
+            self.lvDataReady.emit(lvData)
+        if self._fitResult is not None:
+            fitResult, self._fitResult = self._fitResult, None
+            self.fitResultReady.emit(fitResult)
+
+class SplineCreatorWidget(qt.QWidget):
+    movingPeakIntervalChanged = q.Signal(tuple)
+    referencePeakIntervalChanged = q.Signal(tuple)
+    movingPeakFitFunctionChanged = q.Signal(fitfunctions.ScaledSpline)
+    referencePeakFitFunctionChanged = q.Signal(fitfunctions.ScaledSpline)
+    sigmaChanged = q.Signal(object)
+    
+    def __init__(self,parent=None):        
+        qt.QWidget.__init__(self,parent)
+        
+        self.isRecording = False        
+        
+        layout = qt.QVBoxLayout()
+        self.setLayout(layout)
+        
+        buttonStrip = qt.QHBoxLayout()
+        
+        self.startRecordingButton = qt.QPushButton("start recording",self)
+        self.startRecordingButton.setIcon(qt.QIcon(qt.QStyle.SP_MediaPlay))
+        self.startRecordingButton.setIconSize(q.QSize(24,24))
+        buttonStrip.addWidget(self.startRecordingButton)
+        
+        self.stopRecordingButton = qt.QPushButton("stop recording",self)
+        self.stopRecordingButton.setIcon(qt.QIcon(qt.QStyle.SP_MediaStop))
+        self.stopRecordingButton.setIconSize(q.QSize(24,24))
+        buttonStrip.addWidget(self.stopRecordingButton)
+        
+        layout.addLayout(buttonStrip)
+        
+        self.plotWidget = pg.PlotWidget(name='Intensity Profile',parent=self)
+        layout.addWidget(self.plotWidget)
+        
+        self.profileStatistics = ProfileStatistics()
+        
+        self.refPeakSplineControl = InteractiveSplineCreatorControlsWidget(self.profileStatistics,parent=self)
+        self.movingPeakSplineControl = InteractiveSplineCreatorControlsWidget(self.profileStatistics,parent=self)
+        
+        hLayout = qt.QHBoxLayout()
+        hLayout.addWidget(self.refPeakSplineControl)
+        hLayout.addWidget(self.movingPeakSplineControl)
+        hLayout.addStretch()
+        layout.addLayout(hLayout)
+        
+        pw = self.plotWidget
+        self.livePlot = pw.plot()
+        self.livePlot.setPen((200,200,100))
+        
+        self.meanPlot = pw.plot()
+        self.meanPlot.setPen((100,200,200))
+        
+        pw.setLabel('left', 'Intensity', units='a.u.')
+        pw.setLabel('bottom', 'Position', units='px')
+        pw.setXRange(0, 200)
+        pw.setYRange(0, 10000)
+        
+        self.movingPeakRegion = pg.LinearRegionItem(brush=pg.intColor(1,alpha=100))
+        self.movingPeakRegion.setZValue(10)
+        self.movingPeakRegionLabel = pg.TextItem("moving peak",color=pg.intColor(1),
+                                                 anchor=(0,1))
+        self.movingPeakRegionLabel.setX(self.movingPeakRegion.getRegion()[0])
+        pw.addItem(self.movingPeakRegionLabel)                
+        pw.addItem(self.movingPeakRegion, ignoreBounds=True)
+        
+        self.referencePeakRegion = pg.LinearRegionItem(brush=pg.intColor(2,alpha=100))
+        self.referencePeakRegion.setZValue(10)
+        self.referencePeakRegionLabel = pg.TextItem("reference peak",color=pg.intColor(2),
+                                                 anchor=(0,2))
+        self.referencePeakRegionLabel.setX(self.referencePeakRegion.getRegion()[0])
+        pw.addItem(self.referencePeakRegionLabel)
+        pw.addItem(self.referencePeakRegion, ignoreBounds=True)
+        
+        
+        
+        pw.setAutoVisible(y=True)
+        
+        
+        # connect signals and slots
+        self.startRecordingButton.clicked.connect(self._startRecording)
+        self.stopRecordingButton.clicked.connect(self._stopRecording)
+        
+        self.referencePeakRegion.sigRegionChangeFinished.connect(self._emitReferencePeakIntervalChanged)
+        self.movingPeakRegion.sigRegionChangeFinished.connect(self._emitMovingPeakIntervalChanged)
+        self.referencePeakRegion.sigRegionChanged.connect(lambda r: self.referencePeakRegionLabel.setX(r.getRegion()[0]))        
+        self.movingPeakRegion.sigRegionChanged.connect(lambda r: self.movingPeakRegionLabel.setX(r.getRegion()[0]))        
+        
+        
+        self.refPeakSplineControl.splineCreator.fitFunctionCreated.connect(self._emitReferencePeakFitFunctionChanged)
+        self.movingPeakSplineControl.splineCreator.fitFunctionCreated.connect(self._emitMovingPeakFitFunctionChanged)
+        
+        
+    def _startRecording(self):
+        self.isRecording = True
+        self.profileStatistics.reset()
+    
+    def _stopRecording(self):
+        self.isRecording = False
+        
+    def _emitReferencePeakIntervalChanged(self):
+        interval = self.referencePeakRegion.getRegion()
+        self.referencePeakIntervalChanged.emit(interval)
+            
+    def _emitMovingPeakIntervalChanged(self):
+        interval = self.movingPeakRegion.getRegion()        
+        self.movingPeakIntervalChanged.emit(interval)
+    
+    def _emitMovingPeakFitFunctionChanged(self,spline):
+        self.movingPeakFitFunctionChanged.emit(spline)
+        self._emitSigmaChanged()
+        
+    def _emitReferencePeakFitFunctionChanged(self,spline):
+        self.referencePeakFitFunctionChanged.emit(spline)
+        self._emitSigmaChanged()
+    
+    def _emitSigmaChanged(self):
+        # the noise of the recorded profiles weights the fits with the new spline
+        sigma = self.profileStatistics.sigma
+        self.sigmaChanged.emit(sigma.copy() if sigma is not None else None)
+        
+    
+    def recordProfile(self, intensityProfile):
+        """
+        Adds a profile to the statistics while recording. Call this for every
+        message; updateData only draws, at the refresh rate.
+        """
+        if self.isRecording:
+            self.profileStatistics.record(intensityProfile)
+    
+    def updateData(self, intensityProfile):
+        length = len(intensityProfile)
+        xValues = np.arange(0,length)
+        
+        self.livePlot.setData(y=intensityProfile, x=xValues)
+        self.meanPlot.setData(y=self.profileStatistics.profile, x=xValues)
+            
+        
+        
+
+
+class FitGraphWidget(qt.QWidget):
+    def __init__(self,parent=None):        
+        qt.QWidget.__init__(self,parent)
+        
+        layout = qt.QVBoxLayout()
+        self.setLayout(layout)
+        
+        
+        self.plotWidget = pg.PlotWidget(name='Fit')
+        layout.addWidget(self.plotWidget)
+                
+        self.__initializePlots()
+        
+        
+    def __initializePlots(self):
+        pw = self.plotWidget
+        self.livePlot = pw.plot()
+        self.livePlot.setPen((200,200,100))
+        
+        self.movingPeakFitPlot = pw.plot()
+        self.movingPeakFitPlot.setPen((200,0,0))
+        self.referencePeakFitPlot = pw.plot()
+        self.referencePeakFitPlot.setPen((0,200,0))
+        # one plot per peak, more are added when other peaks show up
+        self.fitPlots = dict(mp=self.movingPeakFitPlot,ref=self.referencePeakFitPlot)
+        self.xValues = None
+        
+        pw.setLabel('left', 'Intensity', units='a.u.')
+        pw.setLabel('bottom', 'Position', units='px')
+        pw.setXRange(0, 200)
+        pw.setYRange(0, 10000)
+        
+        pw.setAutoVisible(y=True)
+    
+    def updateIntensityProfile(self, intensityProfile):
+        xValues = np.arange(0,len(intensityProfile))
+        self.xValues = xValues
+        self.livePlot.setData(y=intensityProfile, x=xValues)
+        
+    def updateGraphData(self, fits):
+        """
+        Draws the fits, a list of (peak name, fit function, popt).
+        """
+        names = set()
+        for name, fitFunction, popt in fits:
+            if name not in self.fitPlots:
+                self.fitPlots[name] = self.plotWidget.plot()
+                self.fitPlots[name].setPen(pg.intColor(len(self.fitPlots)))
+            self.fitPlots[name].setData(x=self.xValues,y=fitFunction(self.xValues,*popt))
+            names.add(name)
+        for name, plot in self.fitPlots.items():
+            if name not in names:
+                plot.clear()
+    
+    def updateGraphBatch(self, batch, current):
+        """
+        Draws the fits of the newest result of every peak in a batch of results
+        (see packResultBatch), unless the current mask of the rows leaves it
+        out.
+        """
+        fits = []
+        for name in batch['peaks']:
+            row = batch['fitRow_%s' % name]
+            popt = batch['popt_%s' % name][row]
+            if batch['fitFunction_%s' % name] is not None and current[row] and np.isfinite(popt).all():
+                fits.append((name,batch['fitFunction_%s' % name],popt))
+        self.updateGraphData(fits)
+    
+class RollingChartWidget(qt.QWidget):
+    def __init__(self,parent=None,bufferSize=2**22):
+        """
+        Chart of the displacement history against time [s]. The points are kept
+        in a DecimatedTimeSeries and only the visible range is drawn, at the
+        resolution of the plot.
+        """
+        qt.QWidget.__init__(self,parent)
+        
+        self.initializeBuffer(bufferSize)
+        
+        layout = qt.QVBoxLayout()
+        self.setLayout(layout)
+        
+        self.plotWidget = pg.PlotWidget()
+        self.plotWidget.setLabel('bottom', 'Time', units='s')
+        self.livePlot = self.plotWidget.plot()
+        self.livePlot.setPen((200,200,100))
+        layout.addWidget(self.plotWidget)
+        
+        self._isRedrawing = False
+        self.plotWidget.getViewBox().sigXRangeChanged.connect(self._viewRangeChanged)
+        
+    def initializeBuffer(self,size):
+        self._series = DecimatedTimeSeries(size)
+        self._pendingX = []
+        self._pendingY = []
+        self._startTime = None
+        self._lastX = -np.inf
+        self._bufferSize = size
+        self._isDirty = True
+    
+    @property
+    def bufferSize(self):
+        return self._bufferSize
+        
+    @bufferSize.setter
+    def bufferSize(self,size):
+        self.initializeBuffer(size)
+        
+    def addData(self,y,x=None):
+        """
+        Adds a point at time x (time.time() by default), or several with y
+        and x arrays, e.g. the rows of a result batch. The points are added
+        to the series in a batch by refresh, which also redraws the plot.
+        The series needs x in order: an x before the last one, e.g. the
+        collect time of a result that was reordered, is moved up to it.
+        """
+        if x is None:
+            x = time.time()
+        if np.ndim(y) > 0:
+            if len(y) == 0:
+                return
+            x = np.resize(x,len(y))
+        if self._startTime is None:
+            self._startTime = np.min(x)
+        x = np.maximum.accumulate(np.append(self._lastX,x - self._startTime))[1:]
+        self._lastX = x[-1]
+        self._pendingX.append(x)
+        self._pendingY.append(y)
+        self._isDirty = True
+    
+    def refresh(self):
+        if self._pendingX:
+            self._series.append(np.hstack(self._pendingX),np.hstack(self._pendingY))
+            self._pendingX = []
+            self._pendingY = []
+        if self._isDirty:
+            self._redraw()
+            self._isDirty = False
+    
+    def _redraw(self):
+        viewBox = self.plotWidget.getViewBox()
+        if viewBox.autoRangeEnabled()[0]:
+            xmin, xmax = None, None
+        else:
+            xmin, xmax = viewBox.viewRange()[0]
+        # two points per pixel column is all that can be seen
+        maxPoints = 2 * max(int(viewBox.width()),100)
+        x, y = self._series.getView(xmin,xmax,maxPoints)
+        self._isRedrawing = True
+        try:
+            self.livePlot.setData(x=x,y=y)
+        finally:
+            self._isRedrawing = False
+    
+    def _viewRangeChanged(self):
+        # zooming or panning needs another resolution of the data
+        if not self._isRedrawing:
+            self._redraw()
+            
+    
+
+class DisplacementPairWidget(qt.QWidget):
+    pairChanged = q.Signal(object)
+    
+    def __init__(self,parent=None,pair=("mp","ref")):
+        """
+        Selects the two peaks whose displacement difference is charted. With
+        "-" as the second peak the displacement of the first one is charted.
+        """
+        qt.QWidget.__init__(self,parent)
+        
+        layout = qt.QHBoxLayout()
+        self.setLayout(layout)
+        
+        self.firstPeakBox = qt.QComboBox()
+        self.secondPeakBox = qt.QComboBox()
+        layout.addWidget(self.firstPeakBox)
+        layout.addWidget(qt.QLabel("minus"))
+        layout.addWidget(self.secondPeakBox)
+        layout.addStretch()
+        
+        self._pair = tuple(pair)
+        self.setPeakNames([name for name in pair if name is not None])
+        self.firstPeakBox.activated.connect(self._emitPairChanged)
+        self.secondPeakBox.activated.connect(self._emitPairChanged)
+    
+    @property
+    def pair(self):
+        return self._pair
+    
+    def setPeakNames(self,names):
+        first, second = self._pair
+        self.firstPeakBox.clear()
+        self.firstPeakBox.addItems(list(names))
+        self.secondPeakBox.clear()
+        self.secondPeakBox.addItems(["-"] + list(names))
+        self.firstPeakBox.setCurrentIndex(max(self.firstPeakBox.findText(first),0))
+        self.secondPeakBox.setCurrentIndex(max(self.secondPeakBox.findText(second if second is not None else "-"),0))
+    
+    def _emitPairChanged(self):
+        second = str(self.secondPeakBox.currentText())
+        self._pair = (str(self.firstPeakBox.currentText()), None if second == "-" else second)
+        self.pairChanged.emit(self._pair)
+
+
+class LVStatusDisplayWidget(qt.QWidget):
+    def __init__(self,parent=None):
+        qt.QWidget.__init__(self,parent)
+        
+        layout = qt.QGridLayout()
+        self.setLayout(layout)
+        
+        layout.addWidget(qt.QLabel("Labview Status:"),0,0)       
+
+        self.lvStatusLabel = qt.QLabel("")        
+        layout.addWidget(self.lvStatusLabel,0,1)
+        
+        
+    
+    def updateStatus(self,status):
+        if not status == self.lvStatusLabel.text():
+            self.lvStatusLabel.setText(status)
+
+
+
+        
+
+class InteractiveSplineCreator(q.QObject):
+    
+    fitFunctionCreated = q.Signal(fitfunctions.ScaledSpline)
+    
+    def __init__(self):
+        q.QObject.__init__(self)
+        
+        self._fitFunction = None
+        self._sigma = 0
+        self._intensityProfile = None
+    
+    @property
+    def intensityProfile(self):
+        return self._intensityProfile
+    
+    
+    def setIntensityProfile(self,intensityProfile):
+        self._intensityProfile = intensityProfile
+    
+    @property
+    def sigma(self):
+        return self._sigma
+        
+        
+    def setSigma(self,sigma):
+        self._sigma = sigma
+        
+    
+    def hasFitFunction(self):
+        return self._fitFunction is not None
+    
+    @property
+    def fitFunction(self):
+        return self._fitFunction
+    
+    def createSpline(self):
+        spline = fitfunctions.ScaledSpline()
+        spline.estimateInitialParameters(self.intensityProfile,
+                                         filter_sigma=self.sigma)
+        
+        self._fitFunction = spline
+        self.fitFunctionCreated.emit(spline)
+        
+
+class InteractiveSplineCreatorControlsWidget(qt.QWidget):
+    def __init__(self,profileStatistics, parent=None):
+        qt.QWidget.__init__(self,parent)
+        
+        layout=qt.QGridLayout()
+        self.setLayout(layout)        
+        
+        layout.addWidget(qt.QLabel("Gaussian filter sigma:"),0,0)
+
+        self.sigmaSpinBox = qt.QSpinBox()  
+        self.sigmaSpinBox.setMinimum(0)
+        self.sigmaSpinBox.setMaximum(10)
+        layout.addWidget(self.sigmaSpinBox,0,1)
+        
+        self.makeFitFunctionButton = qt.QPushButton("Create")
+        layout.addWidget(self.makeFitFunctionButton,1,0)
+        
+        self.splineCreator = InteractiveSplineCreator()        
+        self.profileStatistics = profileStatistics
+        
+        # connect signals and slots
+        self.sigmaSpinBox.valueChanged.connect(self.splineCreator.setSigma)
+        self.makeFitFunctionButton.clicked.connect(self.createSpline)
+    
+    def createSpline(self):
+        self.splineCreator.setIntensityProfile(np.array(self.profileStatistics.profile))
+        self.splineCreator.createSpline()
+        
+        
+class RealTimeFitter(q.QObject):
+    def __init__(self,parent=None):
+        q.QObject.__init__(self,parent)
+        
+        self._refFitFunction = None
+        self._mpFitFunction = None
+        self._xminRef = None
+        self._xmaxRef = None
+        self._xminMp = None
+        self._xmaxMp = None
+        self._refEstimates = [0.0,1.0,0.0]
+        self._mpEstimates = [0.0,1.0,0.0]
+        self._refModel = None
+        self._mpModel = None
+        self.useAnalyticJacobian = True
+        
+    @property        
+    def canFit(self):
+        return self._mpFitFunction is not None and self._xminRef is not None and self._xmaxRef is not None and self._xminMp is not None and self._xmaxMp is not None
+    
+    def fit(self,intensityProfile):
+        if self.canFit:
+            try:
+                displacement_mp, popt_mp = self._getMovingPeakDisplacement(intensityProfile)
+                displacement_ref, popt_ref = self._getReferencePeakDisplacement(intensityProfile)
+                return dict(displacement_mp=displacement_mp,
+                            displacement_ref=displacement_ref,
+                            popt_mp=popt_mp,
+                            popt_ref=popt_ref,
+                            fitFunction_mp=self._mpFitFunction,
+                            fitFunction_ref=self._refFitFunction)
+            except Exception as e:
+                print e
+        else:
+            return dict()
+    
+    def _getMovingPeakDisplacement(self,intensityProfile):
+        xdata = np.arange(len(intensityProfile))[self._xminMp:self._xmaxMp]
+        ydata = intensityProfile[self._xminMp:self._xmaxMp]
+        
+        popt,pcov = curve_fit(self._mpFitFunction,xdata,ydata,p0=self._mpEstimates,
+                              jac=self._mpModel.jacobian if self.useAnalyticJacobian else None)
+        self._mpEstimates = popt
+        return self._mpFitFunction.getDisplacement(*popt), popt
+        
+    def _getReferencePeakDisplacement(self,intensityProfile):
+        xdata = np.arange(len(intensityProfile))[self._xminRef:self._xmaxRef]
+        ydata = intensityProfile[self._xminRef:self._xmaxRef]
+        
+        popt,pcov = curve_fit(self._refFitFunction,xdata,ydata,p0=self._refEstimates,
+                              jac=self._refModel.jacobian if self.useAnalyticJacobian else None)
+        self._refEstimates = popt
+        return self._refFitFunction.getDisplacement(*popt), popt
+    
+    
+    
+    def setReferencePeakFitFunction(self,fitFunction):
+        print "ref. fitfunction: %s" % fitFunction
+        self._refFitFunction = fitFunction
+        self._refModel = ScaledSplineModel(fitFunction)
+        
+    def setReferencePeakInterval(self,interval):
+        print interval
+        self._xmaxRef = int(max(interval))
+        self._xminRef = int(min(interval))
+
+    def setMovingPeakInterval(self,interval):
+        print interval
+        self._xmaxMp = int(max(interval))
+        self._xminMp = int(min(interval))
+
+        
+    def setMovingPeakFitFunction(self,fitFunction):
+        print "mp. fitfunction: %s" % fitFunction
+        self._mpFitFunction = fitFunction
+        self._mpModel = ScaledSplineModel(fitFunction)
+        
+    def setUseAnalyticJacobian(self,enabled):
+        """
+        Selects whether curve_fit gets the exact Jacobian of the ScaledSpline
+        model, or estimates it with finite differences.
+        """
+        self.useAnalyticJacobian = bool(enabled)
+
+        
+        
+    def reset(self):
+        """
+        Resets the stored curve-fit estimates to the default values.
+        """
+        self._refEstimates = [0.0,1.0,0.0]
+        self._mpEstimates = [0.0,1.0,0.0]
+        
+
+class FitControlWidget(qt.QWidget):
+    def __init__(self,parent=None):
+        qt.QWidget.__init__(self,parent)
+        
+        layout = qt.QHBoxLayout()
+        self.setLayout(layout)
+        
+        self.startButton = qt.QPushButton("start fit")
+        layout.addWidget(self.startButton)
+        
+        self.stopButton = qt.QPushButton("stop fit")
+        layout.addWidget(self.stopButton)
+        
+        self.resetButton = qt.QPushButton("reset fit")
+        layout.addWidget(self.resetButton)
+        
+        self.statsButton = qt.QPushButton("print stats")
+        layout.addWidget(self.statsButton)
+        
+
+
+class MainWindow(qt.QMainWindow):
+    def __init__(self, parent=None, lvport=4562, nWorkers=1, framePolicy="every", frameInterval=1, sharedMemory=False, captureDirectory=None, refreshRate=25, splineTolerance=None, trackingWidth=None, usePrediction=True, displacementPair=("mp","ref"), threads=1, workers=None, batchResults=False):
+        qt.QMainWindow.__init__(self,parent)
+        
+        # with a splineTolerance the fit functions are sent to the workers as
+        # lookup tables with this relative accuracy, None sends the splines
+        self.splineTolerance = splineTolerance
+        
+        self._lvAddress = r"tcp://localhost:%i" % lvport
+        
+        self.setWindowTitle("Live ODM Analysis")
+        self.resize(1000,800)
+        
+        area=dock.DockArea()
+        self.dockArea = area
+        self.setCentralWidget(area)
+        
+        d1 = dock.Dock("Spline Creator", size=(500, 500))     ## give this dock the minimum possible size
+        d2 = dock.Dock("LabView Status", size=(1,100))
+        d3 = dock.Dock("Fit result", size=(500,400))
+        d4 = dock.Dock("Displacement", size=(500,200))
+        d5 = dock.Dock("Fit Controls", size=(1,100))
+        
+        area.addDock(d1, 'left')      ## place d1 at left edge of dock area (it will fill the whole space since there are no other docks yet)
+        area.addDock(d2, 'bottom', d1)     ## place d2 at right edge of dock area
+        area.addDock(d3, 'bottom', d2)## place d3 at bottom edge of d1
+        area.addDock(d4, 'right')     ## place d4 at right edge of dock area
+        area.addDock(d5, 'bottom', d2)        
+        
+        self.splineCreatorWidget = SplineCreatorWidget(self)
+        d1.addWidget(self.splineCreatorWidget)        
+        
+        self.lvStatusDisplay = LVStatusDisplayWidget(self)
+        hLayout = qt.QHBoxLayout()
+        hLayout.addWidget(self.lvStatusDisplay)
+        hLayout.addStretch()
+        w2 = qt.QWidget()
+        w2.setLayout(hLayout)        
+        d2.addWidget(w2)
+        
+        
+        self.fitGraph = FitGraphWidget(self)
+        d3.addWidget(self.fitGraph)
+
+                
+        self.displacementPairSelector = DisplacementPairWidget(self,displacementPair)
+        d4.addWidget(self.displacementPairSelector)
+        self.displacementChart = RollingChartWidget()
+        d4.addWidget(self.displacementChart)
+        self._peakNames = None
+        
+        self.fitControls = FitControlWidget(self)
+        d5.addWidget(self.fitControls)
+        
+        # the widgets are repainted at refreshRate, not for every message
+        self.display = CoalescingDisplay(refreshRate,self)
+        
+        if sharedMemory:
+            # one process decodes the lvdata, the gui and the workers share its ring buffer
+            self.ingestService = ProfileIngestService(self._lvAddress)
+            producerAddress = self.ingestService.notifyAddress
+            ringPath = self.ingestService.ringPath
+            self.lvClient = RingLVODMClient(ringPath)
+        else:
+            self.ingestService = None
+            producerAddress = self._lvAddress
+            ringPath = None
+            self.lvClient = EmittingLVODMClient()
+        self.lvClient.connect(producerAddress)
+        
+        #self.fitClient = ProcessingLVODMClient(lambda d: self.fitter.fit(d['Intensity Profile']))
+        #self.fitClient.connect("tcp://localhost:4562")
+        # with batchResults the collector hands over the results in batches of
+        # arrays, one signal per batch instead of one per result
+        self.fitCollectorThread = CurveFitServiceCollector(publish=captureDirectory is not None,batch=batchResults)
+        self.fitServiceController = CurveFitServiceController(producerAddress=producerAddress,
+                                                              collectorAddress=self.fitCollectorThread.address,
+                                                              nWorkers=nWorkers,
+                                                              ringPath=ringPath,
+                                                              workers=workers)
+        self.fitServiceController.setFramePolicy(framePolicy,frameInterval)
+        if trackingWidth:
+            self.fitServiceController.setMovingPeakTracking(trackingWidth)
+        self.fitServiceController.setUsePrediction(usePrediction)
+        if threads > 1:
+            self.fitServiceController.setThreads(threads)
+        
+        self.captureRecorder = None
+        if captureDirectory is not None:
+            self.captureRecorder = CaptureRecorderService(self._lvAddress,captureDirectory,
+                                                          resultAddress=self.fitCollectorThread.publishAddress)
+        
+        # connect signals and slots        
+        self.lvClient.messageReceived.connect(self.handleLVData)
+        self.display.lvDataReady.connect(self.paintLVData)
+        if batchResults:
+            self.fitCollectorThread.resultsReceived.connect(self.handleFitBatch)
+            self.display.fitResultReady.connect(self.paintFitBatch)
+        else:
+            self.fitCollectorThread.resultReceived.connect(self.handleFitResult)
+            self.display.fitResultReady.connect(self.paintFitResult)
+                
+        self.splineCreatorWidget.referencePeakIntervalChanged.connect(self.setReferencePeakInterval)
+        self.splineCreatorWidget.movingPeakIntervalChanged.connect(self.setMovingPeakInterval)
+        
+        self.splineCreatorWidget.movingPeakFitFunctionChanged.connect(self.setMovingPeakFitFunction)
+        self.splineCreatorWidget.referencePeakFitFunctionChanged.connect(self.setReferencePeakFitFunction)
+        self.splineCreatorWidget.sigmaChanged.connect(self.fitServiceController.setSigma)
+        
+        self.fitControls.startButton.clicked.connect(self.startFitting)
+        self.fitControls.stopButton.clicked.connect(self.fitServiceController.stopFitting)
+        self.displacementPairSelector.pairChanged.connect(self.setDisplacementPair)
+        self.fitControls.resetButton.clicked.connect(self.fitServiceController.reset)
+        self.fitControls.statsButton.clicked.connect(self.requestStats)
+        
+        # results fitted before the last change of a fit function or interval
+        # (an older config epoch) are dropped
+        self._staleEpoch = 0
+        self.staleResults = 0
+        self.controlReplyTimer = q.QTimer()
+        self.controlReplyTimer.timeout.connect(self.handleControlReplies)
+        self.controlReplyTimer.start(100)
+        
+    def setMovingPeakFitFunction(self,fitFunction):
+        self._staleEpoch = self.fitServiceController.setMovingPeakFitFunction(self._tabulate(fitFunction))
+    
+    def setReferencePeakFitFunction(self,fitFunction):
+        self._staleEpoch = self.fitServiceController.setReferencePeakFitFunction(self._tabulate(fitFunction))
+    
+    def setMovingPeakInterval(self,interval):
+        self._staleEpoch = self.fitServiceController.setMovingPeakInterval(interval)
+    
+    def setReferencePeakInterval(self,interval):
+        self._staleEpoch = self.fitServiceController.setReferencePeakInterval(interval)
+    
+    def startFitting(self):
+        # the frames that came in while stopped are not waited for
+        self.fitCollectorThread.restart(self.fitServiceController.startFitting())
+    
+    def handleControlReplies(self):
+        for reply in self.fitServiceController.pollReplies():
+            if reply['error'] is not None:
+                print "worker %(pid)i: %(method)s failed: %(error)s" % reply
+    
+    def _tabulate(self,fitFunction):
+        if self.splineTolerance is None:
+            return fitFunction
+        length = self.splineCreatorWidget.profileStatistics.length
+        return TabulatedScaledSpline(fitFunction,domain=(0,length-1),tolerance=self.splineTolerance)
+    
+    def handleLVData(self,lvData):
+        # the template mean and the fit weights take every profile, the
+        # plots only the latest one
+        self.splineCreatorWidget.recordProfile(np.asarray(lvData['Intensity Profile']))
+        self.display.pushLVData(lvData)
+    
+    def handleFitResult(self,fitResult):
+        if fitResult is not None and fitResult.get('peaks'):
+            if fitResult['epoch'] < self._staleEpoch:
+                self.staleResults += 1
+                return
+            if fitResult['peaks'] != self._peakNames:
+                self._peakNames = fitResult['peaks']
+                self.displacementPairSelector.setPeakNames(self._peakNames)
+            # every displacement goes into the chart, only the latest fit is drawn
+            displacement = self._getPairDisplacement(fitResult)
+            if displacement is not None:
+                self.displacementChart.addData(y=displacement)
+            self.display.pushFitResult(fitResult)
+    
+    def handleFitBatch(self,batch):
+        current = batch['epoch'] >= self._staleEpoch
+        self.staleResults += int(len(current) - current.sum())
+        if not current.any() or not batch['peaks']:
+            return
+        if batch['peaks'] != self._peakNames:
+            self._peakNames = batch['peaks']
+            self.displacementPairSelector.setPeakNames(self._peakNames)
+        displacement = self._getPairDisplacement(batch)
+        if displacement is not None:
+            # rows of results without one of the peaks are NaN
+            shown = current & np.isfinite(displacement)
+            self.displacementChart.addData(y=displacement[shown],x=batch['collectTime'][shown])
+        batch['current'] = current
+        self.display.pushFitResult(batch)
+    
+    def _getPairDisplacement(self,fitResult):
+        """
+        Returns the displacement of the selected pair of peaks for a fit result,
+        or an array of them for a batch, None when a peak is missing.
+        """
+        first, second = self.displacementPairSelector.pair
+        if first not in fitResult['peaks']:
+            return None
+        if second is None:
+            return fitResult['displacement_%s' % first]
+        if second not in fitResult['peaks']:
+            return None
+        return fitResult['displacement_%s' % first] - fitResult['displacement_%s' % second]
+    
+    def setDisplacementPair(self,pair):
+        # the history of another pair does not continue the chart
+        self.displacementChart.initializeBuffer(self.displacementChart.bufferSize)
+        self.displacementChart.refresh()
+    
+    def paintLVData(self,lvData):
+        status = lvData['Measurement Process State']
+        intensityProfile = np.asarray(lvData['Intensity Profile'])
+        
+        self.splineCreatorWidget.updateData(intensityProfile)
+        self.fitGraph.updateIntensityProfile(intensityProfile)
+        self.lvStatusDisplay.updateStatus(status)
+    
+    def paintFitResult(self,fitResult):
+        self.fitGraph.updateGraphData([(name,fitResult['fitFunction_%s' % name],fitResult['popt_%s' % name])
+                                       for name in fitResult['peaks']
+                                       if fitResult['fitFunction_%s' % name] is not None])
+        self.displacementChart.refresh()
+        self.fitCollectorThread.recordPaint(fitResult)
+    
+    def paintFitBatch(self,batch):
+        self.fitGraph.updateGraphBatch(batch,batch['current'])
+        self.displacementChart.refresh()
+        self.fitCollectorThread.recordPaint(batch['last'])
+    
+    def requestStats(self):
+        self.printStats(self.fitServiceController.getStats(timeout=500))
+    
+    def printStats(self,workers):
+        stats = self.fitCollectorThread.getStats()
+        print "%-10s %8s %10s %10s %10s %10s" % ("stage","count","mean [ms]","p50 [ms]","p99 [ms]","max [ms]")
+        for stage, s in stats['latency'].items():
+            print "%-10s %8i %10.3f %10.3f %10.3f %10.3f" % (stage, s['count'], s['mean']*1e3,
+                                                             s['p50']*1e3, s['p99']*1e3, s['max']*1e3)
+        print "sequence: last %(lastSequence)s, lost %(lost)i, dropped %(dropped)i" % stats['sequence']
+        print "config epoch: sent %i, applied %i, stale results dropped %i" % (self.fitServiceController.epoch,
+                                                                               self.fitServiceController.appliedEpoch,
+                                                                               self.staleResults)
+        for worker in workers:
+            print "worker %(pid)i: %(state)s, received %(framesReceived)i, fitted %(framesFitted)i, skipped %(framesSkipped)i, failed %(fitsFailed)i, tracking fallbacks %(trackingFallbacks)i" % worker
+            print "    evaluations/fit: %s, reseeds %i" % (", ".join("%s %.1f" % item for item in sorted(worker['evaluations'].items())),
+                                                          worker['reseeds'])
+    
+    def show(self):
+        super(MainWindow,self).show()
+        self.lvClient.startAsync()
+        self.fitCollectorThread.start()
+        self.display.start()
+
+    def closeEvent(self,event):
+        self._abortClients()
+        qt.QWidget.closeEvent(self,event)        
+        
+    
+    def _abortClients(self):
+        print "aborting"
+        self.display.stop()
+        self.lvClient.abort()
+        self.fitServiceController.abort()
+        self.fitCollectorThread.abort()
+        if self.ingestService is not None:
+            self.ingestService.abort()
+        if self.captureRecorder is not None:
+            self.captureRecorder.abort()
+
+
+def run(args, workers):
+    """
+    Shows the main window for the command line arguments of lvclient_gui and
+    runs the Qt event loop, unless running in interactive mode or using
+    pyside. workers are the PrespawnedWorkers of the fit service. Returns the
+    application and the main window.
+    """
+    #QtGui.QApplication.setGraphicsSystem('raster')
+    app = qt.QApplication([])
+    print args
+    mw = MainWindow(lvport=args.port, nWorkers=args.workers,
+                    framePolicy=args.frame_policy, frameInterval=args.frame_interval,
+                    sharedMemory=args.shared_memory, captureDirectory=args.record,
+                    refreshRate=args.refresh_rate,
+                    splineTolerance=args.spline_tolerance,
+                    trackingWidth=args.track_width,
+                    usePrediction=not args.no_prediction,
+                    threads=args.threads,
+                    displacementPair=(args.pair.split(",") + [None])[:2],
+                    workers=workers,
+                    batchResults=args.batch_results)
+    mw.show()
+
+    import sys
+    if (sys.flags.interactive != 1) or not hasattr(q, 'PYQT_VERSION'):
+        
+        qt.QApplication.instance().exec_()
+
+    return app, mw
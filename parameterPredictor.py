@@ -0,0 +1,115 @@
+import numpy as np
+
+DEFAULT_PARAMETERS = (0.0,1.0,0.0)
+
+
+class ParameterPredictor(object):
+    def __init__(self,history=8,extrapolate=True,maxScaleChange=4.0,maxShift=None):
+        """
+        Predicts the starting parameters (shift, scale, offset) of the next
+        ScaledSpline fit from the last fitted ones.
+
+        With extrapolate, the shift is extrapolated from the last frame: when
+        the messages carry an actuator voltage, with the slope of a
+        straight-line fit of shift against voltage over the last history
+        frames, otherwise at constant velocity from the last two frames. scale
+        and offset are taken from the last frame. Without extrapolate the last
+        fitted parameters are used as they are.
+
+        isDiverged tells when a fit result cannot be right, so that only good
+        results go into the history and the fit can be started again from the
+        next seed. maxShift is the largest shift that keeps the peak inside the
+        fitted interval, e.g. the width of the interval.
+        """
+        self.history = history
+        self.extrapolate = extrapolate
+        self.maxScaleChange = maxScaleChange
+        self.maxShift = maxShift
+        self.reset()
+
+    def reset(self):
+        self._params = np.zeros((self.history,3))
+        self._voltages = np.zeros(self.history)
+        self.n = 0
+
+    @property
+    def last(self):
+        if self.n == 0:
+            return np.array(DEFAULT_PARAMETERS)
+        return self._params[(self.n-1) % self.history].copy()
+
+    def record(self,popt,actuatorVoltage=None):
+        slot = self.n % self.history
+        self._params[slot] = popt
+        self._voltages[slot] = np.nan if actuatorVoltage is None else actuatorVoltage
+        self.n += 1
+
+    def _recent(self):
+        # the history in recording order
+        count = min(self.n,self.history)
+        slots = np.arange(self.n-count,self.n) % self.history
+        return self._params[slots], self._voltages[slots]
+
+    def predict(self,actuatorVoltage=None):
+        """
+        Returns the starting parameters for the next frame.
+        """
+        return self.predictBatch(1,None if actuatorVoltage is None else [actuatorVoltage])[0]
+
+    def predictBatch(self,nFrames,actuatorVoltages=None):
+        """
+        Returns an nFrames x 3 array with the starting parameters for the next
+        nFrames frames, with their actuator voltages if known.
+        """
+        predictions = np.empty((nFrames,3))
+        predictions[:] = self.last
+        if not self.extrapolate or self.n < 2:
+            return predictions
+
+        params, voltages = self._recent()
+        if actuatorVoltages is not None:
+            actuatorVoltages = np.asarray(actuatorVoltages,dtype=np.float64)
+            known = np.isfinite(voltages)
+            if np.isfinite(actuatorVoltages).all() and known.sum() >= 2:
+                v = voltages[known]
+                shift = params[known,0]
+                spread = ((v - v.mean())**2).sum()
+                if spread > 1e-12 * max((v**2).sum(),1e-300):
+                    slope = ((v - v.mean()) * (shift - shift.mean())).sum() / spread
+                    predictions[:,0] = shift[-1] + slope * (actuatorVoltages - v[-1])
+                # with a constant voltage the peak stays where it is
+                return predictions
+
+        velocity = params[-1,0] - params[-2,0]
+        predictions[:,0] += velocity * np.arange(1,nFrames+1)
+        return predictions
+
+    def seeds(self,p0):
+        """
+        Returns the starting parameters to try one after the other when a fit
+        from p0 diverges: p0, the last fitted parameters and the defaults.
+        """
+        seeds = [np.asarray(p0,dtype=np.float64)]
+        for seed in (self.last,np.array(DEFAULT_PARAMETERS)):
+            if not any(np.array_equal(seed,s) for s in seeds):
+                seeds.append(seed)
+        return seeds
+
+    def isDiverged(self,popt):
+        """
+        Tells for a set of parameters, or for every row of an array of them,
+        whether the fit diverged: a parameter is not finite, the scale changed
+        sign or by more than maxScaleChange from the last fit, or the shift is
+        larger than maxShift.
+        """
+        popt = np.asarray(popt,dtype=np.float64)
+        diverged = ~np.isfinite(popt).all(axis=-1)
+        with np.errstate(invalid='ignore'):
+            if self.maxShift is not None:
+                diverged |= ~(np.abs(popt[...,0]) <= self.maxShift)
+            if self.n > 0:
+                ratio = popt[...,1] / self.last[1]
+                diverged |= ~((ratio > 1.0 / self.maxScaleChange) & (ratio < self.maxScaleChange))
+            else:
+                diverged |= ~(popt[...,1] > 0)
+        return diverged
@@ -0,0 +1,276 @@
+import numpy as np
+from scipy.optimize import curve_fit
+import time
+
+from batchFitter import BatchFitter
+from splineModel import ScaledSplineModel
+from crossCorrelation import CrossCorrelationEstimator
+from parameterPredictor import ParameterPredictor
+
+PEAK_ESTIMATORS = ("spline","xcorr")
+
+
+class PeakFitter(object):
+    def __init__(self,name):
+        """
+        Fits one peak of the intensity profiles: a ScaledSpline fit function
+        over an interval of the profile, with its own estimator, starting-point
+        predictor and optional tracking window. RealTimeFitter keeps one
+        PeakFitter per named peak.
+        """
+        self.name = name
+        self.fitFunction = None
+        self.model = None
+        self.xmin = None
+        self.xmax = None
+        self.estimates = [0.0,1.0,0.0]
+        self.estimator = "spline"
+        self.useAnalyticJacobian = True
+        self.predictor = ParameterPredictor()
+        self._correlator = None
+
+        self.trackingWidth = None
+        self._peakCenter = None
+        self._tracked = False
+        self._batchMotion = 0.0
+
+        self.trackingFallbacks = 0
+        self.reseeds = 0
+        self.evaluationCount = 0
+
+    @property
+    def canFit(self):
+        return self.fitFunction is not None and self.xmin is not None and self.xmax is not None
+
+    @property
+    def hasExactJacobian(self):
+        """
+        False if the analytic Jacobian falls back to a central difference of
+        the spline, because the fit function exposes no derivative.
+        """
+        return self.model is not None and self.model.hasExactDerivative
+
+    def setFitFunction(self,fitFunction):
+        self.fitFunction = fitFunction
+        self.model = ScaledSplineModel(fitFunction)
+        self._correlator = None
+        self._peakCenter = None
+        self._tracked = False
+        # the shifts so far are relative to the old fit function
+        self.predictor.reset()
+
+    def setInterval(self,interval):
+        self.xmax = int(max(interval))
+        self.xmin = int(min(interval))
+        self._correlator = None
+        self._peakCenter = None
+        self._tracked = False
+        # the peak cannot have moved further than the interval is wide
+        self.predictor.maxShift = self.xmax - self.xmin
+
+    def setEstimator(self,estimator):
+        if estimator not in PEAK_ESTIMATORS:
+            raise ValueError("estimator must be one of %s" % (PEAK_ESTIMATORS,))
+        self.estimator = estimator
+
+    def setTracking(self,width):
+        """
+        With a width (in pixels), the peak is fitted over a window of that
+        width that follows the peak from frame to frame, instead of over the
+        whole interval. Whenever the peak is lost, the frame is fitted over the
+        whole interval again. None turns tracking off. Only applies to the
+        spline estimator.
+        """
+        self.trackingWidth = int(width) if width else None
+        self._tracked = False
+
+    def reset(self):
+        self.estimates = [0.0,1.0,0.0]
+        self._tracked = False
+        self.predictor.reset()
+
+    def fit(self,intensityProfile,actuatorVoltage=None,sigma=None):
+        """
+        Fits one profile. Returns the displacement, the fitted parameters and
+        the number of fit-function evaluations, and the start and end time of
+        the fit. Raises RuntimeError when the fit diverged from every seed.
+        """
+        fitStart = time.time()
+        displacement, popt, evaluations = self._fit(intensityProfile,actuatorVoltage,sigma)
+        return displacement, popt, evaluations, fitStart, time.time()
+
+    def _fit(self,intensityProfile,actuatorVoltage,sigma):
+        if self.estimator == "xcorr":
+            if self._correlator is None:
+                self._correlator = CrossCorrelationEstimator(self.fitFunction,(self.xmin,self.xmax))
+            popt = self._correlator.estimate(intensityProfile)
+            self.estimates = popt
+            self.predictor.record(popt,actuatorVoltage)
+            return self.fitFunction.getDisplacement(*popt), popt, 0
+
+        p0 = self.predictor.predict(actuatorVoltage)
+        popt = None
+        evaluations = 0
+        interval = self._getTrackingInterval(p0[0])
+        if interval is not None:
+            popt, evaluations = self._fitWithReseed(intensityProfile,interval,sigma,[p0])
+            if popt is None or not self._isTracked(popt,interval):
+                # lost the peak, fall back to the whole interval
+                self.trackingFallbacks += 1
+                popt = None
+        if popt is None:
+            self._tracked = False
+            popt, fallbackEvaluations = self._fitWithReseed(intensityProfile,(self.xmin,self.xmax),sigma,
+                                                            self.predictor.seeds(p0))
+            evaluations += fallbackEvaluations
+            if popt is None:
+                self.predictor.reset()
+                raise RuntimeError("%s peak fit diverged" % self.name)
+        self.estimates = popt
+        self._tracked = True
+        self.predictor.record(popt,actuatorVoltage)
+        self.evaluationCount += evaluations
+        return self.fitFunction.getDisplacement(*popt), popt, evaluations
+
+    def _fitWithReseed(self,intensityProfile,interval,sigma,seeds):
+        """
+        Fits the interval from the first seed, and from the next ones as long as
+        the fit diverges. Returns the fitted parameters, or None if the fit
+        diverged from every seed, and the number of fit-function evaluations.
+        """
+        xmin, xmax = interval
+        xdata = np.arange(len(intensityProfile))[xmin:xmax]
+        ydata = intensityProfile[xmin:xmax]
+        fitFunction = self.fitFunction
+
+        evaluations = [0]
+        def countingFitFunction(x,*params):
+            evaluations[0] += 1
+            return fitFunction(x,*params)
+
+        for i, p0 in enumerate(seeds):
+            if i > 0:
+                self.reseeds += 1
+            try:
+                popt,pcov = curve_fit(countingFitFunction,xdata,ydata,p0=p0,
+                                      sigma=sigma[xmin:xmax] if sigma is not None else None,
+                                      jac=self.model.jacobian if self.useAnalyticJacobian else None)
+            except RuntimeError:
+                continue
+            if not self.predictor.isDiverged(popt):
+                return popt, evaluations[0]
+        return None, evaluations[0]
+
+    def fitBatch(self,intensityProfiles,actuatorVoltages=None,sigma=None):
+        """
+        Fits a stack of profiles (one per row) with the BatchFitter. Returns the
+        displacements, the fitted parameters and the fit-function evaluations
+        per row, and the start and end time. Rows that diverged from every seed
+        have NaN parameters; RuntimeError is raised when all rows did.
+        """
+        fitStart = time.time()
+        if self.estimator != "spline":
+            # the batch fitter only does spline fits
+            voltages = actuatorVoltages if actuatorVoltages is not None else [None] * len(intensityProfiles)
+            fits = [self._fit(profile,voltage,sigma) for profile,voltage in zip(intensityProfiles,voltages)]
+            displacements, popts, evaluations = [np.array(values) for values in zip(*fits)]
+            return displacements, popts, evaluations, fitStart, time.time()
+        nFrames = len(intensityProfiles)
+        p0 = self.predictor.predictBatch(nFrames,actuatorVoltages)
+        # the peak moves during a batch, widen the window by how far it moved
+        # during the last one, in either direction
+        interval = self._getTrackingInterval(p0[:,0].mean(),2*int(np.ceil(self._batchMotion)))
+        lost = np.ones(nFrames,dtype=bool)
+        popts = np.empty((nFrames,3))
+        evaluations = np.zeros(nFrames,dtype=int)
+        if interval is not None:
+            batchFitter = BatchFitter(self.fitFunction,interval,sigma=sigma)
+            popts[:], displacements, converged = batchFitter.fit(intensityProfiles,p0=p0)
+            evaluations += batchFitter.evaluations
+            lost = ~converged | ~self._isTracked(popts,interval) | self.predictor.isDiverged(popts)
+            # the frames the peak moved out of the window are fitted again
+            self.trackingFallbacks += int(lost.sum())
+        batchFitter = BatchFitter(self.fitFunction,(self.xmin,self.xmax),sigma=sigma)
+        failed = self._fitBatchWithReseed(batchFitter,intensityProfiles,p0,lost,popts,evaluations)
+        if failed.all():
+            self.predictor.reset()
+            raise RuntimeError("%s peak fits diverged" % self.name)
+
+        self.estimates = popts[~failed][-1]
+        self._tracked = not failed[-1]
+        self._batchMotion = np.ptp(popts[~failed,0]) if self._tracked else 0.0
+        for i in np.flatnonzero(~failed):
+            self.predictor.record(popts[i],None if actuatorVoltages is None else actuatorVoltages[i])
+        self.evaluationCount += int(evaluations.sum())
+        displacements = np.array([np.nan if failed[i] else self.fitFunction.getDisplacement(*popt)
+                                  for i,popt in enumerate(popts)])
+        return displacements, popts, evaluations, fitStart, time.time()
+
+    def _fitBatchWithReseed(self,batchFitter,intensityProfiles,p0,selected,popts,evaluations):
+        """
+        Fits the selected rows, starting from their rows of p0. Rows that
+        diverge are fitted again from the next seeds (see
+        ParameterPredictor.seeds). popts and evaluations are filled in for the
+        selected rows. Returns the rows that diverged from every seed, their
+        popts are NaN.
+        """
+        remaining = selected.copy()
+        for i, seed in enumerate([p0] + self.predictor.seeds(p0[-1])[1:]):
+            if not remaining.any():
+                break
+            if i > 0:
+                self.reseeds += int(remaining.sum())
+            seed = seed[remaining] if np.ndim(seed) == 2 else seed
+            params, displacements, converged = batchFitter.fit(intensityProfiles[remaining],p0=seed)
+            evaluations[remaining] += batchFitter.evaluations
+            popts[remaining] = params
+            good = converged & ~self.predictor.isDiverged(params)
+            remaining[np.flatnonzero(remaining)[good]] = False
+        popts[remaining] = np.nan
+        return remaining
+
+    def _getTrackingInterval(self,shift,extraWidth=0):
+        """
+        Returns the tracking window for the next fit: trackingWidth plus
+        extraWidth pixels centred on the peak position for the predicted shift,
+        moved inside the interval where it sticks out. Returns None when the
+        whole interval has to be fitted: tracking is off, there is no last fit
+        to go by, or the peak is expected outside the interval.
+        """
+        if self.trackingWidth is None or not self._tracked:
+            return None
+        width = self.trackingWidth + extraWidth
+        if width >= self.xmax - self.xmin:
+            return None
+        center = self._getPeakCenter() + shift
+        if not self.xmin <= center < self.xmax:
+            return None
+        xmin = int(round(center - width/2.0))
+        xmin = min(max(xmin,self.xmin),self.xmax - width)
+        return xmin, xmin + width
+
+    def _isTracked(self,popt,interval):
+        """
+        Tells whether the fitted peak (popt, one set of parameters or one per
+        row) lies in the inner half of the tracking window, so that the window
+        covered its flanks, and kept at least half of its last scale. A window
+        the peak has left is fitted with a collapsed scale.
+        """
+        xmin, xmax = interval
+        margin = (xmax - xmin) / 4.0
+        popt = np.asarray(popt)
+        center = self._getPeakCenter() + popt[...,0]
+        # at the edges of the interval the window cannot do better
+        lower = xmin + margin if xmin > self.xmin else xmin
+        upper = xmax - margin if xmax < self.xmax else xmax
+        scale = popt[...,1] / self.estimates[1]
+        return (center >= lower) & (center <= upper) & (scale >= 0.5)
+
+    def _getPeakCenter(self):
+        # position of the peak in the unshifted fit function: the extremum of
+        # the spline over the interval
+        if self._peakCenter is None:
+            x = np.arange(self.xmin,self.xmax,dtype=np.float64)
+            s = self.model.spline(x)
+            self._peakCenter = x[np.argmax(np.abs(s - np.median(s)))]
+        return self._peakCenter
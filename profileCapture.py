@@ -0,0 +1,350 @@
+"""
+Streaming capture of lvdata profiles and fit results to disk.
+
+A CaptureRecorder process subscribes to the lvdata producer and, optionally, to
+the fit results re-published by a CurveFitServiceCollector, and appends them to
+a capture directory with a CaptureWriter. The data is written in chunks of
+numpy .npy files that can be memory-mapped:
+
+    profiles_00000.npy  chunkSize x profileLength profile matrix (float64)
+    frames_00000.npy    timestamp, actuator voltage, profile length, status
+                        and frame number
+    results_00000.npy   sequence, frame number, receive time, the
+                        displacement_<name> of every peak of the fits and
+                        their displacement, that of the first peak minus that
+                        of the second (mp - ref), or that of a single peak
+
+The frame number is the 'Frame Number' of the producer's message, -1 when it
+does not send one; the results are matched to the profile rows by it.
+
+A result chunk has a column for every peak of the result it starts with; a
+result with other peaks starts a new chunk. Rows that were not written yet have
+a NaN timestamp, so a capture that was cut short can still be read. Capture reads a capture directory back, and
+lvserver_replay.py re-publishes it.
+"""
+
+import zmq
+import numpy as np
+import multiprocessing as mp
+import glob
+import time
+import os
+
+from profileMessage import unpackProfileMessage
+from fitResultFormat import RESULT_MESSAGE, FIT_FUNCTION_MESSAGE, FitFunctionCache, unpackFitResult
+
+_frameDtype = np.dtype([('timestamp','<f8'),
+                        ('actuatorVoltage','<f8'),
+                        ('length','<i4'),
+                        ('status','S64'),
+                        ('frameNumber','<i8')])
+
+def _resultDtype(peaks):
+    return np.dtype([('timestamp','<f8'),
+                     ('sequence','<i8'),
+                     ('frameNumber','<i8'),
+                     ('receiveTime','<f8')] +
+                    [('displacement_%s' % name,'<f8') for name in peaks] +
+                    [('displacement','<f8')])
+
+def _pairDisplacement(fitResult):
+    peaks = fitResult.get('peaks',[])
+    if not peaks:
+        return np.nan
+    if len(peaks) == 1:
+        return fitResult['displacement_%s' % peaks[0]]
+    return fitResult['displacement_%s' % peaks[0]] - fitResult['displacement_%s' % peaks[1]]
+
+
+class CaptureWriter(object):
+    def __init__(self,directory,chunkSize=1024):
+        """
+        Appends profiles and fit results to the chunk files in directory.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.chunkSize = chunkSize
+
+        self._profiles = None
+        self._frames = None
+        self._nFrames = 0
+        self._frameChunk = 0
+
+        self._results = None
+        self._resultPeaks = None
+        self._nResults = 0
+        self._resultChunk = 0
+
+    def writeFrame(self,lvdata,timestamp=None):
+        profile = np.asarray(lvdata['Intensity Profile'])
+        if (self._profiles is None or self._nFrames == self.chunkSize
+                or len(profile) > self._profiles.shape[1]):
+            self._openFrameChunk(profile)
+
+        status = lvdata.get('Measurement Process State',"")
+        if isinstance(status,unicode):
+            status = status.encode('utf-8')
+
+        n = self._nFrames
+        self._profiles[n,:len(profile)] = profile
+        self._frames[n] = (time.time() if timestamp is None else timestamp,
+                           lvdata.get('Actuator Voltage',np.nan),
+                           len(profile),
+                           status[:64],
+                           lvdata.get('Frame Number',-1))
+        self._nFrames += 1
+
+    def writeResult(self,fitResult,timestamp=None):
+        peaks = list(fitResult.get('peaks',[]))
+        if self._results is None or self._nResults == self.chunkSize or peaks != self._resultPeaks:
+            self._openResultChunk(peaks)
+
+        self._results[self._nResults] = ((time.time() if timestamp is None else timestamp,
+                                          fitResult.get('sequence',-1),
+                                          fitResult.get('frameNumber',-1),
+                                          fitResult.get('receiveTime',np.nan)) +
+                                         tuple(fitResult['displacement_%s' % name] for name in peaks) +
+                                         (_pairDisplacement(fitResult),))
+        self._nResults += 1
+
+    def flush(self):
+        for chunk in (self._profiles,self._frames,self._results):
+            if chunk is not None:
+                chunk.flush()
+
+    def close(self):
+        self.flush()
+        self._profiles = None
+        self._frames = None
+        self._results = None
+
+    def _openFrameChunk(self,profile):
+        if self._profiles is not None:
+            self._profiles.flush()
+            self._frames.flush()
+            self._frameChunk += 1
+        # float64 whatever the first profile of the chunk is, so that later
+        # float profiles are not truncated
+        self._profiles = np.lib.format.open_memmap(self._path("profiles",self._frameChunk),mode="w+",
+                                                   dtype=np.float64,shape=(self.chunkSize,len(profile)))
+        self._frames = np.lib.format.open_memmap(self._path("frames",self._frameChunk),mode="w+",
+                                                 dtype=_frameDtype,shape=(self.chunkSize,))
+        self._frames['timestamp'] = np.nan
+        self._nFrames = 0
+
+    def _openResultChunk(self,peaks):
+        if self._results is not None:
+            self._results.flush()
+            self._resultChunk += 1
+        self._resultPeaks = peaks
+        self._results = np.lib.format.open_memmap(self._path("results",self._resultChunk),mode="w+",
+                                                  dtype=_resultDtype(peaks),shape=(self.chunkSize,))
+        self._results['timestamp'] = np.nan
+        self._nResults = 0
+
+    def _path(self,kind,chunk):
+        return os.path.join(self.directory,"%s_%05i.npy" % (kind,chunk))
+
+
+class Capture(object):
+    def __init__(self,directory):
+        """
+        Read-only, memory-mapped view of a capture directory.
+        """
+        self.directory = directory
+        self._frameChunks = []
+        for framesPath in sorted(glob.glob(os.path.join(directory,"frames_*.npy"))):
+            frames = np.load(framesPath,mmap_mode="r")
+            profiles = np.load(framesPath.replace("frames_","profiles_"),mmap_mode="r")
+            n = _writtenRows(frames)
+            self._frameChunks.append((frames[:n],profiles[:n]))
+        self._resultChunks = [results[:_writtenRows(results)] for results in
+                              [np.load(path,mmap_mode="r") for path in
+                               sorted(glob.glob(os.path.join(directory,"results_*.npy")))]]
+
+    def __len__(self):
+        return sum(len(frames) for frames, profiles in self._frameChunks)
+
+    @property
+    def timestamps(self):
+        return self._concatenate([frames['timestamp'] for frames, profiles in self._frameChunks])
+
+    @property
+    def frameNumbers(self):
+        """
+        The producer's frame numbers of the profiles, -1 where there is none or
+        the capture was recorded without them.
+        """
+        return self._concatenate([frames['frameNumber'] if 'frameNumber' in frames.dtype.names
+                                  else -np.ones(len(frames),dtype=np.int64)
+                                  for frames, profiles in self._frameChunks])
+
+    @property
+    def actuatorVoltages(self):
+        return self._concatenate([frames['actuatorVoltage'] for frames, profiles in self._frameChunks])
+
+    @property
+    def results(self):
+        """
+        The fit results, with a displacement_<name> column for every peak in
+        the capture; it is NaN in the rows of results without that peak.
+        """
+        fields = []
+        for results in self._resultChunks:
+            for name in results.dtype.names:
+                if name not in [field for field, dtype in fields]:
+                    fields.append((name,results.dtype[name]))
+        if not fields:
+            return np.zeros(0,dtype=_resultDtype(["mp","ref"]))
+        # the pair displacement stays the last column
+        fields.sort(key=lambda field: field[0] == 'displacement')
+        merged = np.zeros(sum(len(results) for results in self._resultChunks),dtype=fields)
+        for name, dtype in fields:
+            if dtype.kind == 'f':
+                merged[name] = np.nan
+        row = 0
+        for results in self._resultChunks:
+            for name in results.dtype.names:
+                merged[name][row:row+len(results)] = results[name]
+            row += len(results)
+        return merged
+
+    def profileChunks(self):
+        """
+        Yields the profile matrix of every chunk, one profile per row.
+        """
+        for frames, profiles in self._frameChunks:
+            yield profiles
+
+    def frameRange(self,start,stop):
+        """
+        Returns the frame records and the profile matrix of the captured rows
+        start to stop. They are views of the memory-mapped files unless the rows
+        span several chunks.
+        """
+        parts = []
+        offset = 0
+        for frames, profiles in self._frameChunks:
+            if offset >= stop:
+                break
+            if offset + len(frames) > start:
+                parts.append((frames[max(start-offset,0):stop-offset],profiles[max(start-offset,0):stop-offset]))
+            offset += len(frames)
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.zeros(0,dtype=_frameDtype), np.zeros((0,0))
+        # a chunk is wider when a longer profile started it, the rows of the
+        # narrower chunks are as long as their profiles
+        width = min(profiles.shape[1] for frames, profiles in parts)
+        return (np.concatenate([frames for frames, profiles in parts]),
+                np.concatenate([profiles[:,:width] for frames, profiles in parts]))
+
+    def iterFrames(self):
+        """
+        Yields (timestamp, lvdata) for every captured profile, in order. The
+        profiles are views of the memory-mapped files.
+        """
+        for frames, profiles in self._frameChunks:
+            hasFrameNumbers = 'frameNumber' in frames.dtype.names
+            for frame, profile in zip(frames,profiles):
+                lvdata = {'Intensity Profile': profile[:frame['length']],
+                          'Actuator Voltage': float(frame['actuatorVoltage']),
+                          'Measurement Process State': frame['status']}
+                if hasFrameNumbers and frame['frameNumber'] >= 0:
+                    lvdata['Frame Number'] = int(frame['frameNumber'])
+                yield frame['timestamp'], lvdata
+
+    def _concatenate(self,arrays):
+        return np.concatenate(arrays) if arrays else np.zeros(0)
+
+
+def _writtenRows(chunk):
+    return int(np.isfinite(chunk['timestamp']).sum())
+
+
+class CaptureRecorder(object):
+    def __init__(self,producerAddress,resultAddress,directory,controlAddress,chunkSize=1024):
+        """
+        Writes the lvdata from producerAddress and, if resultAddress is not None,
+        the fit results published there to a capture in directory.
+        """
+        self.context = zmq.Context()
+
+        self.control_socket = self.context.socket(zmq.PULL)
+        self.control_socket.connect(controlAddress)
+
+        self.producer_socket = self.context.socket(zmq.SUB)
+        self.producer_socket.connect(producerAddress)
+        self.producer_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.producer_socket,zmq.POLLIN)
+        self.poller.register(self.control_socket,zmq.POLLIN)
+
+        self.result_socket = None
+        if resultAddress is not None:
+            self.result_socket = self.context.socket(zmq.SUB)
+            self.result_socket.connect(resultAddress)
+            self.result_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+            self.poller.register(self.result_socket,zmq.POLLIN)
+
+        self.writer = CaptureWriter(directory,chunkSize)
+        self._fitFunctionCache = FitFunctionCache()
+        self.state = "running"
+
+    def run(self):
+        try:
+            while self.state != "aborted":
+                sockets = dict(self.poller.poll())
+
+                if self.control_socket in sockets:
+                    rpc = self.control_socket.recv_pyobj()
+                    if rpc['method'] == 'abort':
+                        self.state = "aborted"
+                        break
+
+                if self.producer_socket in sockets:
+                    lvdata = unpackProfileMessage(self.producer_socket.recv_multipart(copy=False))
+                    self.writer.writeFrame(lvdata)
+
+                if self.result_socket is not None and self.result_socket in sockets:
+                    frames = self.result_socket.recv_multipart()
+                    if frames[0] == FIT_FUNCTION_MESSAGE:
+                        self._fitFunctionCache.add(*frames[1:])
+                    elif frames[0] == RESULT_MESSAGE:
+                        self.writer.writeResult(unpackFitResult(frames[1],self._fitFunctionCache))
+        finally:
+            self.writer.close()
+            self.producer_socket.close(linger=0)
+            if self.result_socket is not None:
+                self.result_socket.close(linger=0)
+            self.control_socket.close(linger=0)
+            self.context.term()
+
+def captureRecordWorker(producerAddress, resultAddress, directory, controlAddress, chunkSize):
+    captureRecorder = CaptureRecorder(producerAddress, resultAddress, directory, controlAddress, chunkSize)
+    captureRecorder.run()
+
+
+class CaptureRecorderService(object):
+    def __init__(self,producerAddress,directory,resultAddress=None,chunkSize=1024):
+        """
+        Starts a CaptureRecorder process. Recording runs in its own process on
+        SUB sockets, so a slow disk makes the recorder drop messages instead of
+        holding up the producer or the fit workers.
+        """
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.PUSH)
+        port = self._socket.bind_to_random_port("tcp://127.0.0.1")
+        self._socket.setsockopt(zmq.LINGER, 100)
+        controlAddress = "tcp://127.0.0.1:%i" % port
+
+        self._process = mp.Process(target=captureRecordWorker,
+                                   args=(producerAddress,resultAddress,directory,controlAddress,chunkSize))
+        self._process.start()
+
+    def abort(self):
+        self._socket.send_pyobj(dict(method="abort"))
+        self._process.join(2.0)
@@ -0,0 +1,238 @@
+"""
+Qt-free clients for the lvdata stream of a producer.
+
+A ProfileClient receives the messages of one producer into a bounded queue and
+hands them out decoded, by iteration or with get. A ProfileClientLoop serves
+several clients from one thread. The Qt consumers in lvclient are thin
+adapters that emit the frames of a ProfileClient as signals.
+
+usage: python profileClient.py tcp://localhost:4562 [tcp://localhost:4572 ...]
+"""
+
+import zmq
+import time
+import argparse
+from collections import deque
+
+from profileMessage import unpackProfileMessage
+from profileRing import ProfileRingBuffer, unpackSlotNotification
+
+DROP_POLICIES = ("oldest","newest")
+
+# how long a blocking wait polls before it checks for abort [ms]
+POLL_INTERVAL = 100
+
+
+class ProfileClient(object):
+    def __init__(self,address=None,maxQueue=16,dropPolicy="oldest",ringPath=None,socket=None,context=None):
+        """
+        Subscribes to the producer at address and keeps at most maxQueue
+        received frames. When the queue is full, dropPolicy selects the frame
+        that is dropped: "oldest" drops the oldest queued frame, so that a slow
+        reader keeps up with the newest data, "newest" drops the frame that
+        just arrived, so that the queued frames stay consecutive. Dropped
+        frames are counted in framesDropped.
+
+        The frames are only decoded when they are taken from the queue, so
+        dropping one costs nothing. With ringPath the producer is a
+        ProfileIngestService: the messages are slot notifications and the
+        profiles are copied from its ring buffer; a profile that was
+        overwritten in the meantime counts as dropped as well.
+
+        socket is an existing SUB socket to use instead of a new one.
+        """
+        if dropPolicy not in DROP_POLICIES:
+            raise ValueError("dropPolicy must be one of %s" % (DROP_POLICIES,))
+        if maxQueue < 1:
+            raise ValueError("maxQueue must be at least 1")
+        self.maxQueue = maxQueue
+        self.dropPolicy = dropPolicy
+        self._ring = ProfileRingBuffer(ringPath) if ringPath is not None else None
+
+        self._ownsContext = socket is None and context is None
+        if socket is None:
+            self.context = zmq.Context() if context is None else context
+            socket = self.context.socket(zmq.SUB)
+        self.socket = socket
+        if address is not None:
+            self.connect(address)
+
+        self._queue = deque()
+        self.framesReceived = 0
+        self.framesDropped = 0
+        self.framesDelivered = 0
+        self.aborted = False
+
+    def connect(self,address):
+        self.socket.connect(address)
+        self.socket.setsockopt_string(zmq.SUBSCRIBE,u"")
+
+    def __len__(self):
+        return len(self._queue)
+
+    def receiveAvailable(self):
+        """
+        Moves the messages waiting on the socket into the queue, without
+        blocking. Returns the number of messages received.
+        """
+        n = 0
+        while True:
+            try:
+                message = self.socket.recv_multipart(zmq.NOBLOCK,copy=False)
+            except zmq.Again:
+                return n
+            n += 1
+            self.framesReceived += 1
+            if len(self._queue) < self.maxQueue:
+                self._queue.append(message)
+            elif self.dropPolicy == "oldest":
+                self._queue.popleft()
+                self._queue.append(message)
+                self.framesDropped += 1
+            else:
+                self.framesDropped += 1
+
+    def get(self,timeout=None):
+        """
+        Returns the next frame as an lvdata dict, waiting at most timeout
+        milliseconds for one (None waits until there is one or the client is
+        aborted). Returns None when there is no frame.
+        """
+        deadline = None if timeout is None else time.time() + timeout / 1000.0
+        while True:
+            self.receiveAvailable()
+            while self._queue:
+                messageDict = self._decode(self._queue.popleft())
+                if messageDict is not None:
+                    self.framesDelivered += 1
+                    return messageDict
+            if self.aborted:
+                return None
+            wait = POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait,int((deadline - time.time()) * 1000))
+                if wait <= 0:
+                    return None
+            self.socket.poll(wait)
+
+    def __iter__(self):
+        """
+        Yields the frames as they arrive, until the client is aborted.
+        """
+        while not self.aborted:
+            messageDict = self.get(POLL_INTERVAL)
+            if messageDict is not None:
+                yield messageDict
+
+    def _decode(self,message):
+        if self._ring is None:
+            return unpackProfileMessage(message)
+        slot, sequence = unpackSlotNotification(message[0].bytes)
+        messageDict = self._ring.read(slot,sequence)
+        if messageDict is not None:
+            # the reader may hold on to the frame after the slot is reused
+            messageDict['Intensity Profile'] = messageDict['Intensity Profile'].copy()
+            if self._ring.isCurrent(slot,sequence):
+                return messageDict
+        self.framesDropped += 1
+        return None
+
+    def getStats(self):
+        return dict(framesReceived=self.framesReceived,
+                    framesDropped=self.framesDropped,
+                    framesDelivered=self.framesDelivered,
+                    queued=len(self._queue))
+
+    def abort(self):
+        """
+        Ends the iteration and wakes up get; can be called from another
+        thread. The socket is closed with close, on the thread that reads.
+        """
+        self.aborted = True
+
+    def close(self):
+        self.socket.close(linger=0)
+        if self._ring is not None:
+            self._ring.close()
+        if self._ownsContext:
+            self.context.term()
+
+
+class ProfileClientLoop(object):
+    def __init__(self,clients=()):
+        """
+        Reads several ProfileClients on one thread with a single poll over
+        their sockets. Iterating yields (client, frame) pairs; the clients take
+        turns, one frame each, so that a fast producer cannot hold up the
+        others.
+        """
+        self.poller = zmq.Poller()
+        self.clients = []
+        self.aborted = False
+        for client in clients:
+            self.add(client)
+
+    def add(self,client):
+        self.poller.register(client.socket,zmq.POLLIN)
+        self.clients.append(client)
+
+    def remove(self,client):
+        self.poller.unregister(client.socket)
+        self.clients.remove(client)
+
+    def __iter__(self):
+        while not self.aborted and self.clients:
+            # frames already in a queue do not make the sockets readable
+            timeout = 0 if any(len(client) for client in self.clients) else POLL_INTERVAL
+            sockets = dict(self.poller.poll(timeout))
+            for client in list(self.clients):
+                if client.socket in sockets:
+                    client.receiveAvailable()
+            for client in list(self.clients):
+                messageDict = client.get(0)
+                if messageDict is not None:
+                    yield client, messageDict
+
+    def run(self,handler):
+        """
+        Calls handler(client, frame) for every frame until the loop is aborted.
+        """
+        for client, messageDict in self:
+            handler(client,messageDict)
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        for client in list(self.clients):
+            self.remove(client)
+            client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints the frame rates of one or more lvdata producers")
+    parser.add_argument('addresses', nargs='+',
+                        help="Producer addresses, e.g. tcp://localhost:4562.")
+    parser.add_argument('--max-queue', type=int, default=16,
+                        help="Frames each client queues before it drops frames.")
+    parser.add_argument('--drop', choices=DROP_POLICIES, default="oldest",
+                        help="Which frame a full queue drops.")
+    args = parser.parse_args()
+
+    clients = [ProfileClient(address,args.max_queue,args.drop) for address in args.addresses]
+    loop = ProfileClientLoop(clients)
+    counts = dict((client,0) for client in clients)
+    lastPrint = time.time()
+    try:
+        for client, messageDict in loop:
+            counts[client] += 1
+            elapsed = time.time() - lastPrint
+            if elapsed >= 1.0:
+                for address, client in zip(args.addresses,clients):
+                    print "%s: %.1f frames/s, dropped %i" % (address, counts[client] / elapsed, client.framesDropped)
+                    counts[client] = 0
+                lastPrint = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
@@ -0,0 +1,60 @@
+"""
+Multipart message format for lvdata messages.
+
+A message is sent as a small msgpack header frame followed by one raw buffer
+frame per numpy array in the message. The header holds the scalar fields of the
+message and, under ARRAYS_KEY, the name, dtype and shape of every array, in the
+order of the buffer frames. Receivers build the arrays with np.frombuffer on
+the received frames, so the array data is never copied. The arrays are
+read-only views.
+
+The single-frame format, a msgpack(_numpy) packed dict as sent by the LabVIEW
+producer, is still understood by unpackProfileMessage.
+"""
+
+import msgpack as msg
+import msgpack_numpy
+msgpack_numpy.patch()
+import numpy as np
+
+ARRAYS_KEY = "__arrays__"
+
+
+def packProfileMessage(messageDict):
+    """
+    Returns the list of frames for messageDict, to be sent with
+    socket.send_multipart(frames, copy=False).
+    """
+    header = dict()
+    arrays = []
+    buffers = []
+    for key, value in messageDict.items():
+        if isinstance(value,np.ndarray):
+            value = np.ascontiguousarray(value)
+            arrays.append((key,value.dtype.str,value.shape))
+            buffers.append(value)
+        else:
+            header[key] = value
+    header[ARRAYS_KEY] = arrays
+    return [msg.packb(header)] + buffers
+
+def unpackProfileMessage(frames):
+    """
+    Turns the received frames (bytes or zmq.Frame objects) back into a message
+    dict. A single frame is decoded as a packed dict.
+    """
+    messageDict = msg.unpackb(_bytes(frames[0]))
+    arrays = messageDict.pop(ARRAYS_KEY,[])
+    for (key, dtype, shape), frame in zip(arrays,frames[1:]):
+        # zmq.Frame supports the buffer protocol, the array keeps the frame alive
+        messageDict[key] = np.frombuffer(frame,dtype=dtype).reshape(shape)
+    return messageDict
+
+def recvProfileMessage(socket,flags=0):
+    """
+    Receives and unpacks one message from socket without copying the array data.
+    """
+    return unpackProfileMessage(socket.recv_multipart(flags,copy=False))
+
+def _bytes(frame):
+    return frame.bytes if hasattr(frame,"bytes") else frame
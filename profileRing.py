@@ -0,0 +1,233 @@
+"""
+Shared-memory ring buffer for intensity profiles.
+
+A single ProfileIngest process subscribes to the lvdata producer, decodes every
+message once and writes the profile into the next slot of a ProfileRingBuffer,
+a memory-mapped file that all processes on the host map. It then publishes a
+notification with only the slot index and sequence number. Readers (the GUI and
+the fit workers) subscribe to the notifications and take zero-copy views of the
+slots. A reader that has fallen behind can skip to the newest notification.
+
+A slot is overwritten after nSlots newer profiles, so a view is only valid
+until then. ProfileRingBuffer.read returns None for a slot that has already
+been reused.
+"""
+
+import zmq
+import numpy as np
+import multiprocessing as mp
+import tempfile
+import struct
+import os
+
+from profileMessage import unpackProfileMessage
+
+_header = struct.Struct("<8sII")
+_MAGIC = b"ODMRING1"
+_notification = struct.Struct("<Iq")
+
+_metaDtype = np.dtype([('sequence','<i8'),
+                       ('length','<i4'),
+                       ('actuatorVoltage','<f8'),
+                       ('frameNumber','<i8'),
+                       ('sendTime','<f8'),
+                       ('status','S128')])
+
+
+def packSlotNotification(slot,sequence):
+    return _notification.pack(slot,sequence)
+
+def unpackSlotNotification(notificationBytes):
+    return _notification.unpack(notificationBytes)
+
+
+class ProfileRingBuffer(object):
+    def __init__(self,path,nSlots=None,profileLength=None):
+        """
+        Maps the ring buffer file at path. When nSlots and profileLength are
+        given the file is created, otherwise the layout is read from the
+        header of the existing file.
+        """
+        self.path = path
+        create = nSlots is not None
+        if not create:
+            with open(path,"rb") as f:
+                magic, nSlots, profileLength = _header.unpack(f.read(_header.size))
+            if magic != _MAGIC:
+                raise ValueError("%s is not a profile ring buffer" % path)
+
+        self.nSlots = nSlots
+        self.profileLength = profileLength
+
+        metaOffset = 64
+        profileOffset = metaOffset + ((nSlots * _metaDtype.itemsize + 63) // 64) * 64
+        if create:
+            with open(path,"wb") as f:
+                f.write(_header.pack(_MAGIC,nSlots,profileLength))
+                # size the file before it is mapped
+                f.truncate(profileOffset + nSlots * profileLength * 8)
+
+        self._meta = np.memmap(path,dtype=_metaDtype,mode="r+",offset=metaOffset,shape=(nSlots,))
+        self._profiles = np.memmap(path,dtype='<f8',mode="r+",offset=profileOffset,shape=(nSlots,profileLength))
+        if create:
+            self._meta['sequence'] = -1
+
+        self._nextSequence = 0
+
+    def write(self,lvdata):
+        """
+        Writes the profile and fields of a decoded lvdata message into the next
+        slot and returns (slot, sequence).
+        """
+        profile = lvdata['Intensity Profile']
+        length = len(profile)
+        if length > self.profileLength:
+            raise ValueError("profile of length %i does not fit in the ring buffer (%i)" % (length,self.profileLength))
+
+        sequence = self._nextSequence
+        slot = sequence % self.nSlots
+        meta = self._meta[slot]
+        # mark the slot as being written, readers treat it as stale meanwhile
+        meta['sequence'] = -1
+        self._profiles[slot,:length] = profile
+        meta['length'] = length
+        meta['actuatorVoltage'] = lvdata.get('Actuator Voltage',np.nan)
+        meta['frameNumber'] = lvdata.get('Frame Number',-1)
+        meta['sendTime'] = lvdata.get('Send Time',np.nan)
+        status = lvdata.get('Measurement Process State',"")
+        if isinstance(status,unicode):
+            status = status.encode('utf-8')
+        meta['status'] = status[:128]
+        meta['sequence'] = sequence
+
+        self._nextSequence += 1
+        return slot, sequence
+
+    def read(self,slot,sequence):
+        """
+        Returns an lvdata dict with a view of the profile in slot, or None if the
+        slot no longer holds the profile with this sequence number.
+        """
+        meta = self._meta[slot]
+        if meta['sequence'] != sequence:
+            return None
+        return {'Intensity Profile': self._profiles[slot,:meta['length']],
+                'Actuator Voltage': float(meta['actuatorVoltage']),
+                'Frame Number': int(meta['frameNumber']),
+                'Send Time': float(meta['sendTime']),
+                'Measurement Process State': meta['status']}
+
+    def isCurrent(self,slot,sequence):
+        """
+        Tells whether a view obtained with read is still valid.
+        """
+        return self._meta[slot]['sequence'] == sequence
+
+    def close(self):
+        del self._meta
+        del self._profiles
+
+
+class ProfileIngest(object):
+    def __init__(self,producerAddress,ringPath,controlAddress):
+        """
+        Reads lvdata from producerAddress, writes the profiles into the ring
+        buffer at ringPath and publishes (slot, sequence) notifications on
+        a randomly chosen port, see notifyAddress.
+        """
+        self.context = zmq.Context()
+
+        self.control_socket = self.context.socket(zmq.PULL)
+        self.control_socket.connect(controlAddress)
+
+        self.producer_socket = self.context.socket(zmq.SUB)
+        self.producer_socket.connect(producerAddress)
+        self.producer_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+
+        self.notify_socket = self.context.socket(zmq.PUB)
+        port = self.notify_socket.bind_to_random_port("tcp://127.0.0.1")
+        self._notifyAddress = "tcp://127.0.0.1:%i" % port
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.producer_socket,zmq.POLLIN)
+        self.poller.register(self.control_socket,zmq.POLLIN)
+
+        self.ring = ProfileRingBuffer(ringPath)
+        self.state = "running"
+
+    @property
+    def notifyAddress(self):
+        return self._notifyAddress
+
+    def run(self):
+        try:
+            while self.state != "aborted":
+                sockets = dict(self.poller.poll())
+
+                if self.control_socket in sockets:
+                    rpc = self.control_socket.recv_pyobj()
+                    if rpc['method'] == 'abort':
+                        self.state = "aborted"
+                        break
+
+                if self.producer_socket in sockets:
+                    lvdata = unpackProfileMessage(self.producer_socket.recv_multipart(copy=False))
+                    try:
+                        slot, sequence = self.ring.write(lvdata)
+                    except ValueError as e:
+                        print e
+                        continue
+                    self.notify_socket.send(packSlotNotification(slot,sequence))
+        finally:
+            self.producer_socket.close(linger=0)
+            self.notify_socket.close(linger=0)
+            self.control_socket.close(linger=0)
+            self.context.term()
+            self.ring.close()
+
+def profileIngestWorker(producerAddress, ringPath, controlAddress, addressConnection):
+    profileIngest = ProfileIngest(producerAddress, ringPath, controlAddress)
+    addressConnection.send(profileIngest.notifyAddress)
+    addressConnection.close()
+    profileIngest.run()
+
+
+class ProfileIngestService(object):
+    def __init__(self,producerAddress,nSlots=256,profileLength=4096):
+        """
+        Creates the ring buffer file and starts the ProfileIngest process for
+        producerAddress. Readers open the ring at ringPath and subscribe to
+        notifyAddress.
+        """
+        handle, self._ringPath = tempfile.mkstemp(prefix="odm-live-",suffix=".ring",
+                                                  dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        os.close(handle)
+        ProfileRingBuffer(self._ringPath,nSlots,profileLength).close()
+
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.PUSH)
+        port = self._socket.bind_to_random_port("tcp://127.0.0.1")
+        self._socket.setsockopt(zmq.LINGER, 100)
+        controlAddress = "tcp://127.0.0.1:%i" % port
+
+        parentConnection, childConnection = mp.Pipe()
+        self._process = mp.Process(target=profileIngestWorker,
+                                   args=(producerAddress,self._ringPath,controlAddress,childConnection))
+        self._process.start()
+        self._notifyAddress = parentConnection.recv()
+
+    @property
+    def ringPath(self):
+        return self._ringPath
+
+    @property
+    def notifyAddress(self):
+        return self._notifyAddress
+
+    def abort(self):
+        self._socket.send_pyobj(dict(method="abort"))
+        self._process.join(2.0)
+        try:
+            os.remove(self._ringPath)
+        except OSError:
+            pass
@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class ProfileStatistics(object):
+    def __init__(self,alpha=0.1,window=100):
+        """
+        Per-pixel statistics of a stream of intensity profiles, updated in place
+        in preallocated float64 buffers:
+          - the cumulative mean and variance (Welford's algorithm)
+          - an exponential moving average with smoothing factor alpha
+          - the mean of the last window profiles
+        Profiles can be recorded one at a time or as a batch (one per row). A
+        profile of another length starts the statistics over.
+        """
+        self.alpha = alpha
+        self.window = window
+        self.length = None
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        if self.length is not None:
+            self._allocate(self.length)
+
+    def _allocate(self,length):
+        self.length = length
+        self._mean = np.zeros(length)
+        self._m2 = np.zeros(length)
+        self._ema = np.zeros(length)
+        self._windowBuffer = np.zeros((self.window,length))
+        self._windowSum = np.zeros(length)
+        self._delta = np.empty(length)
+        self._scratch = np.empty(length)
+
+    @property
+    def mean(self):
+        return self._mean if self.n > 0 else None
+
+    @property
+    def profile(self):
+        """
+        The cumulative mean profile, or None if nothing was recorded.
+        """
+        return self.mean
+
+    @property
+    def variance(self):
+        return self._m2 / (self.n - 1) if self.n > 1 else None
+
+    @property
+    def sigma(self):
+        """
+        Per-pixel standard deviation, to be used as sigma (weights) of the fits.
+        Pixels without measurable noise get a small nonzero value.
+        """
+        variance = self.variance
+        if variance is None:
+            return None
+        floor = max(variance.max() * 1e-6, np.finfo(float).tiny)
+        return np.sqrt(np.maximum(variance,floor))
+
+    @property
+    def ema(self):
+        return self._ema if self.n > 0 else None
+
+    @property
+    def windowMean(self):
+        if self.n == 0:
+            return None
+        return self._windowSum / min(self.n,self.window)
+
+    def record(self,profile):
+        if self.length != len(profile):
+            self._allocate(len(profile))
+            self.n = 0
+
+        self.n += 1
+        n = self.n
+        delta, scratch = self._delta, self._scratch
+
+        # Welford: mean += delta/n, m2 += delta*(x-newMean)
+        np.subtract(profile,self._mean,out=delta)
+        np.multiply(delta,1.0/n,out=scratch)
+        self._mean += scratch
+        np.subtract(profile,self._mean,out=scratch)
+        scratch *= delta
+        self._m2 += scratch
+
+        if n == 1:
+            self._ema[:] = profile
+        else:
+            self._ema *= 1.0 - self.alpha
+            np.multiply(profile,self.alpha,out=scratch)
+            self._ema += scratch
+
+        slot = (n-1) % self.window
+        self._windowSum -= self._windowBuffer[slot]
+        self._windowBuffer[slot] = profile
+        self._windowSum += self._windowBuffer[slot]
+        if slot == self.window - 1:
+            # keep the running sum from drifting
+            self._windowBuffer.sum(axis=0,out=self._windowSum)
+
+    def recordBatch(self,profiles):
+        profiles = np.atleast_2d(profiles)
+        k, length = profiles.shape
+        if k == 0:
+            return
+        if self.length != length:
+            self._allocate(length)
+            self.n = 0
+        if self.n == 0:
+            self.record(profiles[0])
+            profiles = profiles[1:]
+            k -= 1
+            if k == 0:
+                return
+
+        # combine the batch with the running statistics (Chan et al.)
+        n = self.n
+        batchMean = profiles.mean(axis=0)
+        batchM2 = ((profiles - batchMean)**2).sum(axis=0)
+        np.subtract(batchMean,self._mean,out=self._delta)
+        self._mean += self._delta * (k / float(n+k))
+        self._m2 += batchM2 + self._delta**2 * (n*k / float(n+k))
+
+        decay = 1.0 - self.alpha
+        weights = self.alpha * decay**np.arange(k-1,-1,-1)
+        self._ema *= decay**k
+        self._ema += np.dot(weights,profiles)
+
+        if k >= self.window:
+            slots = np.arange(n+k-self.window,n+k) % self.window
+            self._windowBuffer[slots] = profiles[-self.window:]
+            self._windowBuffer.sum(axis=0,out=self._windowSum)
+        else:
+            slots = np.arange(n,n+k) % self.window
+            self._windowSum -= self._windowBuffer[slots].sum(axis=0)
+            self._windowBuffer[slots] = profiles
+            self._windowSum += profiles.sum(axis=0)
+
+        self.n = n + k
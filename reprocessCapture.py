@@ -0,0 +1,195 @@
+"""
+Re-runs the displacement analysis of a capture recorded with profileCapture,
+e.g. with another fit function or other peak intervals, on all cores.
+
+The frames are split into contiguous chunks of --chunk-size frames that a pool
+of worker processes fits with the BatchFitter (see fitProfileMatrix). Every
+chunk starts from its own first frame, fitted with a PeakFitter, so that the
+chunks do not depend on each other. When the fits of the last frames of a
+batch fail, e.g. on dark frames, these frames are fitted again from the
+newest of them that a PeakFitter can fit. The workers memory-map the capture and the
+displacements are written to the output as the chunks come back, in order, so
+the memory used does not grow with the size of the capture.
+
+The output is a .npy file of (timestamp, displacement_mp, displacement_ref,
+displacement, converged) records, or a text file with these columns when its
+name ends with .csv. Frames whose fit did not converge have NaN displacements.
+
+The fit function is a pickled ScaledSpline (--spline), or is made from one of
+the captured profiles (--reference-frame, --sigma) like the Spline Creator of
+the gui does.
+
+usage: python reprocessCapture.py capturedir output.npy --mp-interval 40,80 [--ref-interval 120,160]
+           [--spline spline.pkl | --reference-frame 0 --sigma 0] [--processes 4] [--chunk-size 4096]
+"""
+
+import numpy as np
+import multiprocessing as mp
+import argparse
+import pickle
+import time
+
+from batchFitter import fitProfileMatrix
+from peakFitter import PeakFitter
+from profileCapture import Capture
+
+_reprocessedDtype = np.dtype([('timestamp','<f8'),
+                              ('displacement_mp','<f8'),
+                              ('displacement_ref','<f8'),
+                              ('displacement','<f8'),
+                              ('converged','?')])
+
+# the first frames of a chunk that are tried for the fit it starts from
+FIRST_FIT_ATTEMPTS = 8
+
+# state of a pool worker, set by _initializeWorker
+_worker = dict()
+
+
+def _initializeWorker(directory,peaks,batchSize):
+    _worker['capture'] = Capture(directory)
+    _worker['peaks'] = peaks
+    _worker['batchSize'] = batchSize
+
+def _firstFit(name,fitFunction,interval,profiles):
+    """
+    Returns the fitted parameters of the first of the profiles that can be
+    fitted, None if none of the first FIRST_FIT_ATTEMPTS can.
+    """
+    peakFitter = PeakFitter(name)
+    peakFitter.setFitFunction(fitFunction)
+    peakFitter.setInterval(interval)
+    for profile in profiles[:FIRST_FIT_ATTEMPTS]:
+        try:
+            return peakFitter.fit(np.asarray(profile,dtype=np.float64))[1]
+        except RuntimeError:
+            continue
+    return None
+
+def reprocessRange(rows):
+    """
+    Fits the captured rows (start, stop) in a pool worker. Returns the records
+    of the rows.
+    """
+    start, stop = rows
+    frames, profiles = _worker['capture'].frameRange(start,stop)
+    records = np.zeros(len(frames),dtype=_reprocessedDtype)
+    records['timestamp'] = frames['timestamp']
+    records['converged'] = True
+    records['displacement_ref'] = 0.0
+    for name, (fitFunction, interval) in _worker['peaks'].items():
+        displacements = records['displacement_%s' % name]
+        displacements[:] = np.nan
+        seed = lambda batch: _firstFit(name,fitFunction,interval,batch)
+        p0 = seed(profiles)
+        row = 0
+        for params, batchDisplacements, converged in fitProfileMatrix(profiles,fitFunction,interval,
+                                                                       _worker['batchSize'],
+                                                                       (0.0,1.0,0.0) if p0 is None else p0,seed):
+            n = len(converged)
+            displacements[row:row+n] = np.where(converged,batchDisplacements,np.nan)
+            records['converged'][row:row+n] &= converged
+            row += n
+    records['displacement'] = records['displacement_mp'] - records['displacement_ref']
+    return records
+
+def reprocessCapture(directory,peaks,processes=None,chunkSize=4096,batchSize=256):
+    """
+    Generator that fits the capture in directory on a pool of processes
+    (cpu_count by default) and yields the records of every chunk of chunkSize
+    frames, in order. peaks maps "mp", and optionally "ref", to a
+    (fitFunction, interval) pair; without "ref" the displacement is that of
+    the moving peak.
+    """
+    nFrames = len(Capture(directory))
+    ranges = [(start,min(start+chunkSize,nFrames)) for start in range(0,nFrames,chunkSize)]
+    pool = mp.Pool(processes,initializer=_initializeWorker,initargs=(directory,peaks,batchSize))
+    try:
+        for records in pool.imap(reprocessRange,ranges):
+            yield records
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def writeReprocessed(chunks,path,nFrames):
+    """
+    Writes the records of chunks, as they come, to a .npy file of nFrames
+    records or a .csv file at path. Returns the number of frames that did not
+    converge.
+    """
+    failed = 0
+    if path.endswith(".csv"):
+        with open(path,"w") as f:
+            f.write(",".join(_reprocessedDtype.names) + "\n")
+            for records in chunks:
+                np.savetxt(f,np.column_stack([records[name] for name in _reprocessedDtype.names]),
+                           fmt=["%.6f","%.6g","%.6g","%.6g","%i"],delimiter=",")
+                failed += int((~records['converged']).sum())
+        return failed
+
+    output = np.lib.format.open_memmap(path,mode="w+",dtype=_reprocessedDtype,shape=(nFrames,))
+    row = 0
+    for records in chunks:
+        output[row:row+len(records)] = records
+        row += len(records)
+        failed += int((~records['converged']).sum())
+    output.flush()
+    return failed
+
+def loadFitFunction(capture,splinePath=None,referenceFrame=0,sigma=0):
+    """
+    Returns the fit function pickled in splinePath, or a ScaledSpline made
+    from the referenceFrame-th profile of the capture.
+    """
+    if splinePath is not None:
+        with open(splinePath,"rb") as f:
+            return pickle.load(f)
+    from odmanalysis import fitfunctions
+    frames, profiles = capture.frameRange(referenceFrame,referenceFrame+1)
+    if len(frames) == 0:
+        raise ValueError("the capture has no frame %i" % referenceFrame)
+    fitFunction = fitfunctions.ScaledSpline()
+    fitFunction.estimateInitialParameters(np.asarray(profiles[0][:frames[0]['length']],dtype=np.float64),
+                                          filter_sigma=sigma)
+    return fitFunction
+
+
+if __name__ == "__main__":
+    interval = lambda text: tuple(int(value) for value in text.split(","))
+    parser = argparse.ArgumentParser(description="Re-fit the displacements of a recorded capture")
+    parser.add_argument('capture',
+                        help="Capture directory.")
+    parser.add_argument('output',
+                        help="Output file, .npy or .csv.")
+    parser.add_argument('--mp-interval', type=interval, required=True,
+                        help="Interval [pixels] of the moving peak, e.g. 40,80.")
+    parser.add_argument('--ref-interval', type=interval, default=None,
+                        help="Interval [pixels] of the reference peak; without it the displacement is that of the moving peak.")
+    parser.add_argument('--spline', default=None,
+                        help="Pickled fit function to use instead of one made from a captured profile.")
+    parser.add_argument('--reference-frame', type=int, default=0,
+                        help="Captured frame the fit function is made from.")
+    parser.add_argument('--sigma', type=int, default=0,
+                        help="Gaussian filter sigma of the fit function made from the reference frame.")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Number of worker processes, all cores by default.")
+    parser.add_argument('--chunk-size', type=int, default=4096,
+                        help="Frames per chunk of work.")
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help="Frames the BatchFitter fits at once.")
+    args = parser.parse_args()
+
+    capture = Capture(args.capture)
+    nFrames = len(capture)
+    fitFunction = loadFitFunction(capture,args.spline,args.reference_frame,args.sigma)
+    peaks = dict(mp=(fitFunction,args.mp_interval))
+    if args.ref_interval is not None:
+        peaks['ref'] = (fitFunction,args.ref_interval)
+
+    t0 = time.time()
+    chunks = reprocessCapture(args.capture,peaks,args.processes,args.chunk_size,args.batch_size)
+    failed = writeReprocessed(chunks,args.output,nFrames)
+    elapsed = time.time() - t0
+    print "%i frames in %.1f s (%.0f frames/s), %i not converged, written to %s" % (
+        nFrames, elapsed, nFrames / max(elapsed,1e-9), failed, args.output)
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class ScaledSplineModel(object):
+    def __init__(self,fitFunction):
+        """
+        Exposes the model behind a fitfunctions.ScaledSpline,
+
+            f(x, shift, scale, offset) = scale * s(x - shift) + offset
+
+        together with its derivatives. s is the unshifted spline itself. Its
+        derivative is taken from the underlying scipy spline when the fit function
+        exposes one, otherwise it is approximated with a central difference.
+        A TabulatedScaledSpline provides both from its lookup table.
+        """
+        self.fitFunction = fitFunction
+        self._isTabulated = getattr(fitFunction,"isTabulated",False)
+        self._splineDerivative = self._findSplineDerivative()
+
+    def _findSplineDerivative(self):
+        if self._isTabulated:
+            return self.fitFunction.splineDerivative
+        u = np.linspace(0,10,7)
+        for name in ("spline","_spline"):
+            spline = getattr(self.fitFunction,name,None)
+            if spline is None or not hasattr(spline,"derivative"):
+                continue
+            try:
+                # only trust the spline if it is the same curve as the fit function
+                if np.allclose(spline(u),self.spline(u)):
+                    return spline.derivative()
+            except Exception:
+                pass
+        return None
+
+    @property
+    def hasExactDerivative(self):
+        return self._splineDerivative is not None
+
+    def spline(self,u):
+        return self.fitFunction(u,0.0,1.0,0.0)
+
+    def splineDerivative(self,u,h=1e-4):
+        if self._splineDerivative is not None:
+            return self._splineDerivative(u)
+        else:
+            return (self.spline(u+h)-self.spline(u-h))/(2*h)
+
+    def __call__(self,x,shift,scale,offset):
+        return scale * self.spline(x-shift) + offset
+
+    def jacobian(self,x,shift,scale,offset):
+        """
+        Returns the len(x) x 3 matrix of partial derivatives with respect to
+        shift, scale and offset.
+        """
+        u = x - shift
+        jac = np.empty((len(x),3))
+        values, derivatives = self.evaluate(u)
+        jac[:,0] = -scale * derivatives
+        jac[:,1] = values
+        jac[:,2] = 1.0
+        return jac
+
+    def evaluate(self,u):
+        """
+        Evaluates the spline and its derivative for an array u of any shape.
+        """
+        if self._isTabulated:
+            return self.fitFunction.evaluate(u)
+        flat = np.ravel(u)
+        return (np.reshape(self.spline(flat),np.shape(u)),
+                np.reshape(self.splineDerivative(flat),np.shape(u)))
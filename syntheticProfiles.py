@@ -0,0 +1,58 @@
+"""
+Synthetic intensity profiles and fit functions for the benchmarks.
+
+The standard profile has two gaussian peaks on an axis from 0 to 100, sampled
+with length points: a moving peak at 30 and a stationary reference peak at 60.
+"""
+
+import numpy as np
+
+from odmanalysis import fitfunctions
+
+
+def gauss(x, mu, sigma):
+    return np.exp(-(x-mu)**2/(2.*sigma**2))
+
+def makeCleanProfile(length=200, shift=0.0):
+    """
+    Returns the noise-free profile with the moving peak shifted by shift (in
+    units of the axis, not pixels).
+    """
+    xValues = np.linspace(0,100,length)
+    return (gauss(xValues,30+shift,5)+gauss(xValues,60,5))*10000
+
+def makeProfile(length=200, shift=0.0):
+    """
+    Returns the profile with poisson noise.
+    """
+    return np.random.poisson(makeCleanProfile(length,shift))
+
+def makeProfiles(nFrames, length=200, stroke=3):
+    """
+    Returns noisy profiles whose moving peak goes through one period of a sine
+    of amplitude stroke, and the shifts of the moving peak.
+    """
+    shifts = np.sin(np.linspace(0,2*np.pi,nFrames)) * stroke
+    return [makeProfile(length,shift) for shift in shifts], shifts
+
+def makeSplineFitFunction(cleanProfile):
+    spline = fitfunctions.ScaledSpline()
+    spline.estimateInitialParameters(cleanProfile)
+    return spline
+
+def makeFitFunction(length=200):
+    """
+    Returns a ScaledSpline made from the noise-free standard profile.
+    """
+    return makeSplineFitFunction(makeCleanProfile(length))
+
+def peakIntervals(length, roiWidth):
+    """
+    Returns the moving and reference peak intervals of roiWidth pixels around
+    the two peaks of the standard profile.
+    """
+    intervals = []
+    for peakPosition in (30,60):
+        center = int(round(peakPosition / 100. * (length-1)))
+        intervals.append((center - roiWidth//2, center + roiWidth//2))
+    return intervals
@@ -0,0 +1,129 @@
+import numpy as np
+
+from splineModel import ScaledSplineModel
+
+
+class TabulatedScaledSpline(object):
+    isTabulated = True
+    
+    def __init__(self,fitFunction,domain=None,tolerance=1e-6,margin=10.0,maxSamplesPerPixel=256):
+        """
+        Lookup-table version of a fitfunctions.ScaledSpline,
+
+            f(x, shift, scale, offset) = scale * s(x - shift) + offset
+
+        s and its derivative are sampled once on a uniform subpixel grid over
+        domain (the pixel range of the profile the spline was made from,
+        widened by margin pixels). Between the samples s is the cubic Hermite
+        interpolant of the samples, kept as one polynomial per grid interval so
+        that an evaluation is an index computation and a Horner step. The grid
+        is refined until the
+        interpolation error halfway between the samples, where it is largest,
+        is below tolerance times the maximum of |s|. Points outside the domain
+        are evaluated with the original fit function.
+
+        It can be used in place of the original fit function, for the fits as
+        well as for plotting. Other attributes, like getDisplacement, are
+        taken from the original.
+        """
+        self.fitFunction = fitFunction
+        self.tolerance = tolerance
+        model = ScaledSplineModel(fitFunction)
+        self._model = model
+
+        if domain is None:
+            domain = self._splineDomain(model)
+        self.umin = float(min(domain)) - margin
+        self.umax = float(max(domain)) + margin
+
+        samplesPerPixel = 2
+        while True:
+            self._tabulate(model,samplesPerPixel)
+            self.maxError = self._measureError(model)
+            if self.maxError <= tolerance * self._scale or samplesPerPixel >= maxSamplesPerPixel:
+                break
+            samplesPerPixel *= 2
+        self.samplesPerPixel = samplesPerPixel
+
+    def _splineDomain(self,model):
+        for name in ("spline","_spline"):
+            spline = getattr(self.fitFunction,name,None)
+            if spline is not None and hasattr(spline,"get_knots"):
+                knots = spline.get_knots()
+                return knots[0], knots[-1]
+        raise ValueError("the domain of %s is not known, pass it as domain" % self.fitFunction)
+
+    def _tabulate(self,model,samplesPerPixel):
+        self.step = 1.0 / samplesPerPixel
+        nSamples = int(np.ceil((self.umax - self.umin) / self.step)) + 1
+        u = self.umin + self.step * np.arange(nSamples)
+        self.umax = u[-1]
+        y = np.asarray(model.spline(u),dtype=np.float64)
+        d = np.asarray(model.splineDerivative(u),dtype=np.float64) * self.step
+        self._scale = max(np.abs(y).max(),np.finfo(float).tiny)
+        self._nIntervals = nSamples - 1
+
+        # s(umin + step*(i+f)) = c0[i] + c1[i]*f + c2[i]*f**2 + c3[i]*f**3 for 0 <= f <= 1
+        # one row per interval, so that a lookup is a single indexing operation
+        dy = y[1:] - y[:-1]
+        self._coefficients = np.column_stack((y[:-1], d[:-1],
+                                              3.0*dy - 2.0*d[:-1] - d[1:],
+                                              d[:-1] + d[1:] - 2.0*dy))
+
+    def _measureError(self,model):
+        u = self.umin + self.step * (np.arange(self._nIntervals) + 0.5)
+        return np.abs(self.spline(u) - model.spline(u)).max()
+
+    def _lookup(self,u):
+        """
+        Returns the polynomial coefficients and the position in the interval
+        for every element of the 1-d array u, and a mask of the elements
+        outside the table or None.
+        """
+        t = (u - self.umin) * (1.0 / self.step)
+        i = t.astype(np.intp)
+        if u.size and (t.min() < 0 or i.max() >= self._nIntervals):
+            outside = (t < 0) | (i >= self._nIntervals)
+            i[outside] = 0
+        else:
+            outside = None
+        t -= i
+        return self._coefficients[i], t, outside
+
+    def evaluate(self,u):
+        """
+        Returns s(u) and s'(u) for an array u of any shape.
+        """
+        u = np.asarray(u,dtype=np.float64)
+        flat = u.ravel()
+        c, f, outside = self._lookup(flat)
+        values = ((c[:,3]*f + c[:,2])*f + c[:,1])*f + c[:,0]
+        derivatives = ((3.0*c[:,3]*f + 2.0*c[:,2])*f + c[:,1]) * (1.0 / self.step)
+        if outside is not None:
+            values[outside] = self._model.spline(flat[outside])
+            derivatives[outside] = self._model.splineDerivative(flat[outside])
+        return values.reshape(u.shape), derivatives.reshape(u.shape)
+
+    def spline(self,u):
+        u = np.asarray(u,dtype=np.float64)
+        flat = u.ravel()
+        c, f, outside = self._lookup(flat)
+        values = ((c[:,3]*f + c[:,2])*f + c[:,1])*f + c[:,0]
+        if outside is not None:
+            values[outside] = self._model.spline(flat[outside])
+        return values.reshape(u.shape)
+
+    def splineDerivative(self,u):
+        return self.evaluate(u)[1]
+
+    def __call__(self,x,shift,scale,offset):
+        values = self.spline(np.asarray(x,dtype=np.float64) - shift)
+        values *= scale
+        values += offset
+        return values
+
+    def __getattr__(self,name):
+        # not for special or own attributes, so that copy and pickle work
+        if name.startswith("__") or name in ("fitFunction","_model"):
+            raise AttributeError(name)
+        return getattr(self.fitFunction,name)
@@ -0,0 +1,134 @@
+"""
+Array-backed time series with a min/max decimation pyramid, for plotting long
+histories.
+
+Level 0 holds the raw (x, y) points. Level k holds the minimum and maximum of y
+over blocks of factor**k points, which only cover complete blocks and are
+updated incrementally when points are appended. getView returns the points of
+an x range at the coarsest level that still gives maxPoints points: blocks are
+drawn as a vertical min-max segment, which looks the same as drawing all the
+points they stand for.
+"""
+
+import numpy as np
+
+
+class DecimatedTimeSeries(object):
+    def __init__(self,capacity=2**22,factor=8):
+        """
+        Holds up to capacity points, x must not decrease. When the series is
+        full the oldest half is dropped.
+        """
+        self.factor = factor
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self._x = np.empty(self.capacity)
+        self._y = np.empty(self.capacity)
+        self._n = 0
+        # level k (k >= 1) is kept at index k-1
+        self._mins = []
+        self._maxs = []
+        self._nBlocks = []
+        blockSize = self.factor
+        while blockSize <= self.capacity:
+            self._mins.append(np.empty(self.capacity // blockSize))
+            self._maxs.append(np.empty(self.capacity // blockSize))
+            self._nBlocks.append(0)
+            blockSize *= self.factor
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def x(self):
+        return self._x[:self._n]
+
+    @property
+    def y(self):
+        return self._y[:self._n]
+
+    def append(self,x,y):
+        """
+        Appends arrays of points.
+        """
+        x = np.atleast_1d(np.asarray(x,dtype=float))
+        y = np.atleast_1d(np.asarray(y,dtype=float))
+        if len(x) > self.capacity:
+            x = x[-self.capacity:]
+            y = y[-self.capacity:]
+        if self._n + len(x) > self.capacity:
+            self._dropOldest(max(self._n // 2, self._n + len(x) - self.capacity))
+        self._x[self._n:self._n+len(x)] = x
+        self._y[self._n:self._n+len(y)] = y
+        self._n += len(x)
+        self._updatePyramid()
+
+    def getView(self,xmin=None,xmax=None,maxPoints=2000):
+        """
+        Returns (x, y) arrays to draw the points with xmin <= x <= xmax, with at
+        most about maxPoints points.
+        """
+        i0 = 0 if xmin is None else int(np.searchsorted(self.x,xmin,'left'))
+        i1 = self._n if xmax is None else int(np.searchsorted(self.x,xmax,'right'))
+        # include the neighbouring points so that the line runs to the edges
+        i0 = max(i0-1,0)
+        i1 = min(i1+1,self._n)
+        if i1 <= i0:
+            return np.zeros(0), np.zeros(0)
+
+        level = 0
+        blockSize = 1
+        while (i1 - i0) // blockSize > maxPoints // 2 and level < len(self._mins):
+            level += 1
+            blockSize *= self.factor
+        xs, ys = self._render(level,i0,i1)
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def _render(self,level,i0,i1):
+        if i1 <= i0:
+            return [], []
+        if level == 0:
+            return [self._x[i0:i1]], [self._y[i0:i1]]
+
+        blockSize = self.factor ** level
+        firstBlock = -(-i0 // blockSize)
+        lastBlock = min(i1 // blockSize, self._nBlocks[level-1])
+        if firstBlock >= lastBlock:
+            return self._render(level-1,i0,i1)
+
+        headX, headY = self._render(level-1,i0,firstBlock*blockSize)
+        tailX, tailY = self._render(level-1,lastBlock*blockSize,i1)
+
+        blocks = np.arange(firstBlock,lastBlock)
+        x = np.repeat(self._x[blocks*blockSize],2)
+        y = np.empty(2*len(blocks))
+        y[0::2] = self._mins[level-1][firstBlock:lastBlock]
+        y[1::2] = self._maxs[level-1][firstBlock:lastBlock]
+        return headX + [x] + tailX, headY + [y] + tailY
+
+    def _updatePyramid(self):
+        lowerMins = self._y
+        lowerMaxs = self._y
+        lowerCount = self._n
+        for k in range(len(self._mins)):
+            start = self._nBlocks[k]
+            end = lowerCount // self.factor
+            if end > start:
+                f = self.factor
+                self._mins[k][start:end] = lowerMins[start*f:end*f].reshape(-1,f).min(axis=1)
+                self._maxs[k][start:end] = lowerMaxs[start*f:end*f].reshape(-1,f).max(axis=1)
+                self._nBlocks[k] = end
+            lowerMins = self._mins[k]
+            lowerMaxs = self._maxs[k]
+            lowerCount = self._nBlocks[k]
+
+    def _dropOldest(self,nPoints):
+        keep = self._n - nPoints
+        self._x[:keep] = self._x[nPoints:self._n]
+        self._y[:keep] = self._y[nPoints:self._n]
+        self._n = keep
+        # the block boundaries have moved, rebuild the pyramid
+        self._nBlocks = [0] * len(self._nBlocks)
+        self._updatePyramid()